@@ -1,4 +1,4 @@
 "CAMMAC package"
 __version__ = '1.0'
 
-__all__=["ancillary","cancillary","variability","changes","mips_et_al","esgf_query", "figures.py" ]
+__all__=["ancillary","cancillary","variability","changes","mips_et_al","esgf_query", "figures.py", "cache", "fusion", "store" ]
@@ -9,7 +9,7 @@ Ancillary functions for :
 from __future__  import division, print_function , unicode_literals, absolute_import
 
 
-import json, os, os.path
+import json, os, os.path, re
 
 #: A dictionnary of pretty labels for some acronyms 
 prettier_label={  
@@ -24,6 +24,9 @@ prettier_label={
     "dry":"dry days per year",
     "ydrain" : "daily precipitation intensity",
     "ydry":"dry days per year",
+    "rx1day" : "maximum 1-day precipitation",
+    "rx5day" : "maximum 5-day precipitation",
+    "cdd" : "maximum number of consecutive dry days",
     #
     "mean_change"  :"mean change"  , "mean_schange"  :"mean standardized change"  , "mean_rchange"  : "mean percentage change",
     "means_rchange"  : "percentage change of mean",
@@ -140,11 +143,77 @@ def amail(text,subject="The subject",to=["senesi@posteo.net"], sender="job_on_ci
     S.sendmail(sender,to,msg.as_string())
 
 
-def choose_regrid_option(variable,table,model,grid):
+#: Nominal resolution (dlon, dlat) in degrees of the native (regular) atmospheric
+#: grid of high resolution models, used for choosing a coarsening factor (see
+#: `choose_regrid_option`)
+native_resolutions={
+    "CNRM-CM6-1-HR"   : (0.5   , 0.5   ),
+    "MPI-ESM1-2-HR"   : (0.9375, 0.9375),
+    "MPI-ESM1-2-XR"   : (0.4688, 0.4688),
+    "HadGEM3-GC31-MM" : (0.8333, 0.5556),
+    "HadGEM3-GC31-HM" : (0.3516, 0.2344),
+    "EC-Earth3P-HR"   : (0.3516, 0.3509),
+    "CMCC-CM2-VHR4"   : (0.3125, 0.2356),
+}
+
+#: Upper bound for the ratio of the coarsened grid resolution to the target
+#: grid resolution (see `choose_regrid_option`)
+coarsening_fraction=0.5
+
+#: Toggle for pre-coarsening the native grid of high resolution models before
+#: remapping (see `coarsening_factors`)
+use_coarsening=False
+
+#: Upper bound for the relative error of pre-coarsening, i.e. for the 99th
+#: percentile of the absolute difference between the two-stage and direct
+#: remapped fields, divided by the mean absolute value of the latter; it is
+#: checked by `cancillary.remap`, which falls back on direct remapping when
+#: it is exceeded (see `cancillary.coarsening_error`). None disables the check
+coarsening_tolerance=0.01
+
+
+def coarsening_factors(model,target_grid) :
+    """
+    Returns the pair of largest integer factors (FX,FY) by which the native
+    grid of MODEL can be coarsened, keeping its resolution finer than
+    `coarsening_fraction` times the resolution of TARGET_GRID (a CDO grid
+    name such as r360x180); returns (1,1) if `use_coarsening` is False, or
+    if the native or target resolution is not known
+    """
+    match=re.match(r"^r(\d+)x(\d+)$",target_grid or "")
+    if not use_coarsening or model not in native_resolutions or match is None :
+        return (1,1)
+    target=(360./int(match.group(1)),180./int(match.group(2)))
+    return tuple(max(1,int(coarsening_fraction*t/n+1.e-6)) for t,n in zip(target,native_resolutions[model]))
+
+
+def choose_regrid_option(variable,table,model,grid,target_grid=None):
     """
     Want to use a Cdo regrid option which can deal with published grid for Nemo, which has a band 
     of missing values in Indian Ocean
     The return value is a dict of arg/values for regridn
+
+    If TARGET_GRID (the CDO name of the destination grid) is provided, for
+    a high resolution model (see `native_resolutions`) and an atmosphere or
+    land variable, and if `use_coarsening` is True, the dict also includes
+    key 'coarsening' with the factors given by `coarsening_factors` (if
+    larger than 1), for a conservative pre-coarsening; the resulting dict
+    is then intended for `cancillary.remap`, which checks the accuracy of
+    the two-stage remapping against `coarsening_tolerance`
+    """
+    option=choose_regrid_option_internal(variable,table,model,grid)
+    if target_grid is None or table.startswith("O") or table.startswith("SI") or \
+       option["option"] != "remapcon" :
+        return option
+    factors=coarsening_factors(model,target_grid)
+    if factors != (1,1) :
+        option=dict(option,coarsening=factors)
+    return option
+
+
+def choose_regrid_option_internal(variable,table,model,grid):
+    """
+    Returns the regrid option for `choose_regrid_option`, without coarsening
     """
     default = {"option" : "remapcon"}   
     if table != "Omon":
@@ -0,0 +1,237 @@
+"""
+Script basins computes, for a (NetCDF format) file, the area-weighted
+averages of its fields over a series of basins and regions, all at once, by
+a sparse matrix product
+
+Usage :
+
+  basins --weights_dir DIR --basins_file FILE --basins_key KEY [--masks "files"] file_in file_out
+
+  where :
+
+    - DIR is the directory of the remapping weights cache (see module `remap`),
+      which also holds the basins matrices,
+    - FILE is a file coding basins by numbers, on cells of its grid (such as
+      data/basins/num_bas_ctrip.nc),
+    - KEY is a comma-separated list of NAME:NUMBER pairs, for the basins of
+      FILE to process (e.g. Amazon:1,Lena:8),
+    - "files" is a list of files of region masks (such as the monsoon domains
+      data/basins/*_global.nc), on the same grid as FILE, which cells with
+      value 1 (or more than 0.99) are in the region; a region is named after
+      its file basename, without suffix '_global.nc'
+
+Output has one record per record of file_in, and a dimension 'basin',
+which values are the basin and region names. Values are the same as those
+of `cancillary.basin_average`, which remaps with CDO operator 'remapcon'
+to the grid of FILE, masks a basin, and computes 'fldmean'
+
+The matrix which maps the cells of the input grid to the basins averages is
+built by composing the SCRIP weights of 'remapcon' (generated by CDO
+operator 'gencon', and cached, see `remap.weights_file`), the cell areas of
+the grid of FILE, and the basins masks. Its components are cached in DIR,
+keyed by the signatures of the input grid and missing values pattern (as
+the weights are), of FILE and of the basins list, so that they are
+computed only once per model grid. Missing values of the
+input are handled as CDO does, by re-normalizing remapping and averaging
+weights over valid cells; the resulting matrix is computed once per
+pattern of missing values, which is usually the same for all records.
+
+Requires scipy
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import xarray as xr
+import numpy as np
+import os, os.path, sys, hashlib
+
+try :
+    from ensemble_stats import sole_variable
+    from cache import atomic_write
+except ImportError :
+    from CAMMAClib.ensemble_stats import sole_variable
+    from CAMMAClib.cache import atomic_write
+
+#: Effective matrices, memoized by (components file, missing values pattern)
+matrices=dict()
+
+
+def mask_name(filename) :
+    """
+    Returns the name of the region which mask is in FILENAME
+    """
+    name=os.path.basename(filename)
+    for suffix in [ ".nc", "_global" ] :
+        if name.endswith(suffix) :
+            name=name[:-len(suffix)]
+    return name
+
+
+def basins_masks(basins_file, basins_key, masks_files) :
+    """
+    Returns the list of names of the basins in dict BASINS_KEY (name ->
+    number in BASINS_FILE) and of the regions of MASKS_FILES, and a boolean
+    array of their masks, with one row per name and one column per cell of
+    the grid of BASINS_FILE
+    """
+    names=[]
+    masks=[]
+    with xr.open_dataset(basins_file) as ds :
+        numbers=ds[sole_variable(ds)].values.reshape(-1)
+    for name,number in sorted(basins_key.items(), key=lambda item : item[1]) :
+        names.append(name)
+        masks.append(numbers == number)
+    for f in masks_files :
+        with xr.open_dataset(f) as ds :
+            da=ds[sole_variable(ds)]
+            if "time" in da.dims :
+                da=da.isel(time=0)
+            values=da.values.reshape(-1)
+        if values.size != numbers.size :
+            raise ValueError("Mask %s is not on the grid of %s"%(f,basins_file))
+        with np.errstate(invalid='ignore'):
+            masks.append(values > 0.99)
+        names.append(mask_name(f))
+    return names, np.array(masks)
+
+
+def components(source_file, basins_file, basins_key, masks_files, weights_dir) :
+    """
+    Returns the path of the file of the components of the basins matrix for
+    the grid of SOURCE_FILE (see `basins_masks` for the other arguments),
+    computing it in WEIGHTS_DIR if needed. Its arrays are : the remapping
+    weights (as a CSR sparse matrix), restricted to the cells of the grid
+    of BASINS_FILE which belong to a basin or region, these cells areas, the
+    masks on these cells, and the basins names
+    """
+    from remap import weights_file, grid_signature, mask_signature, target_signature
+    import scipy.sparse
+    masks_files=sorted(os.path.abspath(f) for f in masks_files)
+    key=",".join("%s:%d"%(name,number) for name,number in sorted(basins_key.items()))+" "+" ".join(masks_files)
+    basins_signature=hashlib.sha1(key.encode('utf-8')).hexdigest()[0:16]
+    path=os.path.join(weights_dir,"basins_%s_%s_%s_%s.npz"%(grid_signature(source_file),mask_signature(source_file),
+                                                            target_signature(basins_file),basins_signature))
+    if os.path.exists(path) :
+        return path
+    names,masks=basins_masks(basins_file, basins_key, masks_files)
+    scrip=weights_file(source_file,os.path.abspath(basins_file),"remapcon",weights_dir)
+    with xr.open_dataset(scrip) as ds :
+        src=ds["src_address"].values.astype(np.int64)-1
+        dst=ds["dst_address"].values.astype(np.int64)-1
+        weights=ds["remap_matrix"].values[:,0].astype(np.float64)
+        nsrc=ds.sizes["src_grid_size"]
+        areas=ds["dst_grid_area"].values.astype(np.float64)
+    # Keep only the target cells which belong to a basin or region
+    cells=np.nonzero(masks.any(axis=0))[0]
+    rows=-np.ones(areas.size,dtype=np.int64)
+    rows[cells]=np.arange(cells.size)
+    kept=rows[dst] >= 0
+    remapping=scipy.sparse.csr_matrix((weights[kept],(rows[dst[kept]],src[kept])),shape=(cells.size,nsrc))
+    atomic_write(path,lambda tmp : np.savez_compressed(tmp, data=remapping.data, indices=remapping.indices,
+                                                       indptr=remapping.indptr, shape=np.array(remapping.shape),
+                                                       areas=areas[cells], masks=masks[:,cells],
+                                                       names=np.array(names)))
+    return path
+
+
+def effective_matrix(path, valid) :
+    """
+    Returns a sparse matrix which maps the values of the source cells to
+    the basins averages, for components file PATH (see `components`) and
+    boolean array VALID of the source cells which have a non-missing value,
+    and the boolean array of the basins which have a valid average
+    """
+    import scipy.sparse
+    key=(path,hashlib.sha1(np.packbits(valid).tobytes()).hexdigest())
+    if key not in matrices :
+        with np.load(path) as npz :
+            remapping=scipy.sparse.csr_matrix((npz["data"],npz["indices"],npz["indptr"]),shape=tuple(npz["shape"]))
+            areas=npz["areas"]
+            masks=npz["masks"]
+        # Remapping, re-normalized over valid source cells
+        remapping=remapping.dot(scipy.sparse.diags(valid.astype(np.float64)))
+        sums=np.asarray(remapping.sum(axis=1)).reshape(-1)
+        covered=sums > 0
+        remapping=scipy.sparse.diags(np.where(covered,1./np.where(covered,sums,1.),0.)).dot(remapping)
+        # Area-weighted average over the valid target cells of each basin
+        averaging=scipy.sparse.csr_matrix(masks*np.where(covered,areas,0.))
+        norms=np.asarray(averaging.sum(axis=1)).reshape(-1)
+        defined=norms > 0
+        averaging=scipy.sparse.diags(np.where(defined,1./np.where(defined,norms,1.),0.)).dot(averaging)
+        matrices[key]=(averaging.dot(remapping).tocsr(),defined)
+    return matrices[key]
+
+
+def compute(file_in, basins_file, basins_key, masks_files, weights_dir, var=None) :
+    """
+    Returns a Dataset of the averages of variable VAR (default : the sole
+    variable) of FILE_IN over basins and regions (see module doc for the
+    other arguments)
+    """
+    path=components(file_in, basins_file, basins_key, masks_files, weights_dir)
+    with np.load(path) as npz :
+        names=[ str(name) for name in npz["names"] ]
+    with xr.open_dataset(file_in) as ds :
+        if var is None :
+            var=sole_variable(ds)
+        da=ds[var]
+        has_time="time" in da.dims
+        if has_time :
+            da=da.transpose(*(["time"]+[ d for d in da.dims if d != "time" ]))
+        data=da.values.astype(np.float64).reshape((da.sizes["time"] if has_time else 1,-1))
+        attrs=da.attrs
+        time=ds["time"] if has_time else None
+        time_bnds=ds["time_bnds"].load() if "time_bnds" in ds else None
+    valid=~np.isnan(data)
+    values=np.where(valid,data,0.)
+    result=np.full((data.shape[0],len(names)),np.nan)
+    # Records are grouped by pattern of missing values
+    patterns=dict()
+    for record in range(data.shape[0]) :
+        patterns.setdefault(np.packbits(valid[record]).tobytes(),[]).append(record)
+    for records in patterns.values() :
+        matrix,defined=effective_matrix(path, valid[records[0]])
+        averages=matrix.dot(values[records].T).T
+        averages[:,~defined]=np.nan
+        result[records]=averages
+    out=xr.Dataset()
+    if has_time :
+        out[var]=xr.DataArray(result,coords=[ ("time",time.values), ("basin",names) ],attrs=attrs)
+        out["time"].attrs=time.attrs
+        out["time"].encoding.update(dict((k,v) for k,v in time.encoding.items() if k in [ "units", "calendar" ]))
+        if time_bnds is not None :
+            out["time_bnds"]=time_bnds
+    else :
+        out[var]=xr.DataArray(result[0],coords=[ ("basin",names) ],attrs=attrs)
+    out[var].encoding["_FillValue"]=1.e+20
+    return out
+
+
+def main(argv) :
+    """
+    Command line interface (see module doc)
+    """
+    args=argv[1:]
+    weights_dir=None
+    basins_file=None
+    basins_key=dict()
+    masks_files=[]
+    while args[0].startswith("--") :
+        if args[0] == "--weights_dir" :
+            weights_dir=args[1]
+        elif args[0] == "--basins_file" :
+            basins_file=args[1]
+        elif args[0] == "--basins_key" :
+            basins_key=dict((pair.split(":")[0],int(pair.split(":")[1])) for pair in args[1].split(",") if pair != "")
+        elif args[0] == "--masks" :
+            masks_files=args[1].split()
+        else :
+            raise ValueError("Unknown option %s for basins"%args[0])
+        args=args[2:]
+    if weights_dir is None or basins_file is None or len(args) != 2 :
+        raise ValueError("Usage : basins --weights_dir DIR --basins_file FILE --basins_key KEY "+\
+                         "[--masks \"files\"] file_in file_out")
+    compute(args[0], basins_file, basins_key, masks_files, weights_dir).to_netcdf(args[1])
+
+
+if __name__ == "__main__" :
+    main(sys.argv)
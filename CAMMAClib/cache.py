@@ -0,0 +1,156 @@
+"""
+A file cache with a manifest index, used for storing results (such as the
+aggregate fields computed by `changes.change_figure_with_caching`) :
+
+  - entries are identified by a key derived from all the parameters
+    which affect the result (see `cache_key`),
+  - the manifest is a SQLite database located in the cache directory, which
+    provides direct lookups, and records entries size and last access time,
+  - entries are written under a temporary name and then renamed (see
+    `atomic_write`, which other modules also use for their shared files),
+  - least-recently used entries are evicted when the cache size exceeds
+    a budget (see `size_budget`)
+
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import os, os.path, json, hashlib, sqlite3, time, uuid
+
+#: Size budget for a cache directory, in bytes. Can be set using environment
+#: variable CAMMAC_CACHE_BUDGET (in MB). Default is 20 GB
+size_budget=int(os.environ.get("CAMMAC_CACHE_BUDGET",20000))*1000000
+
+#: Name of the manifest file in a cache directory
+manifest_name="manifest.sqlite"
+
+
+def cache_key(**params) :
+    """
+    Returns a key for the set of parameters PARAMS, which values must be
+    serializable by json (or have a meaningful string representation)
+    """
+    text=json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def manifest(cache_dir) :
+    """
+    Returns a connection to the manifest of CACHE_DIR, creating both if needed
+    """
+    make_dirs(cache_dir)
+    connection=sqlite3.connect(os.path.join(cache_dir,manifest_name), timeout=600)
+    with connection :
+        connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, path TEXT, "+\
+                           "size INTEGER, last_access REAL, params TEXT)")
+    return connection
+
+
+def temporary_path(cache_dir, suffix=".nc") :
+    """
+    Returns a unique path in CACHE_DIR for writing a file before storing
+    it with `store`
+    """
+    return os.path.join(cache_dir,"tmp_%d_%s%s"%(os.getpid(),uuid.uuid4().hex,suffix))
+
+
+def make_dirs(directory) :
+    """
+    Create DIRECTORY and its parents if needed, allowing for another job
+    creating them meanwhile
+    """
+    if not os.path.exists(directory) :
+        try :
+            os.makedirs(directory)
+        except OSError :
+            if not os.path.isdir(directory) :
+                raise
+
+
+def atomic_write(path, write) :
+    """
+    Create file PATH by calling function WRITE with a temporary path in the
+    same directory (which is created if needed), and then renaming that
+    file to PATH. The rename is atomic, so that concurrent jobs sharing a
+    directory never see partial files; a temporary file left by a failing
+    WRITE is removed. The temporary path has the same extension as PATH
+    """
+    directory=os.path.dirname(path)
+    make_dirs(directory)
+    tmp=temporary_path(directory,os.path.splitext(path)[1])
+    try :
+        write(tmp)
+        os.rename(tmp,path)
+    except :
+        if os.path.exists(tmp) :
+            os.remove(tmp)
+        raise
+
+
+def lookup(cache_dir, key) :
+    """
+    Returns the path of the entry for KEY in CACHE_DIR, or None. Updates
+    the entry's access time
+    """
+    connection=manifest(cache_dir)
+    try :
+        with connection :
+            row=connection.execute("SELECT path FROM entries WHERE key=?",(key,)).fetchone()
+            if row is None :
+                return None
+            path=os.path.join(cache_dir,row[0])
+            if not os.path.exists(path) :
+                connection.execute("DELETE FROM entries WHERE key=?",(key,))
+                return None
+            connection.execute("UPDATE entries SET last_access=? WHERE key=?",(time.time(),key))
+            return path
+    finally :
+        connection.close()
+
+
+def store(cache_dir, key, filename, params=None, budget=None) :
+    """
+    Store file FILENAME (which should be located in CACHE_DIR, see
+    `temporary_path`) as the entry for KEY, by renaming it atomically, and
+    record PARAMS (a dict) in the manifest. Evict least recently used
+    entries if the cache size exceeds BUDGET (default : `size_budget`).
+    Returns the entry path
+    """
+    extension=os.path.splitext(filename)[1]
+    name=key+extension
+    path=os.path.join(cache_dir,name)
+    os.rename(filename,path)
+    connection=manifest(cache_dir)
+    try :
+        with connection :
+            connection.execute("INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)",
+                               (key,name,os.path.getsize(path),time.time(),
+                                json.dumps(params, sort_keys=True, default=str)))
+        evict(connection, cache_dir, budget, keep=key)
+    finally :
+        connection.close()
+    return path
+
+
+def evict(connection, cache_dir, budget=None, keep=None) :
+    """
+    Remove least recently used entries of CACHE_DIR (which manifest
+    CONNECTION is open), except KEEP, until its size is under BUDGET (default :
+    `size_budget`)
+    """
+    if budget is None :
+        budget=size_budget
+    with connection :
+        total=connection.execute("SELECT SUM(size) FROM entries").fetchone()[0] or 0
+        if total <= budget :
+            return
+        rows=connection.execute("SELECT key,path,size FROM entries ORDER BY last_access").fetchall()
+        for key,name,size in rows :
+            if total <= budget :
+                break
+            if key == keep :
+                continue
+            path=os.path.join(cache_dir,name)
+            if os.path.exists(path) :
+                os.remove(path)
+            connection.execute("DELETE FROM entries WHERE key=?",(key,))
+            total-=size
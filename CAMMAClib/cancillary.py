@@ -6,6 +6,10 @@ CAMMAC ancilliary functions using CiMAF for computing:
   - basin averages
   - mean or variability of data series
   - ensemble statistics on scalars
+  - ensemble statistics on fields, in one pass
+  - spatial statistics of a field, in one pass
+  - regridding with cached weights
+  - robustness masks, in one pass
 
 """
 
@@ -13,16 +17,186 @@ from __future__  import division, print_function , unicode_literals, absolute_im
 
 import json, os, numpy as np
 from climaf.api import *
+from CAMMAClib.fusion import cfile, ceval, cvalue
 from climaf.operators import ccdo,ccdo_fast,ccdo2
 from env.environment import cscripts
 from CAMMAClib.mips_et_al import institute_for_model, table_for_var
-from CAMMAClib.variability import init_trend
+from CAMMAClib.variability import init_trend, init_series
 
+# Operators implemented in Python are run by a persistent worker (see module `worker`)
+worker="python %s/worker.py"%os.path.dirname(__file__)
+
+# Operator 'gini' processes one dataset per call (a CliMAF script cannot have
+# one output per member of an ensemble); see module `gini` for batches
 if "gini" not in cscripts:
-    cscript("gini","python %s/gini.py ${in} ${out}"%os.path.dirname(__file__),_var="gini")
+    cscript("gini","%s gini ${in} ${out}"%worker,_var="gini")
+
+if "gini_slices" not in cscripts:
+    cscript("gini_slices","%s gini --slices ${begin},${nyears},${number} ${in} ${out}"%worker,_var="gini")
 
 if "knutti" not in cscripts:
-    cscript("knutti",'python %s/knutti_sedlacek.py "${mmin}" "${mmin_2}" ${out}'%os.path.dirname(__file__),_var="KSRI")
+    cscript("knutti",'%s knutti "${mmin}" "${mmin_2}" ${out}'%worker,_var="KSRI")
+
+if "ensemble_stats" not in cscripts:
+    cscript("ensemble_stats",'%s ensemble_stats --percentile ${percentile} "${mmin}" '%worker+\
+            '${out} ${out_median} ${out_pctl} ${out_std} ${out_agree}')
+
+if "ensemble_means_rchange" not in cscripts:
+    cscript("ensemble_means_rchange",'%s ensemble_stats --means_rchange "${mmin}" "${mmin_2}" ${out}'%worker)
+
+if "cached_remap" not in cscripts:
+    cscript("cached_remap",'%s remap --weights_dir ${weights_dir} --coarsen ${coarsening} ${option} ${cdogrid} ${in} ${out}'%worker)
+
+if "cached_remap_batch" not in cscripts:
+    cscript("cached_remap_batch",'%s remap --weights_dir ${weights_dir} --coarsen ${coarsening} --batch ${labels} '%worker+\
+            '${option} ${cdogrid} "${mmin}" '+\
+            '${out} ${out_reference} ${out_projection} ${out_rchange} ${out_schange}')
+
+if "daily_indices" not in cscripts:
+    cscript("daily_indices",'%s daily_indices --var ${var} --period ${period_iso} --threshold ${threshold} '%worker+\
+            '"${ins}" ${out} ${out_sdii} ${out_rx1day} ${out_rx5day} ${out_cdd}')
+
+if "basins_averages" not in cscripts:
+    cscript("basins_averages",'%s basins --weights_dir ${weights_dir} --basins_file ${basins_file} '%worker+\
+            '--basins_key ${basins_key} --masks "${masks}" ${in} ${out}')
+
+#: Toggle for using cached remapping weights in function `remap`
+use_weights_cache=True
+
+#: Directory for cached remapping weights; default (when None) is
+#: sub-directory 'remap_weights' of CliMAF cache
+weights_dir=None
+
+def remap_weights_dir() :
+    """
+    Returns the directory for cached remapping weights (see `weights_dir`)
+    """
+    if weights_dir is not None :
+        return weights_dir
+    return os.path.join(os.environ.get("CLIMAF_CACHE",os.path.expanduser("~/tmp/climaf_cache")),
+                        "remap_weights")
+
+def remap(data,cdogrid,option="remapcon",coarsening=None,accuracy_key=None) :
+    """
+    Regrid CliMAF object DATA to CDOGRID (a CDO grid name, or a filename)
+    using CDO remapping operator OPTION, as CliMAF operator 'regridn' does,
+    but re-using interpolation weights which are cached on disk (in
+    directory `weights_dir`) and shared by all fields with the same source
+    grid (see module `remap`)
+
+    COARSENING, if not None, is a pair (FX,FY) of integer factors for
+    first averaging DATA, which must be on a regular (lat, lon) grid, over
+    blocks of FY x FX cells (see `ancillary.choose_regrid_option`); it is
+    ignored if its relative error exceeds `ancillary.coarsening_tolerance`
+    (see `checked_coarsening` for ACCURACY_KEY)
+
+    If `use_weights_cache` is False, or CDOGRID is None, simply calls regridn
+    (and COARSENING is ignored)
+    """
+    if not use_weights_cache or cdogrid is None :
+        return regridn(data,cdogrid=cdogrid,option=option)
+    coarsening=checked_coarsening(data,cdogrid,option,coarsening,accuracy_key)
+    from climaf.operators import cached_remap
+    return cached_remap(data,cdogrid=cdogrid,option=option,weights_dir=remap_weights_dir(),
+                        coarsening="%d,%d"%tuple(coarsening))
+
+def coarsening_error(data,cdogrid,option="remapcon",coarsening=(2,2),statistics=["max","p99","mean"],
+                     relative=False) :
+    """
+    Assess the accuracy of remapping CliMAF object DATA to CDOGRID with a
+    prior coarsening by COARSENING (see `remap`), compared to the direct
+    remapping : returns the list of STATISTICS (see `field_statistics`) of
+    the absolute value of the difference of both remapped fields. If
+    RELATIVE is True, these statistics are divided by the mean absolute
+    value of the direct remapped field
+    """
+    from climaf.operators import cached_remap
+    direct=remap(data,cdogrid,option)
+    # Not through `remap`, which would check COARSENING accuracy
+    two_stages=cached_remap(data,cdogrid=cdogrid,option=option,weights_dir=remap_weights_dir(),
+                            coarsening="%d,%d"%tuple(coarsening))
+    difference=ccdo(ccdo2(two_stages,direct,operator="sub"),operator="abs")
+    rep=field_statistics(difference,statistics)
+    if relative :
+        scale=field_statistics(ccdo(direct,operator="abs"),["mean"])[0]
+        rep=[ value/scale for value in rep ]
+    return rep
+
+#: Outcomes of the checks of pre-coarsening accuracy by `checked_coarsening`,
+#: keyed by accuracy key, target grid, remapping option and factors
+coarsening_checks=dict()
+
+def checked_coarsening(data,cdogrid,option,coarsening,accuracy_key=None) :
+    """
+    Returns COARSENING (or (1,1) if it is None), unless it does not meet
+    `ancillary.coarsening_tolerance` for remapping CliMAF object DATA to
+    CDOGRID, in which case returns (1,1), i.e. direct remapping. The check
+    (see `coarsening_error`) is done once per ACCURACY_KEY (e.g. a tuple of
+    model and variable), which defaults to the CRS of DATA; its outcome is
+    memoized in `coarsening_checks`
+    """
+    from CAMMAClib import ancillary
+    if coarsening is None or tuple(coarsening) == (1,1) or ancillary.coarsening_tolerance is None :
+        return (1,1) if coarsening is None else tuple(coarsening)
+    if accuracy_key is None :
+        accuracy_key=data.crs
+    key=(accuracy_key,cdogrid,option,tuple(coarsening),ancillary.coarsening_tolerance)
+    if key not in coarsening_checks :
+        error=coarsening_error(data,cdogrid,option,coarsening,statistics=["p99"],relative=True)[0]
+        coarsening_checks[key]=(error <= ancillary.coarsening_tolerance)
+        if not coarsening_checks[key] :
+            print("Pre-coarsening by %s for remapping %s to %s has a relative error %g : using direct remapping"%\
+                  (tuple(coarsening),accuracy_key,cdogrid,error))
+    return tuple(coarsening) if coarsening_checks[key] else (1,1)
+
+#: Labels of the fields which can be remapped by `remap_batch`, in the order
+#: of the outputs of operator 'cached_remap_batch' (see module `remap`)
+batch_labels=[ "change", "reference", "projection", "rchange", "schange" ]
+
+def remap_batch(fields,cdogrid,option="remapcon",coarsening=None,accuracy_key=None) :
+    """
+    Regrid the CliMAF objects which are values of dict FIELDS to CDOGRID,
+    as `remap` does, but with a single remapping call : these single-record
+    fields, which must share the same source grid, are stacked as variables
+    of one file, which is remapped and split back. FIELDS keys must be
+    among `batch_labels`, and include 'change'
+
+    Returns a dict of remapped objects with the same keys as FIELDS. See
+    `remap` for COARSENING and ACCURACY_KEY; the accuracy of COARSENING is
+    checked on field 'change'
+
+    If `use_weights_cache` is False, or CDOGRID is None, or FIELDS has a
+    single entry, simply calls `remap` for each field
+    """
+    if not use_weights_cache or cdogrid is None or len(fields) == 1 :
+        return dict([ (label,remap(field,cdogrid,option,coarsening,accuracy_key)) for label,field in fields.items() ])
+    for label in fields :
+        if label not in batch_labels :
+            raise ValueError("Cannot remap field %s in a batch (allowed labels are %s)"%(label,batch_labels))
+    if "change" not in fields :
+        raise ValueError("A batch of fields to remap must include 'change'")
+    labels=[ label for label in batch_labels if label in fields ]
+    coarsening=checked_coarsening(fields["change"],cdogrid,option,coarsening,accuracy_key)
+    from climaf.operators import cached_remap_batch
+    remapped=cached_remap_batch(cens(fields,order=labels),labels=",".join(labels),
+                                cdogrid=cdogrid,option=option,weights_dir=remap_weights_dir(),
+                                coarsening="%d,%d"%tuple(coarsening))
+    rep=dict(change=remapped)
+    for label in labels[1:] :
+        rep[label]=getattr(remapped,label)
+    return rep
+
+if "robustness_masks" not in cscripts:
+    cscript("robustness_masks",'%s robustness_masks '%worker+\
+            '--low_change_agree_threshold ${low_change_agree_threshold} '+\
+            '--fraction_on_magnitude ${fraction_on_magnitude} --fraction_on_sign ${fraction_on_sign} '+\
+            '--stippling_fraction ${stippling_fraction} "${mmin}" "${mmin_2}" "${mmin_3}" '+\
+            '${out} ${out_medvar} ${out_stippling} ${out_hatching} ${out_agreelow} ${out_lowchange} ${out_conflict}')
+
+if "robustness_masks_AR5" not in cscripts:
+    cscript("robustness_masks_AR5",'%s robustness_masks '%worker+\
+            '--stippling_fraction ${stippling_fraction} "${mmin}" "${mmin_2}" "" '+\
+            '${out} ${out_medvar} ${out_stippling} ${out_hatching}')
 
 def init_yeardiv():
     """
@@ -53,7 +227,7 @@ def init_yeardiv():
              '${out}')
 
 
-def walsh_seasonality(precip_monthly_averages):
+def walsh_seasonality(precip_monthly_averages,native=True):
     """
     Implements Walsh (1981) seasonality index SIi (the version computed on individual years) 
     
@@ -69,13 +243,23 @@ def walsh_seasonality(precip_monthly_averages):
     We do not convert to precipitation height but use fluxes
     
     We apply a 10mm per year threshold
+
+    If NATIVE is True, the whole computation is done in one pass by operator
+    'walsh' (see module `series`), which reads the monthly data once; the
+    result is one index value per year, also when computing it on control
+    run slices
     """
+    threshold=10./(365./12. * 24 * 3600.) # 10mm (per year) converted to S.I. during one (average) month
+    if native :
+        init_series()
+        from climaf.operators import walsh
+        return walsh(precip_monthly_averages,threshold="%s"%threshold)
+    #
     # 1- compute annual rains as the sum of monthly rain average
     #annual_rains=ccdo_fast(precip_monthly_averages,operator="yearsum")
     annual_rains=ccdo_fast(precip_monthly_averages,operator="mulc,12 -yearmonmean")
 
     # 2- mask places where annual rains are very low, 
-    threshold=10./(365./12. * 24 * 3600.) # 10mm (per year) converted to S.I. during one (average) month
     enough=ccdo_fast(annual_rains,operator="gec,%s"%threshold) # 1s and 0s
     
     masked_annual_rains=ccdo2(annual_rains,enough,operator="setctomiss,0 -mul")
@@ -91,6 +275,90 @@ def walsh_seasonality(precip_monthly_averages):
     return ccdo_fast(ratios,operator="yearsum -abs -subc,"+one_over_12)    
 
 
+def daily_index(daily_precip,index="dry",threshold=1./(24.*3600.)) :
+    """
+    Returns the annual series of INDEX for CliMAF object DAILY_PRECIP (daily
+    precipitation flux). INDEX can be 'dry' (number of dry days), 'sdii'
+    (mean precipitation for non-dry days), 'rx1day' and 'rx5day' (maximum 1-day
+    and 5-day precipitation amounts, in mm) and 'cdd' (maximum number of
+    consecutive dry days); dry days are those with precipitation lower than
+    THRESHOLD (default : 1 mm/day)
+
+    All indices are computed in a single pass over the daily data by operator
+    'daily_indices' (see module `daily_indices`), which reads it one year at a
+    time; indices other than 'dry' are secondary outputs of the same CliMAF
+    object, and are computed once for all
+    """
+    if index not in [ "dry", "sdii", "rx1day", "rx5day", "cdd" ] :
+        raise ValueError("Unknown daily precipitation index %s"%index)
+    from climaf.operators import daily_indices
+    rep=daily_indices(daily_precip,threshold="%s"%threshold)
+    if index == "dry" :
+        return rep
+    return getattr(rep,index)
+
+
+#: Toggle for computing basin averages all at once using sparse matrices, if
+#: scipy is available (see `basins_averages`)
+use_sparse_basins=True
+
+def sparse_basins_available() :
+    """
+    Returns True if basins averages can be computed by `basins_averages`,
+    i.e. if `use_sparse_basins` is True and scipy is available
+    """
+    if not use_sparse_basins :
+        return False
+    try :
+        import scipy.sparse
+    except ImportError :
+        return False
+    return True
+
+def basins_masks_files(basins) :
+    """
+    Returns the list of files of region masks for dict BASINS (see
+    `basin_average`) : value of key 'masks_files' if present, otherwise the
+    files '*_global.nc' (such as monsoon domains masks) located in the
+    directory of BASINS["basins_file"]
+    """
+    if "masks_files" in basins :
+        return basins["masks_files"]
+    if not basins.get("basins_file") :
+        return []
+    import glob
+    directory=os.path.dirname(os.path.abspath(basins["basins_file"]))
+    return sorted(glob.glob(os.path.join(directory,"*_global.nc")))
+
+def basins_names(basins) :
+    """
+    Returns the list of names of the basins and regions averaged by
+    `basins_averages` for dict BASINS
+    """
+    from CAMMAClib.basins import mask_name
+    return list(basins["basins_key"].keys()) + [ mask_name(f) for f in basins_masks_files(basins) ]
+
+def basins_averages(data,basins) :
+    """
+    Computes averages of DATA over all basins of BASINS["basins_key"], and
+    over the regions described by the masks of `basins_masks_files`, at
+    once, using a sparse matrix which combines the weights of a conservative
+    remapping to the grid of BASINS["basins_file"], and the basins masks
+    (see module `basins`). Values are the same as those of `basin_average`
+
+    The matrix is cached in directory `weights_dir`, for each model grid.
+    Requires scipy (see `sparse_basins_available`)
+
+    Returns a CliMAF object with one record per record of DATA, and a
+    dimension 'basin' (see `periods_mean_or_std` for using it)
+    """
+    from climaf.operators import basins_averages as basins_averages_operator
+    key=",".join("%s:%d"%(name,number) for name,number in sorted(basins["basins_key"].items()))
+    masks=" ".join(os.path.abspath(f) for f in basins_masks_files(basins))
+    return basins_averages_operator(data,weights_dir=remap_weights_dir(),
+                                    basins_file=os.path.abspath(basins["basins_file"]),
+                                    basins_key=key,masks=masks)
+
 def basin_average(data,model,basin,basins,compute=False,house_keeping=False,test=False) :
     """
     Computes average of DATA over a named BASIN, which should be a key of BASINS["basins_key"], 
@@ -116,7 +384,10 @@ def basin_average(data,model,basin,basins,compute=False,house_keeping=False,test
         
     # First regrid to basin definition grid, with first order conservative remapping
     basin_data=fds(basins["basins_file"],simulation="basins", period="fx", model="basins_model")
-    regridded=regrid(data,basin_data,option="remapcon")
+    if use_weights_cache :
+        regridded=remap(data,os.path.abspath(basins["basins_file"]),option="remapcon")
+    else :
+        regridded=regrid(data,basin_data,option="remapcon")
     
     # Use CDO for masking on relevant basin, and computing mean
     mask=ccdo_fast(basin_data,operator="setvrange,%d,%d"%(bkey[basin],bkey[basin]))
@@ -194,28 +465,13 @@ if test_land_average :
     print(cvalue(land_average(ds(**dic),True,False,False))*24.*3600)
 
 
-def mean_or_std(project, scenario, ref_experiment, model, realization, season, variable, stat, table,  
-                period, data_versions, operator=None, operator_args={}, compute=False,
-                detrend=True, house_keeping=False) :
+def mean_or_std_dataset(project, scenario, ref_experiment, model, realization, variable, table,
+                        period, data_versions) :
     """
-    Compute a STAT ("mean" or "std") of annual or seasonal means 
-    of a VARIABLE  over a PERIOD for a given MODEL and a virtual experiment 
-    which merges REF_EXPERIMENT and SCENARIO (but REF_EXPERIMENT can be None) 
-
-    Detrending is performed before computing standard deviation, except if requested 
-    otherwise using arg 'detrend'
-
-    Additionnaly, a CliMAF OPERATOR can be applied after time averaging (and before 
-    standard deviation computation if applicable). 
-    
-    Dict DATA_VERSIONS provide details (grid, version, realization) for the data to use 
-    
-    PERIOD can extend from some date in REF_EXPERIMENT to some other date of SCENARIO, 
-    but then, the end of REF_EXPERIMENT must match the beginning of SCENARIO
-    
+    Returns the dict of dataset facets used by `mean_or_std` (see there for
+    the arguments), for a virtual experiment which merges REF_EXPERIMENT (which
+    can be None) and SCENARIO
     """
-    #
-    # Define relevant dataset
     if ref_experiment is not None :
         grid,version,_=data_versions[ref_experiment][variable][table][model][realization]
         _,scenario_version,_=data_versions[scenario][variable][table][model][realization]
@@ -235,7 +491,36 @@ def mean_or_std(project, scenario, ref_experiment, model, realization, season, v
              realization=realization)
     if project == "CMIP6" :
         dic.update(institute=institute_for_model(model), grid=grid)
-        #
+    return dic
+
+
+def mean_or_std(project, scenario, ref_experiment, model, realization, season, variable, stat, table,  
+                period, data_versions, operator=None, operator_args={}, compute=False,
+                detrend=True, house_keeping=False, native=True) :
+    """
+    Compute a STAT ("mean" or "std") of annual or seasonal means 
+    of a VARIABLE  over a PERIOD for a given MODEL and a virtual experiment 
+    which merges REF_EXPERIMENT and SCENARIO (but REF_EXPERIMENT can be None) 
+
+    Detrending is performed before computing standard deviation, except if requested 
+    otherwise using arg 'detrend'
+
+    With NATIVE True, detrending and standard deviation are computed in a 
+    single call (see `variability.init_series`)
+
+    Additionnaly, a CliMAF OPERATOR can be applied after time averaging (and before 
+    standard deviation computation if applicable). 
+    
+    Dict DATA_VERSIONS provide details (grid, version, realization) for the data to use 
+    
+    PERIOD can extend from some date in REF_EXPERIMENT to some other date of SCENARIO, 
+    but then, the end of REF_EXPERIMENT must match the beginning of SCENARIO
+    
+    """
+    #
+    # Define relevant dataset
+    dic=mean_or_std_dataset(project, scenario, ref_experiment, model, realization, variable, table,
+                            period, data_versions)
     print("dic=",dic)
     # Compute relevant stat
     if stat=="mean" : 
@@ -253,16 +538,20 @@ def mean_or_std(project, scenario, ref_experiment, model, realization, season, v
         cached=ccdo(ds(**dic),operator=time_operation)
         if operator is not None:
             cached=operator(cached,**operator_args)
-        if detrend :
-            # Must detrend 
-            init_trend()
-            from climaf.operators import ctrend,csubtrend
-            a=ctrend(cached)
-            detrended=csubtrend(cached,a,a.b)
+        detrended=cached
+        if detrend and native :
+            init_series()
+            from climaf.operators import ols_iav
+            rep=ols_iav(cached,factor=1.)
         else :
-            detrended=cached
-        # Compute standard deviation of seasonal values series
-        rep=ccdo_fast(detrended,operator="timstd1")
+            if detrend :
+                # Must detrend 
+                init_trend()
+                from climaf.operators import ctrend,csubtrend
+                a=ctrend(cached)
+                detrended=csubtrend(cached,a,a.b)
+            # Compute standard deviation of seasonal values series
+            rep=ccdo_fast(detrended,operator="timstd1")
     else :
         raise ValueError("stat %s cannot yet be processed by mean_or_std for season %s"+\
                     "and variable %s"%(stat,season,variable))
@@ -270,7 +559,219 @@ def mean_or_std(project, scenario, ref_experiment, model, realization, season, v
     #
     if house_keeping and stat=='std':
             cdrop(cached)
-            cdrop(detrended)
+            if detrended is not cached :
+                cdrop(detrended)
+    return rep
+
+def periods_span(periods) :
+    """
+    Returns a CliMAF period string (such as '1850-2100') for the span of
+    a list of PERIODS (such as ['1995-2014','2081-2100']) and the list of
+    corresponding (first year, last year) pairs
+    """
+    years=[ (int(p.split("-")[0][0:4]),int(p.split("-")[1][0:4])) for p in periods ]
+    return "%d-%d"%(min(y[0] for y in years),max(y[1] for y in years)), years
+
+
+def mean_or_std_series(project, scenario, ref_experiment, model, realization, season, variable, table,
+                       periods, data_versions, operator=None, operator_args={}, house_keeping=False) :
+    """
+    Returns a CliMAF object for the series of annual or seasonal means of
+    VARIABLE, over the span of list PERIODS (see `periods_span`), to which
+    OPERATOR (such as a spatial average) is applied. This series allows to
+    compute the same values as `mean_or_std` (see there for the other
+    arguments) for all PERIODS at once, see `periods_mean_or_std`
+    """
+    span,_=periods_span(periods)
+    dic=mean_or_std_dataset(project, scenario, ref_experiment, model, realization, variable, table,
+                            span, data_versions)
+    time_operation="yearmean"
+    if season != "anm" : time_operation ="selseason,%s -seasmean"%season
+    means=ccdo(ds(**dic),operator=time_operation)
+    rep=means
+    if operator is not None:
+        rep=operator(means,**operator_args)
+    ceval(rep)
+    if house_keeping and rep is not means :
+        cdrop(means)
+    return rep
+
+
+def periods_mean_or_std(series, periods, stat, detrend=True, basins=None) :
+    """
+    Returns a dict of the values of STAT ("mean" or "std") of CliMAF
+    object SERIES (see `mean_or_std_series`), which must have a single
+    value per record (e.g. a spatial average), for each of list PERIODS
+    (such as '1995-2014'). Detrending is performed before computing standard
+    deviation, except if requested otherwise using arg DETREND
+
+    If list BASINS is not None, SERIES must have a dimension 'basin' (see
+    `basins_averages`), and the result is a dict with BASINS as keys, and
+    such dicts as values. A ValueError is raised for a series with more
+    than one value per record, or with a dimension 'basin' if BASINS is None
+
+    The series is read once; values for each period are then computed in
+    constant time from its running sums (see
+    `series.prefix_statistics`). Seasonal records are assigned to the year
+    of their last month
+    """
+    import xarray as xr
+    from CAMMAClib.series import prefix_statistics, window_statistics
+    from CAMMAClib.ensemble_stats import sole_variable
+    if stat not in [ "mean", "std" ] :
+        raise ValueError("stat %s cannot yet be processed by periods_mean_or_std"%stat)
+    with xr.open_dataset(cfile(series)) as dset :
+        years=dset["time"].dt.year.values
+        da=dset[sole_variable(dset)]
+        if basins is None :
+            if "basin" in da.dims :
+                raise ValueError("Series %s has a dimension 'basin' : arg basins must be provided"%series)
+            if da.size != len(years) :
+                raise ValueError("Series %s has %d values per record instead of one"%(series,da.size//len(years)))
+            values=da.values.reshape(-1).astype(np.float64)
+        else :
+            values=da.sel(basin=basins).transpose("time","basin").values.astype(np.float64)
+    prefix=prefix_statistics(values)
+    if stat=="std" :
+        key="detrended_std" if detrend else "std"
+    else :
+        key="mean"
+    _,bounds=periods_span(periods)
+    rep=dict()
+    for period,(first,last) in zip(periods,bounds) :
+        start=np.searchsorted(years,first,side="left")
+        stop =np.searchsorted(years,last ,side="right")
+        value=window_statistics(prefix,start,stop)[key]
+        if basins is None :
+            rep[period]=float(value)
+        else :
+            for basin,basin_value in zip(basins,value) :
+                rep.setdefault(basin,dict())[period]=float(basin_value)
+    return rep
+
+
+def ensemble_statistics(ens,percentile=90) :
+    """
+    Computes in one pass a series of statistics across the members of
+    CliMAF ensemble ENS (of fields on the same grid), which remapped
+    files are read only once (see module `ensemble_stats`)
+
+    Returns a CliMAF object which value is the ensemble mean, and which
+    attributes 'median', 'pctl' (for PERCENTILE), 'std' and 'agree'
+    (fraction of members agreeing on sign) provide the other statistics
+    """
+    from climaf.operators import ensemble_stats
+    return ensemble_stats(ens,percentile=percentile)
+
+def means_relative_change(projections,references) :
+    """
+    Returns the relative change (in %) of the ensemble mean of CliMAF
+    ensemble PROJECTIONS vs the ensemble mean of CliMAF ensemble REFERENCES,
+    computed in one pass
+    """
+    from climaf.operators import ensemble_means_rchange
+    return ensemble_means_rchange(projections,references)
+
+def robustness_masks(changes,variabilities,nchanges=None,low_change_agree_threshold=1.645,
+                     fraction_on_magnitude=0.33,fraction_on_sign=0.8,stippling_fraction=0.9) :
+    """
+    Computes in one pass, from CliMAF ensembles CHANGES and VARIABILITIES
+    (and, optionally, NCHANGES, the changes normalized by their own
+    variability), the fields which are otherwise computed by functions
+    `variability.agreement_fraction_on_sign`,
+    `variability.stippling_hatching_masks_AR5`,
+    `variability.agreement_fraction_on_lower` and
+    `variability.lowchange_conflict_masks_AR6` (see module `robustness_masks`)
+
+    Returns a dict of CliMAF objects, with the same keys as those used by
+    `changes.change_fields` : agreement_fraction_on_sign, median_variability,
+    stippling, hatching and, if NCHANGES is not None, agree_low, lowchange
+    and conflict
+    """
+    if nchanges is None :
+        from climaf.operators import robustness_masks_AR5
+        masks=robustness_masks_AR5(changes,variabilities,stippling_fraction=stippling_fraction)
+    else :
+        from climaf.operators import robustness_masks
+        masks=robustness_masks(changes,variabilities,nchanges,
+                               low_change_agree_threshold=low_change_agree_threshold,
+                               fraction_on_magnitude=fraction_on_magnitude,
+                               fraction_on_sign=fraction_on_sign,
+                               stippling_fraction=stippling_fraction)
+    rep=dict(agreement_fraction_on_sign=masks, median_variability=masks.medvar,
+             stippling=masks.stippling, hatching=masks.hatching)
+    if nchanges is not None :
+        rep.update(agree_low=masks.agreelow, lowchange=masks.lowchange, conflict=masks.conflict)
+    return rep
+
+def cell_weights(ds,da) :
+    """
+    Returns an array of weights for averaging DataArray DA (of Dataset DS)
+    over its grid cells, with the same shape as DA, or None if they cannot
+    be determined : cell areas if DS includes them (as referenced by DA's
+    attribute 'cell_measures', or as variable 'areacella', 'areacello' or
+    'cell_area'), or, for a regular grid (with a 1-D latitude), the area of
+    latitude bands computed from latitude bounds, if any, or cos(latitude)
+    otherwise
+    """
+    import xarray as xr
+    names=[ "areacella", "areacello", "cell_area" ]
+    measures=da.attrs.get("cell_measures","")
+    if "area:" in measures :
+        names.insert(0,measures.split("area:")[1].split()[0])
+    for name in names :
+        if name in ds and name != da.name :
+            return ds[name].broadcast_like(da).values
+    for name in [ "lat", "latitude" ] :
+        if name in da.dims :
+            lat=ds[name]
+            bounds=lat.attrs.get("bounds")
+            if bounds in ds :
+                edges=np.deg2rad(ds[bounds].values)
+                band=np.abs(np.sin(edges[:,1])-np.sin(edges[:,0]))
+                return xr.DataArray(band,dims=(name,)).broadcast_like(da).values
+            return np.cos(np.deg2rad(lat)).broadcast_like(da).values
+    return None
+
+def field_statistics(field,statistics=["mean"]) :
+    """
+    Computes in one pass, and in process, a list of spatial STATISTICS of
+    the (single-record) CliMAF object FIELD, which is read once. Statistics
+    are :
+
+      - "mean" : area-weighted mean, as CDO's fldmean, using cell areas or,
+        for regular grids, latitude weights (see `cell_weights`); if no
+        weights can be determined (e.g. for a curvilinear grid without
+        cell areas), this mean is computed by CDO's fldmean
+      - "min", "max"
+      - "pN" : N-th percentile, with the nearest rank method, as CDO's fldpctl,N
+
+    Missing values are skipped. Returns a list of floats, in the order of STATISTICS
+    """
+    import xarray as xr
+    from CAMMAClib.ensemble_stats import sole_variable, percentile_nrank
+    with xr.open_dataset(cfile(field)) as ds :
+        # A file with cell areas has a variable which refers to them
+        measured=[ v for v in ds.data_vars if "cell_measures" in ds[v].attrs ]
+        da=ds[measured[0] if len(measured) == 1 else sole_variable(ds)].squeeze()
+        values=da.values
+        weights=cell_weights(ds,da)
+    valid=~np.isnan(values)
+    rep=[]
+    for stat in statistics :
+        if stat == "mean" :
+            if weights is None :
+                rep.append(float(cvalue(ccdo_fast(field,operator="fldmean"))))
+            else :
+                rep.append(float((values[valid]*weights[valid]).sum()/weights[valid].sum()))
+        elif stat == "min" :
+            rep.append(float(values[valid].min()))
+        elif stat == "max" :
+            rep.append(float(values[valid].max()))
+        elif stat[0] == "p" :
+            rep.append(float(percentile_nrank(values[valid].reshape(-1,1),float(stat[1:]))[0]))
+        else :
+            raise ValueError("Unknown field statistics %s"%stat)
     return rep
 
 def ensemble_stat(ens,option) :
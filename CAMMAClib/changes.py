@@ -11,23 +11,32 @@ import os.path
 import hashlib
 
 from climaf.api import *
+from CAMMAClib.fusion import cfile, ceval, cvalue
 
 from CAMMAClib.variability import process_dataset, variability_AR5, agreement_fraction_on_sign, \
     agreement_fraction_on_lower, stippling_hatching_masks_AR5, \
     lowchange_conflict_masks_AR6,\
-    inter_annual_variability, control_inter_annual_variability
+    inter_annual_variability, control_inter_annual_variability, init_series
 
 from CAMMAClib.figures import change_figure
 
 from CAMMAClib.ancillary import feed_dic, choose_regrid_option
 
-from CAMMAClib.cancillary  import basin_average, mean_or_std, ensemble_stat, walsh_seasonality
+from CAMMAClib.cache import cache_key, lookup, store, temporary_path
+
+from CAMMAClib.store import seasonal_field
+
+from CAMMAClib.cancillary  import basin_average, mean_or_std, ensemble_stat, walsh_seasonality, daily_index, \
+    ensemble_statistics, means_relative_change, robustness_masks, field_statistics, remap, remap_batch, \
+    mean_or_std_series, periods_mean_or_std, sparse_basins_available, basins_names, basins_averages
 
 from CAMMAClib.mips_et_al import table_for_var, \
      institute_for_model, mip_for_experiment, models_for_experiments, models_for_experiments_multi_var, \
      read_versions_dictionnary
 
-from climaf.operators import gini
+from climaf.operators import gini, gini_slices
+init_series()
+from climaf.operators import ols_iav_slices
 
 one_mm_per_day="%g"%(1./(24.*3600.)) # in S.I.
 
@@ -41,19 +50,28 @@ derivations={
         "plain"        : {},
     
         # Annual count of number of dry days (when applied to daily precip by change_fields)
-        "dry"          : { "operator" : ccdo,              
-                           "operator_args" :{"operator" :"yearsum -ltc,"+one_mm_per_day }},
+        # (all daily precipitation indices are computed in one pass, see cancillary.daily_index)
+        "dry"          : { "operator" : daily_index, "operator_args" : {"index" : "dry" }},
     
         # Annual average daily rain for non-dry days (when applied to daily precip  by change_fields)
-        "drain"        : { "operator" : ccdo,              
-                           "operator_args" : {"operator" :"yearmean -setrtomiss,-1,"+one_mm_per_day}},
+        "drain"        : { "operator" : daily_index, "operator_args" : {"index" : "sdii" }},
+    
+        # Annual maximum 1-day and 5-day precipitation amounts (when applied to daily precip by change_fields)
+        "rx1day"       : { "operator" : daily_index, "operator_args" : {"index" : "rx1day" }},
+        "rx5day"       : { "operator" : daily_index, "operator_args" : {"index" : "rx5day" }},
+    
+        # Annual maximum number of consecutive dry days (when applied to daily precip by change_fields)
+        "cdd"          : { "operator" : daily_index, "operator_args" : {"index" : "cdd" }},
     
         # Inter-annual variability (when applied to monthly data  by change_fields)
+        # (for variability, all slices are processed in a single call)
         "iav"          : { "post_operator" : inter_annual_variability, 
-                           "post_operator_args" :{"house_keeping" : True, "compute": True}},
+                           "post_operator_args" :{"house_keeping" : True, "compute": True},
+                           "slices_operator" : ols_iav_slices, "slices_operator_args" : {"factor" : 1.}},
     
         # Gini index on annual values (when applied to monthly data by change_fields)
-        "gini"         : { "post_operator" : gini},
+        # (for variability, all slices are processed in a single call)
+        "gini"         : { "post_operator" : gini, "slices_operator" : gini_slices},
     
         # Walsh seasonnality index (when applied to monthly precip by change_fields)
         "seasonality"  : { "operator" : walsh_seasonality }, 
@@ -65,7 +83,7 @@ def stats_of_basins_changes(model_changes,project,ref_experiment,scenario,ref_pe
                             data_versions,slices,stats_list,basins_data,
                             fprint=True,excluded_models=[], included_models=None,
                             must_have_vars=[],
-                            relative=True,compute=False, house_keeping=False): 
+                            relative=True,compute=False, house_keeping=False, fast=True): 
     """
     Feed dic MODEL_CHANGES with change values for TIME_STAT of VARIABLE spatially averaged
     over basins listed in BASINS_DATA["basins"] (which can include "globe" and "land"); this with 
@@ -90,6 +108,14 @@ def stats_of_basins_changes(model_changes,project,ref_experiment,scenario,ref_pe
       - basins_key : a dict of correspondance between basin names and basin numbers in basins_file
       
     Change values are relative changes, except if RELATIVE=False
+
+    With FAST True, the series of annual means averaged over each basin is
+    computed once per model, over the span of REF_PERIOD and SLICES, and
+    the values for all periods are derived from it (see
+    `cancillary.periods_mean_or_std`), instead of calling `mean_or_std`
+    for each (model, basin, period); if scipy is available, all basins
+    (except 'globe' and 'land') are averaged at once (see
+    `cancillary.basins_averages`)
     """
     
     lbasins=basins_data["basins"]
@@ -99,17 +125,39 @@ def stats_of_basins_changes(model_changes,project,ref_experiment,scenario,ref_pe
     if fprint : print("%6s %s %s %s"%(scenario,variable,table,time_stat),end='')
     pairs=must_have_vars + [ (variable,table) ]
     models=models_for_experiments_multi_var(data_versions,pairs,[scenario,ref_experiment],excluded_models,included_models)
+    def basin_operator(basin,model) :
+        if basin == "globe" :
+            return ccdo_fast,{"operator":"fldmean"}
+        else:
+            return basin_average,{"model": model, "basin":basin,"basins":basins_data,"compute":True}
+    #
     for model,variant in models :
         if fprint : print(" %s"%(model),end='')
+        if fast :
+            periods=[ ref_period ] + slices
+            others=lbasins
+            if sparse_basins_available() :
+                # All basins and regions are averaged at once
+                sparse=[ basin for basin in lbasins if basin in basins_names(basins_data) ]
+                others=[ basin for basin in lbasins if basin not in sparse ]
+                if len(sparse) > 0 :
+                    series=mean_or_std_series(project, scenario, ref_experiment, model, variant, "anm", variable, table,
+                                              periods, data_versions, basins_averages, {"basins":basins_data},
+                                              house_keeping=house_keeping)
+                    for basin,basin_values in periods_mean_or_std(series, periods, time_stat, basins=sparse).items() :
+                        for period,value in basin_values.items() :
+                            feed_dic(values,value,model,basin,period)
+            for basin in others :
+                operator,args=basin_operator(basin,model)
+                series=mean_or_std_series(project, scenario, ref_experiment, model, variant, "anm", variable, table,
+                                          periods, data_versions, operator, args, house_keeping=house_keeping)
+                for period,value in periods_mean_or_std(series, periods, time_stat).items() :
+                    feed_dic(values,value,model,basin,period)
+            continue
         for period in [ ref_period ] + slices :
             #if fprint : print "%s"%period[0:3],
             for basin in lbasins :
-                if basin == "globe" :
-                    operator=ccdo_fast
-                    args={"operator":"fldmean"}
-                else:
-                    operator=basin_average
-                    args={"model": model, "basin":basin,"basins":basins_data,"compute":True}
+                operator,args=basin_operator(basin,model)
                 value=cvalue(mean_or_std(project, scenario, ref_experiment, model, variant, "anm", variable, time_stat, table,
                                          period, data_versions, operator, args,
                                          compute=compute,house_keeping=house_keeping))
@@ -200,6 +248,19 @@ def global_change(project,variable,table,experiment,period,ref_experiment,ref_pe
     return GSAT
 
 
+def dict_leaves(dic,keys=()) :
+    """
+    Generator which yields, for each leaf value of dict of dicts DIC, the
+    pair (tuple of keys, value)
+    """
+    for key,value in dic.items() :
+        if isinstance(value,dict) :
+            for leaf in dict_leaves(value,keys+(key,)) :
+                yield leaf
+        else :
+            yield keys+(key,), value
+
+
 def change_fields(project,variable,experiments,seasons,ref_period,projection_period,
                   models_to_plot, data_versions, derivation_label=None,
                   relative=False, standardized=False, print_statistics=False,
@@ -208,7 +269,8 @@ def change_fields(project,variable,experiments,seasons,ref_period,projection_per
                                          "shift":100,"nyears":20,"number":20},
                   common_grid=None,table=None,
                   deep=None, threshold=None,
-                  low_change_agree_threshold=1.645, sign_agree_threshold=0.9) :
+                  low_change_agree_threshold=1.645, sign_agree_threshold=0.9,
+                  ensemble_engine=True, cache_dir=None) :
     
     """Computes a series of change fields for one
     VARIABLE and a list of EXPERIMENTS, for period PROJECTION_PERIOD
@@ -222,6 +284,19 @@ def change_fields(project,variable,experiments,seasons,ref_period,projection_per
     the period(s); such transforations are found in dict `changes.derivations` and must be 
     designated by a label (DERIVATION_LABEL)
 
+    PROJECTION_PERIOD may be a list of periods, which are all processed; the
+    returned dicts then have an additional first level of keys : the
+    periods. If the store of yearly seasonal means (see module `store`)
+    includes the historical and scenario data, the reference and projection
+    time means for plain averaging are computed by slicing the stored yearly
+    means, rather than by reading monthly data (for each period)
+
+    DERIVATION_LABEL may also be a list of labels, which are all processed, and
+    which results are gathered in the returned dicts. For plain averaging, the
+    means for all seasons in DJF, MAM, JJA, SON and ANN are computed in a single
+    read of each dataset (see `variability.process_dataset`), and so are all
+    daily precipitation indices (see `cancillary.daily_index`)
+
     See examples in the scripts of the various figures of AR6/WGI chapter 8 
  
     Also computes variability fields and other related fields (see below) using piControl 
@@ -255,6 +330,22 @@ def change_fields(project,variable,experiments,seasons,ref_period,projection_per
     The fraction of sign agreement across models is returned under key
     `agreement_fraction_on_sign` (see below)
 
+    With ENSEMBLE_ENGINE set to True, the ensemble statistics (means,
+    medians, sign agreement) of each kind of per-model field are computed
+    in one pass, which reads the remapped per-model fields only once (see
+    `cancillary.ensemble_statistics`), and so are the agreement fractions
+    and the masks of all robustness schemes (see
+    `cancillary.robustness_masks`); otherwise, each statistics is computed
+    by a separate CDO call
+
+    If CACHE_DIR is not None, the per-model fields (reference, projection
+    and changes, on the native and on the common grid, and variability)
+    are stored in that cache (see module `cache`), with keys which do not
+    depend on the ensemble membership, and are re-used by later calls (except
+    if DEEP is True); so, when changing the list of models, only the
+    fields for new models are computed. Dict 'dic' provides the same fields
+    for models which fields are read in cache as for the others
+
     The variable is sought inproject's table Amon or Lmon (depending on the 
     variable), except specified otherwise using arg TABLE (e.g. value 'day' is 
     for processing variable 'pr', provided the derivation make sense for daily data)
@@ -300,6 +391,38 @@ def change_fields(project,variable,experiments,seasons,ref_period,projection_per
         * nchange means : change standardized by multi-decadal variability
 
     """
+    if isinstance(derivation_label,(list,tuple)) :
+        aggregates=dict()
+        dic=dict()
+        for label in derivation_label :
+            label_aggregates,label_dic=change_fields(project,variable,experiments,seasons,ref_period,
+                  projection_period,models_to_plot,data_versions,derivation_label=label,
+                  relative=relative,standardized=standardized,print_statistics=print_statistics,
+                  ref_experiment=ref_experiment,variab_sampling_args=variab_sampling_args,
+                  common_grid=common_grid,table=table,deep=deep,threshold=threshold,
+                  low_change_agree_threshold=low_change_agree_threshold,
+                  sign_agree_threshold=sign_agree_threshold,
+                  ensemble_engine=ensemble_engine,cache_dir=cache_dir)
+            for keys,value in dict_leaves(label_aggregates) :
+                feed_dic(aggregates,value,*keys)
+            for keys,value in dict_leaves(label_dic) :
+                feed_dic(dic,value,*keys)
+        return aggregates, dic
+    #
+    if isinstance(projection_period,(list,tuple)) :
+        aggregates=dict()
+        dic=dict()
+        for period in projection_period :
+            aggregates[period],dic[period]=change_fields(project,variable,experiments,seasons,ref_period,
+                  period,models_to_plot,data_versions,derivation_label=derivation_label,
+                  relative=relative,standardized=standardized,print_statistics=print_statistics,
+                  ref_experiment=ref_experiment,variab_sampling_args=variab_sampling_args,
+                  common_grid=common_grid,table=table,deep=deep,threshold=threshold,
+                  low_change_agree_threshold=low_change_agree_threshold,
+                  sign_agree_threshold=sign_agree_threshold,
+                  ensemble_engine=ensemble_engine,cache_dir=cache_dir)
+        return aggregates, dic
+    #
     aggregates=dict()
     dic=dict()
     if standardized and (variab_sampling_args == {} or variab_sampling_args is None) :
@@ -315,6 +438,10 @@ def change_fields(project,variable,experiments,seasons,ref_period,projection_per
     def feed(value,key):
         feed_dic(aggregates,value,variable,experiment,season,key,derivation_label)
     
+    # Reference fields do not depend on the experiment; they are computed
+    # once per (model, realization, season) and shared across experiments
+    references=dict()
+    #
     for experiment in experiments :
         #
         if table is None :
@@ -328,11 +455,27 @@ def change_fields(project,variable,experiments,seasons,ref_period,projection_per
             #
             #
             for model,realization in models :
+                fields=model_fields_params(project,model,realization,variable,table,season,
+                            derivation_label,ref_experiment,ref_period,experiment,projection_period,
+                            common_grid,threshold,variab_sampling_args,data_versions,
+                            relative,standardized)
+                cached={}
+                if cache_dir is not None and deep is not True :
+                    cached=dict([ (f,read_cached_field(cache_dir,fields[f])) for f in fields ])
+                if len(cached) > 0 and None not in cached.values() :
+                    print("%s(cached)"%model,end='')
+                    for f in cached :
+                        feed_dic(dic,cached[f],experiment,season,f,derivation_label,model)
+                    continue
                 change_fields_internal(dic,project,model,realization,variable,ref_period,
                             projection_period,ref_experiment,experiment,season,
                             derivation_label, relative,standardized,print_statistics,
                             common_grid,table,data_versions,deep,variab_sampling_args,
-                            threshold)
+                            threshold,references)
+                if cache_dir is not None :
+                    for f in fields :
+                        write_cached_field(dic[experiment][season][f][derivation_label][model],
+                                           cache_dir,fields[f])
             #
             if do_variability :
                 if print_statistics : print("Variabilities :",end='')
@@ -340,10 +483,10 @@ def change_fields(project,variable,experiments,seasons,ref_period,projection_per
                     variability=variability_field(project,model,realization,
                             variable, season, derivation_label, standardized,
                             variab_sampling_args, common_grid,table,
-                            data_versions,deep)
+                            data_versions,deep,cache_dir=cache_dir)
                     feed_dic(dic,variability,experiment,season,"variability",derivation_label,model)
                     if print_statistics :
-                        print("%s % 7.2g / "%(model,cvalue(ccdo_fast(variability,operator="fldmean"))),end='')
+                        print("%s % 7.2g / "%(model,field_statistics(variability)[0]),end='')
                     #
                     # Compute ratio of change to internal variability for models which allow for
                     # (done on common grid)
@@ -357,28 +500,39 @@ def change_fields(project,variable,experiments,seasons,ref_period,projection_per
             # Compute ensemble statistics
             if print_statistics :
                 print("%s medians :"%experiment,end='')
-            ensavg=ccdo_ens(cens(dic[experiment][season]["change"][derivation_label]),operator='ensmean')
+            def stats(key) :
+                # Returns ensemble mean and median for a key of dic, plus
+                # the statistics object (for the engine case)
+                ens=cens(dic[experiment][season][key][derivation_label])
+                if ensemble_engine :
+                    all_stats=ensemble_statistics(ens)
+                    return all_stats,all_stats.median,all_stats
+                return ccdo_ens(ens,operator='ensmean'),ccdo_ens(ens,operator='enspctl,50'),None
+            #
+            ensavg,ensmdn,change_stats=stats("change")
             feed(ensavg,"mean_change")
-            ensmdn=ccdo_ens(cens(dic[experiment][season]["change"][derivation_label]),operator='enspctl,50')
             feed(ensmdn,"median_change")
             if print_statistics :
-                print("change %7.2g"%cvalue(ccdo_fast(ensmdn,operator="fldpctl,50")),end='')
+                print("change %7.2g"%field_statistics(ensmdn,["p50"])[0],end='')
             if relative :
-                rmean=ccdo_ens(cens(dic[experiment][season]["rchange"][derivation_label]),operator='ensmean')
+                rmean,rmedian,_=stats("rchange")
                 feed(rmean,"mean_rchange")
-                rmedian=ccdo_ens(cens(dic[experiment][season]["rchange"][derivation_label]),operator='enspctl,50')
                 feed(rmedian,"median_rchange")
                 # Also compute the relative change of ensemble means
-                ref_ensavg=ccdo_ens(cens(dic[experiment][season]["reference_remapped"][derivation_label]),operator='ensmean')
-                proj_ensavg=ccdo_ens(cens(dic[experiment][season]["projection_remapped"][derivation_label]),operator='ensmean')
-                rmeans=ccdo2(ccdo2(proj_ensavg,ref_ensavg,operator="sub"),ref_ensavg,operator="mulc,100 -div")
+                ref_members =cens(dic[experiment][season]["reference_remapped"][derivation_label])
+                proj_members=cens(dic[experiment][season]["projection_remapped"][derivation_label])
+                if ensemble_engine :
+                    rmeans=means_relative_change(proj_members,ref_members)
+                else :
+                    ref_ensavg=ccdo_ens(ref_members,operator='ensmean')
+                    proj_ensavg=ccdo_ens(proj_members,operator='ensmean')
+                    rmeans=ccdo2(ccdo2(proj_ensavg,ref_ensavg,operator="sub"),ref_ensavg,operator="mulc,100 -div")
                 feed(rmeans,"means_rchange")
             if print_statistics :
-                print("relative %7.2g %%"%cvalue(ccdo_fast(rmedian,operator="fldpctl,50")),end='')
+                print("relative %7.2g %%"%field_statistics(rmedian,["p50"])[0],end='')
             if standardized :
-                smean=ccdo_ens(cens(dic[experiment][season]["schange"][derivation_label]),operator='ensmean')
+                smean,smedian,schange_stats=stats("schange")
                 feed(smean,"mean_schange")
-                smedian=ccdo_ens(cens(dic[experiment][season]["schange"][derivation_label]),operator='enspctl,50')
                 feed(smedian,"median_schange")
             if print_statistics :
                 csync()
@@ -387,51 +541,92 @@ def change_fields(project,variable,experiments,seasons,ref_period,projection_per
             if standardized :
                 agree_field="schange"
                 avg=smean
+                agree_stats=schange_stats
             else :
                 agree_field="change"
                 avg=ensavg
-            agreef=agreement_fraction_on_sign(cens(dic[experiment][season][agree_field][derivation_label]))
-            feed(agreef,"agreement_fraction_on_sign")
-            #
-            # Compute stippling and hatching fields (a la AR5) for the figure 
-            #
+                agree_stats=change_stats
+            nchanges=None
             if do_variability :
-                medvar=ccdo_ens(cens(dic[experiment][season]["variability"][derivation_label]),
-                                operator='enspctl,50')
-                feed(medvar,"median_variability")
-                #
-                s,h=stippling_hatching_masks_AR5(avg,medvar,agreef)
-                feed(s,"stippling")
-                feed(h,"hatching")
-                #
-                # Agreement on low change wrt OWN internal variability
                 if "nchange" in dic[experiment][season] :
-                    agree_low=agreement_fraction_on_lower(
-                        cens(dic[experiment][season]["nchange"][derivation_label]),
-                        low_change_agree_threshold)
-                    feed(agree_low,"agree_low")
-                    (l , c) = lowchange_conflict_masks_AR6(\
-                                 agreef,agree_low,
-                                 fraction_on_sign=sign_agree_thresold)
-                    feed(l,"lowchange")
-                    feed(c,"conflict")
+                    nchanges=cens(dic[experiment][season]["nchange"][derivation_label])
                 else:
                     print("No common model for ",variable,seasons,experiments)
                     print("models: ",models)
                     print("control_models:",control_models)
             #
+            if ensemble_engine and do_variability :
+                # Compute agreement fraction, median variability and the masks of
+                # AR5 and AR6 schemes in one pass
+                masks=robustness_masks(cens(dic[experiment][season][agree_field][derivation_label]),
+                                       cens(dic[experiment][season]["variability"][derivation_label]),
+                                       nchanges, low_change_agree_threshold,
+                                       fraction_on_sign=sign_agree_threshold)
+                for key in masks :
+                    feed(masks[key],key)
+            else :
+                if ensemble_engine :
+                    agreef=agree_stats.agree
+                else :
+                    agreef=agreement_fraction_on_sign(cens(dic[experiment][season][agree_field][derivation_label]))
+                feed(agreef,"agreement_fraction_on_sign")
+                #
+                # Compute stippling and hatching fields (a la AR5) for the figure 
+                #
+                if do_variability :
+                    _,medvar,_=stats("variability")
+                    feed(medvar,"median_variability")
+                    #
+                    s,h=stippling_hatching_masks_AR5(avg,medvar,agreef)
+                    feed(s,"stippling")
+                    feed(h,"hatching")
+                    #
+                    # Agreement on low change wrt OWN internal variability
+                    if nchanges is not None :
+                        agree_low=agreement_fraction_on_lower(nchanges,low_change_agree_threshold)
+                        feed(agree_low,"agree_low")
+                        (l , c) = lowchange_conflict_masks_AR6(\
+                                     agreef,agree_low,
+                                     fraction_on_sign=sign_agree_threshold)
+                        feed(l,"lowchange")
+                        feed(c,"conflict")
+            #
             print()
     return aggregates, dic
 
 
 
+def period_mean(dataset_dict,grid,season,derivation) :
+    """
+    Returns the time mean for SEASON of the dataset described by
+    DATASET_DICT (which grid is GRID), processed according to DERIVATION
+    (see `variability.process_dataset`). For plain averaging, if the store of
+    yearly seasonal means (see module `store`) includes the dataset and
+    SEASON, the time mean is computed on the stored yearly means for the
+    dataset's period, rather than on monthly data. The store does not
+    include DJF, which means computed from monthly data include partial
+    seasons at both ends of the period
+    """
+    if derivation.get("operator") is None and derivation.get("post_operator") is None :
+        d=dataset_dict
+        stored=seasonal_field(d["project"],d["experiment"],d["model"],d["realization"],d["variable"],
+                              d["table"],d["version"],grid,season,d["period"])
+        if stored is not None :
+            return ccdo_fast(stored,operator="timmean")
+    return process_dataset(ds(**dataset_dict),season,**derivation)
+
+
 def change_fields_internal(dic,project,model,realization,variable,ref_period,
                            projection_period,ref_experiment,experiment,season,
                            derivation_label,relative,standardized,print_statistics,
                            common_grid,table,data_versions,deep,variab_sampling_args,
-                           threshold ):
+                           threshold, references=None ):
     """
     See function change_fields for documentation 
+
+    REFERENCES, if not None, is a dict used for sharing the reference
+    fields across calls which differ only by the experiment; it is keyed
+    by (model, realization, season, derivation_label)
     """
 
     def feed(name,field):
@@ -443,48 +638,49 @@ def change_fields_internal(dic,project,model,realization,variable,ref_period,
         print(model,end='')
     #
     grid,version,_=data_versions[ref_experiment][variable][table][model][realization]
-    roption=choose_regrid_option(variable,table,model,grid)
+    roption=choose_regrid_option(variable,table,model,grid,target_grid=common_grid)
     derivation=derivations[derivation_label]
     #
     base_dict=dict(project=project, experiment=ref_experiment,
                         model=model, period=ref_period, variable=variable,
                         table=table, version=version, realization=realization)
     if project == "CMIP6" :
-        dic.update(institute=institute_for_model(model), grid=grid)
+        base_dict.update(institute=institute_for_model(model), grid=grid)
     #
-    # Compute reference time mean over requested season
+    # Compute reference time mean over requested season (or re-use it)
     reference_dict=base_dict.copy()
-    reference_ds=ds(**reference_dict)
-    reference=process_dataset(reference_ds,season,**derivation)
+    key=(model,realization,season,derivation_label)
+    if references is not None and key in references :
+        reference,reference_remapped,thresholded_reference=references[key]
+    else :
+        reference=period_mean(reference_dict,grid,season,derivation)
+        reference_remapped=None
+        thresholded_reference=None
+        if relative  :
+            if threshold is not None :
+                thresholded_reference=ccdo_fast(reference,operator="setrtomiss,-1.e+10,%f"%threshold)
+            else :
+                thresholded_reference=reference
     feed("reference",reference)
-    reference_remapped=regridn(reference,cdogrid=common_grid,**roption)
-    feed("reference_remapped",reference_remapped)
-    if relative  :
-        if threshold is not None :
-            thresholded_reference=ccdo_fast(reference,operator="setrtomiss,-1.e+10,%f"%threshold)
-        else :
-            thresholded_reference=reference
     #
     # Compute projection time mean over requested season
     projection_dict=reference_dict.copy()
-    _,version,_=data_versions[experiment][variable][table][model][realization]
+    projection_grid,version,_=data_versions[experiment][variable][table][model][realization]
     projection_dict.update(experiment=experiment,period=projection_period,
                         realization=realization,version=version)
-    projection_ds=ds(**projection_dict)
-    projection=process_dataset(projection_ds,season,**derivation)
+    projection=period_mean(projection_dict,projection_grid,season,derivation)
     feed("projection",projection)
-    feed("projection_remapped",regridn(projection,cdogrid=common_grid,**roption))
     #
-    # Compute absolute and relative changes, and regrid to common grid
+    # Compute absolute and relative changes
     change=ccdo2(projection,reference,operator="sub")
     feed("change_orig",change)
-    change_remapped=regridn(change,cdogrid=common_grid,**roption)
-    feed("change",change_remapped)
+    natives=dict(projection=projection,change=change)
+    if reference_remapped is None :
+        natives["reference"]=reference
     if relative :
         rchange=ccdo2(change,thresholded_reference,operator="mulc,100 -div")
         feed("rchange_orig",rchange)
-        rchange_remapped=regridn(rchange,cdogrid=common_grid,**roption)
-        feed("rchange",rchange_remapped)
+        natives["rchange"]=rchange
     if standardized:
         inter_ann_var=variability_field(None,model,realization,
                             variable, season,derivation_label, standardized,
@@ -493,34 +689,47 @@ def change_fields_internal(dic,project,model,realization,variable,ref_period,
                             deep=None,only_inter_annual=True)
         schange=ccdo2(change,inter_ann_var,operator="div")
         feed("schange_orig",schange)
-        schange_remapped=regridn(schange,cdogrid=common_grid,**roption)
-        feed("schange",schange_remapped)
+        natives["schange"]=schange
+    #
+    # Regrid all fields to common grid in one call (they share the source grid)
+    remapped=remap_batch(natives,cdogrid=common_grid,accuracy_key=(model,variable,table),**roption)
+    if reference_remapped is None :
+        reference_remapped=remapped["reference"]
+        if references is not None :
+            references[key]=(reference,reference_remapped,thresholded_reference)
+    feed("reference_remapped",reference_remapped)
+    feed("projection_remapped",remapped["projection"])
+    feed("change",remapped["change"])
+    if relative :
+        feed("rchange",remapped["rchange"])
+    if standardized:
+        feed("schange",remapped["schange"])
     #
     if print_statistics :
         variab_value=0.
         print("      %7.2g     %7.2g      %7.2g      %7.2g"%(
             variab_value,\
-            cvalue(ccdo_fast(reference,operator="fldmean")),\
-            cvalue(ccdo_fast(projection,operator="fldmean")),\
-            cvalue(ccdo_fast(change,operator="fldmean"))),end='')
+            field_statistics(reference)[0],\
+            field_statistics(projection)[0],\
+            field_statistics(change)[0]),end='')
         if relative :
-            print("      %7.2g %7.2g  %7.2g"%(
-                cvalue(ccdo_fast(rchange,operator="fldpctl,50")),
-                cvalue(ccdo_fast(rchange,operator="fldmax")),
-                cvalue(ccdo_fast(rchange,operator="fldpctl,90"))),end='')
+            print("      %7.2g %7.2g  %7.2g"%tuple(field_statistics(rchange,["p50","max","p90"])),end='')
         if standardized :
-            print("      %7.2g %7.2g  %7.2g"%(
-                cvalue(ccdo_fast(schange,operator="fldmean")),
-                cvalue(ccdo_fast(schange,operator="fldmax")),
-                cvalue(ccdo_fast(schange,operator="fldpctl,90"))),end='')
+            print("      %7.2g %7.2g  %7.2g"%tuple(field_statistics(schange,["mean","max","p90"])),end='')
         print()
     return
 
+#: Variability fields computed by `variability_field` in this process, which
+#: do not depend on the experiment and are re-used by all calls of `change_fields`
+#: and `change_figure_with_caching`. Keys are built by `variability_field` with
+#: all relevant arguments. Can be cleared using variabilities.clear()
+variabilities=dict()
+
 def variability_field(project,model,realization,variable,season,
                            derivation_label,standardized,
                            variab_sampling_args,common_grid,table,
                            data_versions,deep,
-                           only_inter_annual=False):
+                           only_inter_annual=False,cache_dir=None):
     """
     Computes variability (either multi-decadal 'a la AR5' or inter_annual) for the
     requested dataset, and regrid it to common grid (provided it is not None)
@@ -529,10 +738,27 @@ def variability_field(project,model,realization,variable,season,
 
     Otherwise, returns the multi-decadal, which, if standardized is True, is normalized 
     (i.e. divided) by the inter_annual variability
+
+    Results are memoized in dict `variabilities` (except if DEEP is True), and,
+    if CACHE_DIR is not None, stored in that cache (see module `cache`)
     """
     #
     if realization not in data_versions["piControl"][variable][table][model] :
-        realization=data_versions["piControl"][variable][table][model].keys()[0]
+        realization=list(data_versions["piControl"][variable][table][model].keys())[0]
+    control_version=data_versions["piControl"][variable][table][model][realization]
+    regrid=regrid_params(variable,table,model,control_version[0],common_grid)
+    key=(project,model,realization,variable,table,season,derivation_label,standardized,
+         tuple(sorted(variab_sampling_args.items())),common_grid,only_inter_annual,
+         tuple(control_version),tuple(sorted(regrid["regrid"].items())),
+         tuple(sorted((k,v) for k,v in regrid.items() if k != "regrid")))
+    if deep is not True and key in variabilities :
+        return variabilities[key]
+    params=dict(kind="variability",key=key)
+    if cache_dir is not None and deep is not True :
+        variability=read_cached_field(cache_dir,params)
+        if variability is not None :
+            variabilities[key]=variability
+            return variability
     derivation=derivations[derivation_label]
     #
     args=variab_sampling_args.copy()
@@ -559,8 +785,11 @@ def variability_field(project,model,realization,variable,season,
         #
     if common_grid is not None :
         grid,_,_=data_versions["piControl"][variable][table][model][realization]
-        roption=choose_regrid_option(variable,table,model,grid)
-        variability=regridn(variability,cdogrid=common_grid,**roption)
+        roption=choose_regrid_option(variable,table,model,grid,target_grid=common_grid)
+        variability=remap(variability,cdogrid=common_grid,accuracy_key=(model,variable,table,"variability"),**roption)
+    if cache_dir is not None :
+        write_cached_field(variability,cache_dir,params)
+    variabilities[key]=variability
     return variability 
 
 def change_figure_with_caching(variable, experiment, season, 
@@ -597,7 +826,12 @@ def change_figure_with_caching(variable, experiment, season,
     for the results of first step, using toggles WRITE (which drives
     writing cache values) and READ (which allows to avoid re-doing
     first step). Compute step will be launched anyway if cache does
-    not contain the needed data.
+    not contain the needed data. The cache is located in CACHE_DIR, and
+    managed by module `cache` : cached fields are keyed by all the arguments
+    which affect their values, and least recently used fields are evicted
+    when the cache size exceeds `cache.size_budget`. The same cache also
+    stores per-model fields (see `change_fields`), so that changing the
+    list of models only triggers the computation of fields for new models
 
     MODELS can limit the models to be use by providing their list; if
     not, all models which provide data for the experiment, the
@@ -628,6 +862,10 @@ def change_figure_with_caching(variable, experiment, season,
 
     Argument CHANGE_SIGN_AGREE_THRESHOLD is used with schemes AR6 and  AR6S 
 
+    The fields for all schemes are computed (and cached) together, so that
+    switching SCHEME can use cached values, except when a scheme needing
+    variability (AR5 or AR6) follows scheme AR6S, which doesn't compute it
+
     Argument DEEP, if set to True, will force CliMAF to restart all
     computations from scratch rather than using its (own) cached
     values. This is done whatever the value of READ.
@@ -660,10 +898,12 @@ def change_figure_with_caching(variable, experiment, season,
         # This can happen when using papermill upstream 
         threshold=eval(threshold)
     #
+    sampling_args=variab_sampling_args
+    do_variability= (variab_sampling_args != {} and variab_sampling_args is not None)
+    variab_models=[]
     if scheme == "AR6S" :
         do_variability=False
         variab_sampling_args=None
-        variab_models=[]
     #
     data_versions=read_versions_dictionnary(data_versions_tag, data_versions_dir)
     #
@@ -696,12 +936,34 @@ def change_figure_with_caching(variable, experiment, season,
     models_reals_string=models_reals_string.encode('ascii')
     tag=data_versions_tag + "_" + hashlib.sha1(models_reals_string).hexdigest()[0:8]
     #
+    # All parameters which affect the aggregate fields, for keying cached
+    # fields (but not the scheme, as fields for all schemes are computed together)
+    cache_params=dict(project=project, variable=variable, experiment=experiment,
+                      derivation=derivation_label, table=table,
+                      ref_experiment=ref_experiment, ref_period=ref_period, proj_period=proj_period,
+                      data_versions_tag=data_versions_tag, models=changes_models,
+                      variability_models=variability_models,
+                      variability_excluded_models=variability_excluded_models,
+                      same_models_for_variability_and_changes=same_models_for_variability_and_changes,
+                      variab_sampling_args=sampling_args, common_grid=common_grid,
+                      threshold=threshold, standardized=standardized,
+                      low_change_agree_threshold=low_change_agree_threshold,
+                      change_sign_agree_threshold=change_sign_agree_threshold,
+                      **regrid_settings())
+    #
     aggregates={}
     read_failed=False
     if read and deep is not True :
-        aggregates=read_aggregates(ref_period,proj_period,tag,cache_dir)
+        # Fields needed by the chosen scheme (all schemes masks are computed together)
+        needed=[ field_type ]
+        if scheme == "AR6S" :
+            needed.append("agreement_fraction_on_sign")
+        elif do_variability :
+            needed.extend({ "AR5" : ["stippling","hatching"], "AR6" : ["conflict","lowchange"] }.get(scheme,[]))
+        aggregates=read_aggregates(cache_params,seasons,needed,cache_dir)
         try :
-            a=aggregates[variable][experiment][season][field_type][derivation_label]
+            for key in needed :
+                a=aggregates[variable][experiment][season][key][derivation_label]
         except :
             print("Needed fields not found in cache; will launch comptation")
             read_failed=True
@@ -714,9 +976,9 @@ def change_figure_with_caching(variable, experiment, season,
                                      relative,standardized,print_statistics,
                                      ref_experiment, variab_sampling_args,
                                      common_grid,table,deep,threshold,low_change_agree_threshold,
-                                     change_sign_agree_threshold)
+                                     change_sign_agree_threshold,cache_dir=cache_dir)
         if write and (not read or read_failed or deep) :
-            dump_aggregates(aggregates,variable,derivation_label,ref_period,proj_period,cache_dir,tag,deep)
+            dump_aggregates(aggregates,cache_params,cache_dir,deep)
     #
     relative = ( "_rchange" in field_type )
     if title is None :
@@ -770,37 +1032,174 @@ def change_figure_with_caching(variable, experiment, season,
     print("Figure available as ",filename)
     return filename,plot1,dic,variab_models,changes_models
 
-def dump_aggregates(aggregates,variable,derive,ref_period,proj_period,cache_dir,tag,deep=None) :
+def read_cached_field(cache_dir,params) :
+    """
+    Returns a CliMAF dataset for the field stored in cache CACHE_DIR with
+    parameters PARAMS (a dict), or None
+    """
+    f=lookup(cache_dir,cache_key(**params))
+    if f is None :
+        return None
+    dataset=fds(f,period="1850-2100")
+    # Need to erase cached value
+    cdrop(dataset)
+    return dataset
+
+
+def write_cached_field(field,cache_dir,params) :
+    """
+    Store CliMAF object FIELD in cache CACHE_DIR, with parameters PARAMS (a dict)
+    """
+    tmp=temporary_path(cache_dir)
+    cfile(field,tmp,deep=None,ln=False)
+    store(cache_dir,cache_key(**params),tmp,params)
+
+
+def regrid_settings() :
+    """
+    Returns a dict of the global settings which affect the remapping of
+    fields to the common grid, for keying cached fields : pre-coarsening
+    of high resolution models (see `ancillary.choose_regrid_option`), and
+    use of cached remapping weights (see `cancillary.remap`)
+    """
+    from CAMMAClib import ancillary, cancillary
+    return dict(use_coarsening=ancillary.use_coarsening, coarsening_fraction=ancillary.coarsening_fraction,
+                coarsening_tolerance=ancillary.coarsening_tolerance, weights_cache=cancillary.use_weights_cache)
+
+
+def regrid_params(variable,table,model,grid,common_grid) :
+    """
+    Returns a dict of the parameters which affect the remapping of a field
+    of MODEL (on GRID) to COMMON_GRID, for keying cached fields : the regrid
+    option (including coarsening factors) and `regrid_settings`
+    """
+    return dict(regrid_settings(),
+                regrid=choose_regrid_option(variable,table,model,grid,target_grid=common_grid))
+
+
+def model_fields_params(project,model,realization,variable,table,season,derivation_label,
+                        ref_experiment,ref_period,experiment,projection_period,
+                        common_grid,threshold,variab_sampling_args,data_versions,
+                        relative,standardized) :
+    """
+    Returns a dict of the cache parameters of the per-model fields computed
+    by `change_fields_internal`, i.e. those fed in dict 'dic' (see
+    `change_fields`), except variability fields. These parameters do not
+    depend on the ensemble membership; they include only what affects each
+    field (e.g. the regridding settings affect only remapped fields)
+    """
+    ref_version=data_versions[ref_experiment][variable][table][model][realization]
+    native=dict(kind="model_field",project=project,model=model,realization=realization,
+                variable=variable,table=table,season=season,derivation=derivation_label,
+                ref_experiment=ref_experiment,ref_period=ref_period,ref_version=ref_version)
+    base=dict(native,common_grid=common_grid,
+              **regrid_params(variable,table,model,ref_version[0],common_grid))
+    scenario=dict(experiment=experiment,projection_period=projection_period,
+                  version=data_versions[experiment][variable][table][model][realization])
+    projection=dict(base,**scenario)
+    native_projection=dict(native,**scenario)
+    params={ "reference_remapped" : base, "projection_remapped" : projection, "change" : projection,
+             "reference" : native, "projection" : native_projection, "change_orig" : native_projection }
+    if relative :
+        params["rchange"]=dict(projection,threshold=threshold)
+        params["rchange_orig"]=dict(native_projection,threshold=threshold)
+    if standardized :
+        control=data_versions["piControl"][variable][table][model]
+        if realization not in control :
+            realization=list(control.keys())[0]
+        variability=dict(variab_sampling_args=variab_sampling_args,control_version=control[realization])
+        params["schange"]=dict(projection,**variability)
+        params["schange_orig"]=dict(native_projection,**variability)
+    return dict([ (field,dict(params[field],field=field)) for field in params ])
+
+
+def aggregate_name(field,season) :
+    """
+    Returns the name of the variable for aggregate FIELD and SEASON in a
+    consolidated aggregates file (see `dump_aggregates`)
+    """
+    return "%s_%s"%(field,season)
+
+
+def consolidate(files,names,out,previous=None) :
+    """
+    Write in file OUT the sole variable of each of the NetCDF FILES (which
+    are assumed to be single-record fields on the same grid), renamed
+    according to list NAMES. Time coordinates are those of the first file.
+    If file PREVIOUS is not None, its variables which are not in NAMES are
+    also written in OUT
+    """
+    import xarray as xr
+    merged=None
+    kept=[]
+    if previous is not None :
+        with xr.open_dataset(previous) as ds :
+            kept=[ v for v in ds.data_vars if v not in names and "_bnds" not in v ]
+            if len(kept) > 0 :
+                merged=ds.drop_vars([ v for v in ds.data_vars if v not in kept and "_bnds" not in v ]).load()
+    for f,name in zip(files,names) :
+        with xr.open_dataset(f) as ds :
+            ds.load()
+            var=[ v for v in ds.data_vars if "_bnds" not in v ][0]
+            if merged is None :
+                merged=ds.drop_vars(var)
+            merged[name]=(ds[var].dims,ds[var].values,ds[var].attrs)
+    encoding=dict([ (name,{"_FillValue":1.e+20, "zlib":True, "complevel":1}) for name in kept+list(names) ])
+    merged.to_netcdf(out,encoding=encoding)
+
+
+def dump_aggregates(aggregates,params,cache_dir,deep=None) :
     """
     This is an ancillary function for `change_figure_with_caching`. See its doc
+
+    Stores all fields of dict AGGREGATES for the variable, experiment and
+    derivation of dict PARAMS in cache CACHE_DIR (see module `cache`), as a 
+    single (consolidated) NetCDF file keyed by PARAMS, with one variable per
+    field and season (see `aggregate_name`). PARAMS does not include the
+    season : fields of other seasons already stored for PARAMS are kept in
+    the new file (except if two jobs store seasons concurrently, in which
+    case one of them may be lost, which only implies a later cache miss)
     """
-    import os, os.path
-    if not os.path.exists(cache_dir) : 
-        os.makedirs(cache_dir)
-    for exp in aggregates[variable] :
-        for season in aggregates[variable][exp] :
-            for field in aggregates[variable][exp][season] :
-                cfile(aggregates[variable][exp][season][field][derive],
-                      cache_dir+"/%s=%s=%s=%s=%s=%s=%s=%s.nc"%(season,variable,exp,field,derive,ref_period,proj_period,tag),
-                      deep=None,ln=False)
+    variable,exp,derive=params["variable"],params["experiment"],params["derivation"]
+    files,names=[],[]
+    for season in aggregates[variable][exp] :
+        for field in aggregates[variable][exp][season] :
+            tmp=temporary_path(cache_dir)
+            cfile(aggregates[variable][exp][season][field][derive],tmp,deep=None,ln=False)
+            files.append(tmp)
+            names.append(aggregate_name(field,season))
+    out=temporary_path(cache_dir)
+    consolidate(files,names,out,lookup(cache_dir,cache_key(**params)))
+    for f in files :
+        os.remove(f)
+    store(cache_dir,cache_key(**params),out,params)
                 
-def read_aggregates(ref_period,proj_period,tag,cache_dir) :
+def read_aggregates(params,seasons,fields,cache_dir) :
     """
     This is an ancillary function for `change_figure_with_caching`. See its doc
+
+    Returns a dict of aggregates (see `change_fields`) with those of FIELDS
+    and SEASONS which are found in cache CACHE_DIR, for the variable,
+    experiment and derivation of dict PARAMS. The consolidated file is
+    opened once, and only the requested fields are provided (as CliMAF
+    datasets which select one variable of that file)
     """
+    import xarray as xr
     d=dict()
-    import glob
-    files=glob.glob(cache_dir+"/*=*=*=*=*=*=*=%s.nc"%tag)
-    for f in files :
-        bn=f.split("/")[-1]
-        bn=bn.split(".")[0]
-        bn=bn.split("=")
-        season,variable,exp,field,derive,rperiod,pperiod,_=bn
-        if pperiod==proj_period and rperiod==ref_period :
-            dataset=fds(f,period="1850-2100")
-            # Need to erase cached value
-            cdrop(dataset)
-            feed_dic(d,dataset,variable,exp,season,field,derive)
+    variable,exp,derive=params["variable"],params["experiment"],params["derivation"]
+    f=lookup(cache_dir,cache_key(**params))
+    if f is None :
+        return d
+    with xr.open_dataset(f) as ds : # Reads only metadata
+        available=list(ds.data_vars)
+    for season in seasons :
+        for field in fields :
+            name=aggregate_name(field,season)
+            if name in available :
+                dataset=fds(f,variable=name,period="1850-2100")
+                # Need to erase cached value
+                cdrop(dataset)
+                feed_dic(d,dataset,variable,exp,season,field,derive)
     return d
 
 
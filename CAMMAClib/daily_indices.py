@@ -0,0 +1,235 @@
+"""
+Script daily_indices computes, in one pass over a series of (NetCDF format)
+files of daily precipitation, a series of annual indices :
+
+  - dry    : number of dry days, i.e. with precipitation lower than THRESHOLD
+  - sdii   : simple daily intensity index, i.e. mean precipitation over days
+             with precipitation higher than THRESHOLD (in input units)
+  - rx1day : maximum 1-day precipitation amount (in kg m-2, i.e. mm)
+  - rx5day : maximum 5-day precipitation amount (in kg m-2, i.e. mm)
+  - cdd    : maximum number of consecutive dry days
+
+Usage :
+
+  daily_indices [--var VAR] [--period BEGIN,END] [--threshold THRESHOLD] \\
+           "files" out_dry out_sdii out_rx1day out_rx5day out_cdd
+
+  where :
+
+    - VAR is the variable name (default : the sole variable of first file),
+    - BEGIN and END are dates in ISO format (such as 1850-01-01T00:00:00),
+      which limit the processed period (default : all data),
+    - THRESHOLD is the dry day threshold, in input units (default : 1 mm/day
+      for a precipitation flux in kg m-2 s-1)
+
+Definitions of dry days and of SDII match those of derivations 'dry' and
+'drain' in module `changes` (which used CDO operators 'ltc' and
+'setrtomiss'). Rx5day windows and dry spells do not span years. Missing
+values are skipped; an index is missing for a year with no valid data at a
+location.
+
+Each output has one record per year, dated (as CDO yearly statistics) by
+the last day of the year, and with time bounds spanning the year. Data are
+read one year at a time, whatever the files organization, so that memory
+footprint is bounded by the size of one year of data
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import xarray as xr
+import numpy as np
+import sys
+
+try :
+    from ensemble_stats import sole_variable
+except ImportError :
+    from CAMMAClib.ensemble_stats import sole_variable
+
+#: Names of the indices, in the order of outputs
+indices=[ "dry", "sdii", "rx1day", "rx5day", "cdd" ]
+
+#: Metadata for the outputs
+metadata={
+    "dry"    : dict(long_name="Number of dry days", units="days"),
+    "sdii"   : dict(long_name="Simple daily intensity index"),
+    "rx1day" : dict(long_name="Maximum 1-day precipitation amount", units="kg m-2"),
+    "rx5day" : dict(long_name="Maximum 5-day precipitation amount", units="kg m-2"),
+    "cdd"    : dict(long_name="Maximum number of consecutive dry days", units="days"),
+}
+
+seconds_per_day=24.*3600.
+
+
+def in_period(times, period) :
+    """
+    Returns a boolean array telling which of TIMES (datetime64 or cftime
+    values) are within PERIOD (a pair of ISO dates, bounds included, or None)
+    """
+    if period is None :
+        return np.ones(len(times),dtype=bool)
+    if np.issubdtype(times.dtype,np.datetime64) :
+        begin,end=[ np.datetime64(date).astype(times.dtype) for date in period ]
+        return (times >= begin) & (times <= end)
+    return np.array([ period[0] <= t.isoformat() <= period[1] for t in times ],dtype=bool)
+
+
+def yearly_chunks(files, var=None, period=None) :
+    """
+    Generator which yields, for each year of the data of variable VAR in
+    (time-ordered) FILES, within PERIOD (a pair of ISO dates, or None), a
+    tuple : (year, times, time bounds or None, data array with time first).
+    A year which spans several files is yielded once
+    """
+    pending=None
+
+    def merged(chunks) :
+        year=chunks[0][0]
+        bounds=None
+        if chunks[0][2] is not None :
+            bounds=np.concatenate([ c[2] for c in chunks ])
+        return (year, np.concatenate([ c[1] for c in chunks ]), bounds,
+                np.concatenate([ c[3] for c in chunks ]))
+
+    for f in files :
+        with xr.open_dataset(f) as ds :
+            if var is None :
+                var=sole_variable(ds)
+            da=ds[var]
+            kept=np.nonzero(in_period(ds["time"].values,period))[0]
+            years=ds["time"].dt.year.values[kept]
+            axis_num=da.get_axis_num("time")
+            for year in np.unique(years) :
+                selected=kept[years == year]
+                chunk=(int(year), ds["time"].values[selected],
+                       ds["time_bnds"].values[selected] if "time_bnds" in ds else None,
+                       np.moveaxis(da.isel(time=selected).values,axis_num,0))
+                if pending is not None and pending[0][0] != chunk[0] :
+                    yield merged(pending)
+                    pending=None
+                if pending is None :
+                    pending=[]
+                pending.append(chunk)
+    if pending is not None :
+        yield merged(pending)
+
+
+def annual_indices(data, threshold) :
+    """
+    Returns a dict of the indices (see `indices`) computed on array DATA
+    of daily precipitation (with time first) for one year
+    """
+    valid=~np.isnan(data)
+    nvalid=valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dry=valid & (data < threshold)
+        wet=valid & (data > threshold)
+        rep=dict(dry=dry.sum(axis=0).astype(np.float64))
+        rep["sdii"]=np.where(wet,data,0.).sum(axis=0)/wet.sum(axis=0)
+        rep["rx1day"]=np.where(valid,data,-np.inf).max(axis=0)*seconds_per_day
+        # 5-day sums using prefix sums; windows with missing values are skipped
+        if data.shape[0] >= 5 :
+            zero=np.zeros((1,)+data.shape[1:])
+            csums  =np.concatenate((zero,np.cumsum(np.where(valid,data,0.),axis=0,dtype=np.float64)))
+            ccounts=np.concatenate((zero,np.cumsum(valid,axis=0)))
+            sums=csums[5:]-csums[:-5]
+            complete=(ccounts[5:]-ccounts[:-5]) == 5
+            rep["rx5day"]=np.where(complete,sums,-np.inf).max(axis=0)*seconds_per_day
+            rep["rx5day"][~complete.any(axis=0)]=np.nan
+        else :
+            rep["rx5day"]=np.full(data.shape[1:],np.nan)
+        # Dry spells : running length of current spell, and its maximum
+        run=np.zeros(data.shape[1:])
+        cdd=np.zeros(data.shape[1:])
+        for day in dry :
+            run=(run+1)*day
+            np.maximum(cdd,run,out=cdd)
+        rep["cdd"]=cdd
+    for index in indices :
+        rep[index][nvalid == 0]=np.nan
+    rep["sdii"][~np.isfinite(rep["sdii"])]=np.nan
+    return rep
+
+
+def compute(files, threshold, var=None, period=None) :
+    """
+    Returns a dict of Datasets, one per index (see `indices`), with one
+    record per year of the data of variable VAR in FILES (within PERIOD, see
+    `yearly_chunks`)
+    """
+    files=sorted(files, key=first_time)
+    with xr.open_dataset(files[0]) as template :
+        if var is None :
+            var=sole_variable(template)
+        da=template[var]
+        others=[ d for d in da.dims if d != "time" ]
+        coords=[ (d, template[d].values, template[d].attrs) for d in others ]
+        extra=dict((v,template[v].load()) for v in [ "lat_bnds", "lon_bnds" ] if v in template)
+        time_encoding=dict((k,v) for k,v in template["time"].encoding.items() if k in [ "units", "calendar" ])
+        time_encoding["dtype"]="float64"
+        var_attrs=da.attrs
+        dims=da.dims
+    results=dict((index,[]) for index in indices)
+    times=[]
+    bounds=[]
+    for year,time,time_bnds,data in yearly_chunks(files, var, period) :
+        values=annual_indices(data.astype(np.float64), threshold)
+        for index in indices :
+            results[index].append(values[index])
+        times.append(time[-1])
+        if time_bnds is not None :
+            bounds.append([ time_bnds[0][0], time_bnds[-1][1] ])
+    #
+    rep=dict()
+    for index in indices :
+        out=xr.Dataset()
+        attrs=dict(var_attrs)
+        attrs.update(metadata[index])
+        data=xr.DataArray(np.array(results[index]).astype(np.float32),
+                          coords=[ ("time", np.array(times)) ] + [ (d,v) for d,v,_ in coords ],
+                          attrs=attrs)
+        out[var]=data.transpose(*dims)
+        for d,_,a in coords :
+            out[d].attrs=a
+        for v in extra :
+            out[v]=extra[v]
+        if len(bounds) > 0 :
+            out["time_bnds"]=xr.DataArray(np.array(bounds),dims=("time","bnds"))
+            out["time"].attrs["bounds"]="time_bnds"
+        out["time"].encoding.update(time_encoding)
+        out[var].encoding["_FillValue"]=1.e+20
+        rep[index]=out
+    return rep
+
+
+def first_time(filename) :
+    """
+    Returns the first time value of FILENAME, used for ordering files
+    """
+    with xr.open_dataset(filename) as ds :
+        return ds["time"].values[0]
+
+
+def main(argv) :
+    """
+    Command line interface (see module doc)
+    """
+    args=argv[1:]
+    var=None
+    period=None
+    threshold=1./seconds_per_day
+    while args[0].startswith("--") :
+        if args[0] == "--var" :
+            var=args[1]
+        elif args[0] == "--period" :
+            period=args[1].split(",")
+        elif args[0] == "--threshold" :
+            threshold=float(args[1])
+        else :
+            raise ValueError("Unknown option %s for daily_indices"%args[0])
+        args=args[2:]
+    results=compute(args[0].split(), threshold, var, period)
+    for index,filename in zip(indices,args[1:]) :
+        results[index].to_netcdf(filename)
+
+
+if __name__ == "__main__" :
+    main(sys.argv)
@@ -0,0 +1,142 @@
+"""
+Script ensemble_stats computes, in one pass, a series of statistics across
+the members of an ensemble of (NetCDF format) fields, which are assumed to be
+single-variable and on the same grid
+
+Usage :
+
+  ensemble_stats [--percentile P] "files" out_mean out_median out_pctl out_std out_agree
+
+      computes the ensemble mean, median, P-th percentile (default 90),
+      standard deviation (with ddof=1) and the fraction of members which
+      agree on sign (the highest of the fractions of values <= 0 and >= 0)
+
+  ensemble_stats --means_rchange "projection_files" "reference_files" out
+
+      computes the relative change (in %) of the ensemble mean of projections
+      vs. the ensemble mean of references
+
+Missing values are skipped, as CDO ens* operators do; percentiles use the
+nearest rank method (which is CDO's default) : for N valid members, the
+P-th percentile is the member of rank ceil(N*P/100) (or the lowest member for
+P=0). Hence, with an even number of members, the median is the lower of the
+two central values, as with CDO's enspctl,50
+
+Input fields are loaded once in a (member, ...) array
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import xarray as xr
+import numpy as np
+import sys
+
+
+def sole_variable(ds) :
+    """
+    Returns the name of the sole variable of Dataset DS, apart from
+    bounds variables; raise an error if there are more than one
+    """
+    allvars= [ var for var in ds.keys() if "_bnds" not in var ]
+    if len(allvars) > 1 :
+        raise ValueError("Too many vars : %s"%allvars)
+    return allvars[0]
+
+
+def load_ensemble(files) :
+    """
+    Returns a pair : the Dataset for first file in list FILES (used as a
+    template for outputs), and a (member, ...) array of the sole variable of
+    all FILES
+    """
+    arrays=[]
+    template=None
+    for f in files :
+        with xr.open_dataset(f,mask_and_scale=True) as ds :
+            var=sole_variable(ds)
+            if template is None :
+                template=ds.load()
+            arrays.append(ds[var].values)
+    return template, np.stack(arrays)
+
+
+def percentile_nrank(data, percentile) :
+    """
+    Compute PERCENTILE along first axis of array DATA, with the nearest rank method
+    and skipping NaNs
+    """
+    valid=(~np.isnan(data)).sum(axis=0)
+    # NaNs are sorted last
+    ordered=np.sort(data,axis=0)
+    rank=np.ceil(valid*percentile/100.).astype(int)
+    rank=np.clip(rank-1,0,None)
+    with np.errstate(invalid='ignore'):
+        rep=np.take_along_axis(ordered,rank[None,...],axis=0)[0]
+    rep[valid==0]=np.nan
+    return rep
+
+
+def ensemble_statistics(data, percentile=90) :
+    """
+    Returns a dict of fields computed on array DATA along its first axis :
+    mean, median, pctl (for PERCENTILE), std and agree (fraction of members
+    agreeing on sign, among all members)
+    """
+    nb=data.shape[0]
+    valid=(~np.isnan(data)).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean=np.nansum(data,axis=0)/valid
+        std=np.sqrt(np.nansum((data-mean)**2,axis=0)/(valid-1))
+        agree=np.maximum((data<=0).sum(axis=0),(data>=0).sum(axis=0))/float(nb)
+    mean[valid==0]=np.nan
+    std[valid<2]=np.nan
+    agree[valid==0]=np.nan
+    return dict(mean=mean, median=percentile_nrank(data,50), pctl=percentile_nrank(data,percentile),
+                std=std, agree=agree)
+
+
+def means_relative_change(projections, references) :
+    """
+    Returns the relative change (in %) of the mean of array PROJECTIONS vs.
+    the mean of array REFERENCES, along their first axis, skipping NaNs. As
+    with CDO's div, the result is missing where the reference mean is zero
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        proj=np.nanmean(projections,axis=0)
+        ref=np.nanmean(references,axis=0)
+        return np.where(ref != 0, 100.*(proj-ref)/ref, np.nan)
+
+
+def write_like(template, data, filename) :
+    """
+    Write array DATA in FILENAME, with the same structure and metadata as the
+    sole variable of Dataset TEMPLATE
+    """
+    var=sole_variable(template)
+    out=template.copy()
+    out[var]=template[var].copy(data=data.astype(template[var].dtype))
+    out[var].encoding["_FillValue"]=1.e+20
+    out.to_netcdf(filename)
+
+
+def main(argv) :
+    """
+    Command line interface (see module doc)
+    """
+    args=argv[1:]
+    if args[0] == "--means_rchange" :
+        template,projections=load_ensemble(args[1].split())
+        _,references=load_ensemble(args[2].split())
+        write_like(template,means_relative_change(projections,references),args[3])
+        return
+    percentile=90.
+    if args[0] == "--percentile" :
+        percentile=float(args[1])
+        args=args[2:]
+    template,data=load_ensemble(args[0].split())
+    stats=ensemble_statistics(data,percentile)
+    for key,filename in zip([ "mean", "median", "pctl", "std", "agree" ],args[1:]) :
+        write_like(template,stats[key],filename)
+
+
+if __name__ == "__main__" :
+    main(sys.argv)
@@ -0,0 +1,115 @@
+"""
+Fusion of chains of unary CDO operators in CliMAF graphs
+
+CAMMAC builds its CliMAF objects by stacking many single-step calls of
+'ccdo' or 'ccdo_fast' (e.g. a time mean after `variability.process_dataset`,
+the comparisons of `variability.stippling_hatching_masks_AR5`, or the
+masking steps of `cancillary.walsh_seasonality`), each of which would write
+an intermediate NetCDF file when evaluated.
+
+Function `fuse` rewrites such a chain (ccdo(ccdo(x,operator=op1),operator=op2))
+as a single CDO piped command (ccdo(x,operator="op2 -op1")), which runs as one
+process without intermediate files. The fused object keeps the cache key
+(CRS) of the last node of the chain, so that its result is cached, and found
+again, as if it had been computed step by step. A chain is not fused below
+a node which result is already in CliMAF cache, which is re-used.
+
+Functions `cfile`, `ceval` and `cvalue` of this module apply `fuse` to
+their first argument before calling CliMAF's functions with the same name.
+They are imported by modules `variability`, `cancillary` and `changes`,
+after CliMAF api, so that all their evaluations benefit from fusion.
+Fusion can be de-activated by setting `use_fusion` to False
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import climaf.api
+
+#: Toggle for fusing chains of CDO operators before evaluation
+use_fusion=True
+
+#: CliMAF operators which can be fused : they apply CDO operator(s) given by
+#: parameter 'operator' to a single input
+fusable_operators=[ "ccdo", "ccdo_fast" ]
+
+
+def is_fusable(cobject) :
+    """
+    Returns True if CliMAF object COBJECT is the application of a fusable
+    operator to a single operand, with no other parameter than 'operator'
+    """
+    from climaf.classes import ctree
+    return isinstance(cobject,ctree) and cobject.operator in fusable_operators and \
+        len(cobject.operands) == 1 and set(cobject.parameters.keys()) <= set([ "operator" ])
+
+
+def fuse(cobject, fused=None) :
+    """
+    Returns a CliMAF object equivalent to COBJECT, where chains of fusable
+    operators (see `fusable_operators`) are replaced by single CDO
+    piped commands, and which has the same cache key (CRS) as COBJECT
+
+    FUSED is a dict used for memoizing results by CRS when walking the graph
+    """
+    from climaf.classes import ctree
+    from climaf.cache import hasExactObject
+    import climaf.operators
+    #
+    if not use_fusion or not isinstance(cobject,ctree) :
+        return cobject
+    if fused is None :
+        fused=dict()
+    if cobject.crs in fused :
+        return fused[cobject.crs]
+    if hasExactObject(cobject) :
+        fused[cobject.crs]=cobject
+        return cobject
+    #
+    if is_fusable(cobject) :
+        # Gather the chain of CDO operators, from last to first
+        operators=[ cobject.parameters["operator"] ]
+        innermost=cobject
+        operand=cobject.operands[0]
+        while is_fusable(operand) and not hasExactObject(operand) :
+            operators.append(operand.parameters["operator"])
+            innermost=operand
+            operand=operand.operands[0]
+        if innermost is cobject :
+            rep=cobject
+        else :
+            # The first operator determines how the chain input is read
+            climaf_operator=getattr(climaf.operators,innermost.operator)
+            command=" ".join([ operators[0] ] + [ "-"+op for op in operators[1:] ])
+            rep=climaf_operator(fuse(operand,fused),operator=command)
+            rep.crs=cobject.crs
+    else :
+        operands=[ fuse(op,fused) for op in cobject.operands ]
+        if all( new is old for new,old in zip(operands,cobject.operands) ) :
+            rep=cobject
+        else :
+            rep=ctree(cobject.operator,cobject.script,*operands,**cobject.parameters)
+            rep.crs=cobject.crs
+            if hasattr(cobject,"outputs") :
+                rep.outputs=cobject.outputs
+    fused[cobject.crs]=rep
+    return rep
+
+
+def cfile(cobject, *args, **kwargs) :
+    """
+    Same as CliMAF's cfile, after fusing chains of CDO operators in COBJECT (see `fuse`)
+    """
+    return climaf.api.cfile(fuse(cobject), *args, **kwargs)
+
+
+def ceval(cobject, *args, **kwargs) :
+    """
+    Same as CliMAF's ceval, after fusing chains of CDO operators in COBJECT (see `fuse`)
+    """
+    return climaf.api.ceval(fuse(cobject), *args, **kwargs)
+
+
+def cvalue(cobject, *args, **kwargs) :
+    """
+    Same as CliMAF's cvalue, after fusing chains of CDO operators in COBJECT (see `fuse`)
+    """
+    return climaf.api.cvalue(fuse(cobject), *args, **kwargs)
@@ -1,8 +1,20 @@
 """
-Script gini computes Gini index on the time series of its (NetCDF format) input file, 
+Script gini computes Gini index on the time series of its (NetCDF format) input file,
 which is assumed to be single-variable, and write it in NetCDF output file
 
-Usage : gini file_in file_out
+Usage : gini [--slices BEGIN,NYEARS,NUMBER] file_in file_out [file_in2 file_out2 ...]
+
+Many input/output pairs can be processed in one invocation, e.g. from a
+batch script. CliMAF operators produce a fixed set of outputs, so operator
+'gini' (see module `cancillary`) still processes one dataset per call; the
+slices of a piControl dataset are processed in one call by operator
+'gini_slices'
+
+With option --slices, the Gini index is computed separately for NUMBER slices of
+NYEARS years each, the first one beginning with year BEGIN; the output then has
+one record per slice
+
+Data is sorted in place along time, by chunks of grid cells, rather than copied
 """
 from __future__  import division, print_function , unicode_literals, absolute_import
 
@@ -11,21 +23,79 @@ import numpy as np
 import sys
 
 
+def gini_array(data, chunk_size=10000) :
+    """
+    Returns the Gini index along first axis of numpy array DATA (which is
+    sorted in place along that axis, by chunks of CHUNK_SIZE grid cells)
+    """
+    n=data.shape[0]
+    flat=data.reshape(n,-1)
+    if not np.shares_memory(flat, data) :
+        raise ValueError("Cannot sort in place a non-contiguous array")
+    rank=np.arange(1,n+1,dtype=np.float64)
+    val=np.empty(flat.shape[1])
+    for c0 in range(0, flat.shape[1], chunk_size) :
+        chunk=flat[:, c0:c0+chunk_size]
+        chunk.sort(axis=0)
+        # Missing values are skipped in sums, as with xarray's sum
+        product=np.nansum(chunk*rank[:,None],axis=0)
+        total=np.nansum(chunk,axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            val[c0:c0+chunk_size] = (2.* product / ( n * total)) - (n+1.)/n
+    return val.reshape(data.shape[1:])
+
+
 def gini_da(da,axis_name="time") : #da is a DataArray
+    """
+    Returns Gini index of DataArray DA along AXIS_NAME. DA's data is
+    sorted in place when AXIS_NAME is its first dimension
+    """
+    axis_num=da.get_axis_num(axis_name)
+    data=np.ascontiguousarray(np.moveaxis(da.values,axis_num,0))
+    others=[ d for d in da.dims if d != axis_name ]
+    val=xr.DataArray(gini_array(data), coords=[ (d, da[d].values) for d in others ])
+    val.name="gini(%s)"%da.name
+    return val
+
+
+def slices_indices(years, begin, nyears, number) :
+    """
+    Returns a list of NUMBER arrays of indices in array YEARS, for the
+    successive slices of NYEARS years beginning with year BEGIN. Raise an
+    error if a slice has no record
+    """
+    rep=[ np.nonzero((years >= begin+k*nyears) & (years < begin+(k+1)*nyears))[0]
+          for k in range(number) ]
+    for k,indices in enumerate(rep) :
+        if len(indices) == 0 :
+            raise ValueError("No data for slice %d-%d (data covers years %d-%d)"%\
+                             (begin+k*nyears,begin+(k+1)*nyears-1,years.min(),years.max()))
+    return rep
+
+
+def gini_slices_da(da, begin, nyears, number, axis_name="time") :
+    """
+    Compute Gini index of DataArray DA for NUMBER slices of NYEARS years each,
+    beginning with year BEGIN. Returns a DataArray with one record per slice
+    """
     axis_num=da.get_axis_num(axis_name)
-    da_sorted=da.copy(data=np.apply_along_axis(np.sort,axis_num,da))
-    rank=xr.DataArray(np.arange(1,da.coords[axis_name].size+1), name="rank",dims=axis_name)
-    product=da_sorted*rank
-    n=np.float(rank.size)
-    val= (2.* product.sum(dim=axis_name) / ( n * da_sorted.sum(dim=axis_name))) - (n+1)/n  
+    data=np.moveaxis(da.values,axis_num,0)
+    years=da[axis_name].dt.year.values
+    vals=[]
+    for indices in slices_indices(years, begin, nyears, number) :
+        vals.append(gini_array(np.ascontiguousarray(data[indices])))
+    others=[ d for d in da.dims if d != axis_name ]
+    middles=[ da[axis_name].values[indices[len(indices)//2]]
+              for indices in slices_indices(years, begin, nyears, number) ]
+    val=xr.DataArray(np.stack(vals), coords=[ (axis_name, middles) ] + [ (d, da[d].values) for d in others ])
     val.name="gini(%s)"%da.name
     return val
 
 
 def my_time_reduce(ds,func,varname,**args) :
-    """ 
-    Apply time-reducing function FUNC (with ARGS) to dataset DS, producing 
-    variable VARNAME. Handle time bounds (but not yet central time coordinate) 
+    """
+    Apply time-reducing function FUNC (with ARGS) to dataset DS, producing
+    variable VARNAME. Handle time bounds (but not yet central time coordinate)
 
     DS should be a Dataset with only one variable (except coord related variables)
     FUNC should be a function which aggregate the variable over time
@@ -47,8 +117,8 @@ def my_time_reduce(ds,func,varname,**args) :
     #
     # Compute time instant in the middle of input time period
     t=ds["time"]
-    out.assign_coords(time=("time",t.isel(time=[t.size/2]).data))
-    # 
+    out.assign_coords(time=("time",t.isel(time=[t.size//2]).data))
+    #
     if "time_bnds" in ds :
         out["time_bnds"]   =ds["time_bnds"].isel(time=0)
         out["time_bnds"][1]=ds["time_bnds"].isel(time=-1)[1]
@@ -56,10 +126,56 @@ def my_time_reduce(ds,func,varname,**args) :
     out[varname]=func(ds[var],**args)
     return out
 
-#f="~/dev/tas_year.nc"
 
-file_in=sys.argv[1]
-file_out=sys.argv[2]
-ds=xr.open_dataset(file_in).load()
-ga=my_time_reduce(ds,gini_da,"gini")
-ga.to_netcdf(file_out)
+def my_slices_reduce(ds,varname,begin,nyears,number) :
+    """
+    Same as `my_time_reduce` with function `gini_slices_da`, but output
+    has one record (and time bounds) per slice
+    """
+    allvars= [ var for var in ds.keys() if "_bnds" not in var ]
+    if len(allvars) > 1 :
+        raise ValueError("Too many vars : %s"%allvars)
+    var=allvars[0]
+    #
+    out = xr.Dataset()
+    out.attrs=ds.attrs
+    if "variable_id" in ds.attrs :
+        out.attrs["variable_id"]="gini(%s)"%ds.attrs["variable_id"]
+    #
+    for v in [ "lat_bnds","lon_bnds"] :
+        if v in ds :
+            out[v]=ds[v]
+    #
+    out[varname]=gini_slices_da(ds[var],begin,nyears,number)
+    #
+    if "time_bnds" in ds :
+        years=ds["time"].dt.year.values
+        bnds=[ [ ds["time_bnds"].values[indices[0]][0], ds["time_bnds"].values[indices[-1]][1] ]
+               for indices in slices_indices(years, begin, nyears, number) ]
+        out["time_bnds"]=xr.DataArray(np.array(bnds),dims=("time",ds["time_bnds"].dims[-1]))
+    return out
+
+
+def main(argv) :
+    """
+    Command line interface (see module doc)
+    """
+    args=argv[1:]
+    slices=None
+    if args[0] == "--slices" :
+        slices=[ int(v) for v in args[1].split(",") ]
+        args=args[2:]
+    if len(args) % 2 != 0 :
+        raise ValueError("gini needs pairs of input and output files : %s"%args)
+    for file_in, file_out in zip(args[0::2], args[1::2]) :
+        with xr.open_dataset(file_in) as ds :
+            ds.load()
+            if slices is None :
+                ga=my_time_reduce(ds,gini_da,"gini")
+            else :
+                ga=my_slices_reduce(ds,"gini",*slices)
+            ga.to_netcdf(file_out)
+
+
+if __name__ == "__main__" :
+    main(sys.argv)
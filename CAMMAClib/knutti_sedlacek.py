@@ -12,162 +12,313 @@ Interface is tuned for use in CliMAF :
 Input fields are supposed to be already re-mapped on the same grid. 
 Input ensembles must be of the same size 
 
-This is a wrapper around a code provided by Benjamin Cook (NCAR), for use in CliMAF
+Optional fourth and fifth arguments provide a memory budget (in Mbytes) and a 
+number of worker processes; they default to the values of environment variables 
+CAMMAC_KS_MEMORY and CAMMAC_KS_WORKERS. When the input data does not fit in the 
+memory budget, or when more than one worker is requested, data is read and 
+processed by bands of latitudes, spread over a pool of processes, and each band 
+is written in the output file as soon as it is computed (see function `banded_KandS`)
+
+This is a wrapper around a code provided by Benjamin Cook (NCAR), for use in CliMAF. 
+The per-grid-cell loop of that code is replaced by a computation of the CDFs of 
+all cells at once (see function `cdfs_on_edges`), which gives the same results
 
 """
 from __future__  import division, print_function , unicode_literals, absolute_import
 
 import xarray as xr
 import numpy as np
-import sys
+import sys, os
 
-def KandS(allmods_hist, allmods_fut, names) :
+def cdfs_on_edges(samples, first, last, num_bins=1000):
+    """
+    Compute, for each column of 2D array SAMPLES (samples x cells), the
+    normalized cumulative histogram (CDF) of its values on NUM_BINS
+    equal bins spanning [FIRST, LAST] (which are 1D arrays, one value per
+    cell). Values outside that range are not counted.
+
+    This reproduces, for all cells at once, the result of :
+    >>> np.cumsum(np.histogram(samples[:,i],bins=num_bins,range=(first[i],last[i]))[0])
+    normalized by its last value, but with a single bincount on a
+    flattened (cell, bin) axis
+
+    Returns an array of shape cells x NUM_BINS
+    """
+    nsamples, ncells = samples.shape
+    # np.histogram computes its edges from the range scalars, with the
+    # precision that np.linspace selects for such scalars (which depends
+    # on numpy version), and then casts them to the common type of range and data
+    first = np.asarray(first)
+    last  = np.asarray(last)
+    ctype = np.linspace(first.dtype.type(0), first.dtype.type(1), 2).dtype
+    dtype = np.result_type(first.dtype, samples.dtype)
+    first = first.astype(ctype)
+    last  = last.astype(ctype)
+    # Same convention as np.histogram for degenerate ranges
+    same = (first == last)
+    first[same] -= 0.5
+    last [same] += 0.5
+    #
+    edges = np.linspace(first, last, num_bins+1, axis=-1).astype(dtype)
+    denom = last - first
+    samples = samples.astype(dtype, copy=False)
+    keep = (samples >= first) & (samples <= last)
+    # Same bin index computation (and edge corrections) as np.histogram
+    indices = ((samples - first) / denom * num_bins).astype(np.intp)
+    indices[indices == num_bins] -= 1
+    np.clip(indices, 0, num_bins-1, out=indices)
+    cells = np.broadcast_to(np.arange(ncells), samples.shape)
+    indices[samples < edges[cells, indices]] -= 1
+    np.clip(indices, 0, num_bins-1, out=indices)
+    indices[(samples >= edges[cells, indices+1]) & (indices != num_bins-1)] += 1
+    #
+    flat = (cells * num_bins + indices)[keep]
+    counts = np.bincount(flat, minlength=ncells*num_bins).reshape(ncells, num_bins)
+    # Like np.histogram(density=True), which weights counts by bin widths
+    cdf = np.cumsum(counts / np.diff(edges, axis=1), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cdf / cdf[:,-1:]
+
+
+def check_time_sizes(allmods_hist, allmods_fut, names) :
+    """
+    Check that all reference and projection DataArrays have the same time size 
+    as the first reference one, and raise an error otherwise (this does not 
+    load the data)
+    """
+    time_size=allmods_hist[0].time.size
+    for allmods in [ allmods_fut, allmods_hist ] :
+        models_in_error=[]
+        for f,n in zip(allmods,names) :
+            if f.time.size != time_size :
+                models_in_error.append(n)
+            print("%30s %3d %3d %3d"%(n,f.lat.size, f.lon.size, f.time.size), f.shape)
+
+        if len(models_in_error) !=0 :
+            print("There are various shapes for input data : ",{ f.shape for f in allmods })
+            print("These models doesn't have the right time size(%d)"%time_size,models_in_error)
+            raise ValueError("These models doesn't have the right time size(%d)"%time_size,models_in_error)
+
+
+def KandS(allmods_hist, allmods_fut, names, chunk_size=2000) :
     """
     Compute Knutti robustness index on DataArrays 
     allmods_hist : list of reference  time series DataArrays 
     allmods_fut  : list of projection time series DataArrays 
 
-    Based on a code provided by Benjamin Cook (NCAR)
+    Based on a code provided by Benjamin Cook (NCAR), but computing the
+    CDFs of all grid cells at once (by chunks of CHUNK_SIZE cells) rather 
+    than in a per-cell loop
     """
 
     lat=allmods_hist[0].lat
     lon=allmods_hist[0].lon
     time_size=allmods_hist[0].time.size
     ens_size=len(allmods_hist)
+    check_time_sizes(allmods_hist, allmods_fut, names)
 
-    models_in_error=[]
-    for f,n in zip(allmods_fut,names) :
-        if f.time.size != time_size :
-            models_in_error.append(n)
-        print("%30s %3d %3d %3d"%(n,f.lat.size, f.lon.size, f.time.size), np.asarray(f).shape)
-
-    if len(models_in_error) !=0 :
-        print("There are various shapes for input data : ",{ f.shape for f in allmods_fut })
-        print("These models doesn't have the right time size(%d)"%time_size,models_in_error)
-        raise ValueError("These models doesn't have the right time size(%d)"%time_size,models_in_error)
-        
-    models_in_error=[]
-    for f,n in zip(allmods_hist,names) :
-        if f.time.size != time_size :
-            models_in_error.append(n)
-        print("%30s %3d %3d %3d"%(n,f.lat.size, f.lon.size, f.time.size), np.asarray(f).shape)
-
-    if len(models_in_error) !=0 :
-        print("There are various shapes for input data : ",{ f.shape for f in allmods_hist })
-        print("These models doesn't have the right time size(%d)"%time_size,models_in_error)
-        raise ValueError("These models doesn't have the right time size(%d)"%time_size,models_in_error)
-
-    # Array to store robustness metric
-    Rrob = np.zeros((lat.size,lon.size))*np.nan
-    
-    # For CDF histograms for robustness calculation
-    num_bins = 1000
-    
-    # Reshape arrays to separate out models. Dimensions on these arrays will be: models x yrs x lat x lon
-    allmods_hist_rob = np.ma.stack(allmods_hist) 
-    allmods_fut_rob = np.ma.stack(allmods_fut) 
-    
-    # Loop Through each grid cell and calculate the robustness metric
-    for n_lat in enumerate(lat):
-        for n_lon in enumerate(lon):
-            
-            # A1 Calculation (based on MME and full ensemble DIFFERENCES)-----------------------------------------------------------------
-            
-            # difference, full ensemble
-            currcell_allmods = np.ma.masked_array.flatten(allmods_fut_rob[:,:,n_lat[0],n_lon[0]]-allmods_hist_rob[:,:,n_lat[0],n_lon[0]])
-            
-            # difference, MME
-            currcell_mme = np.ma.mean( (allmods_fut_rob[:,:,n_lat[0],n_lon[0]]-allmods_hist_rob[:,:,n_lat[0],n_lon[0]]),axis=0 )
-
-            if np.isnan(np.min(currcell_allmods)) or np.isnan(np.max(currcell_allmods)) :
-                Rrob[n_lat[0],n_lon[0]] = np.nan
-                continue
-
-            # Create normalized CDFs
-            # ensemble
-            counts, bin_edges = np.histogram(currcell_allmods, bins=num_bins, density=True)
-            cdf_ens = np.cumsum(counts)
-            cdf_ens_norm = cdf_ens/cdf_ens[-1]
-            # mme
-            counts, bin_edges = np.histogram(currcell_mme, bins=num_bins, range=(np.min(bin_edges),np.max(bin_edges)), density=True)
-            cdf_mme = np.cumsum(counts)
-            cdf_mme_norm = cdf_mme/cdf_mme[-1]
-            
-            # Calculate A1
-            a1=np.sum((cdf_ens_norm-cdf_mme_norm)**2)
-            
-            
-            # A2 Calculation----------------------------------------------------------------------------------------------------------
-            # MME, historical
-            currcell_mme_hist = np.ma.masked_array.flatten(np.mean(allmods_hist_rob[:,:,n_lat[0],n_lon[0]],axis=0))
-            # MME, SSP
-            currcell_mme_ssp = np.ma.masked_array.flatten(np.mean(allmods_fut_rob[:,:,n_lat[0],n_lon[0]],axis=0))
-            
-            # Ranges for CDFs
-            bin_min=np.min((np.min(currcell_mme_hist),np.min(currcell_mme_ssp)))
-            bin_max=np.max((np.max(currcell_mme_hist),np.max(currcell_mme_ssp)))
-
-            # Historical MME CDF
-            counts, bin_edges = np.histogram(currcell_mme_hist, bins=num_bins, range=(bin_min,bin_max), density=True)
-            cdf_hist = np.cumsum(counts)
-            cdf_hist_norm = cdf_hist/cdf_hist[-1]
-            # SSP MME CDF
-            counts, bin_edges = np.histogram(currcell_mme_ssp, bins=num_bins, range=(bin_min,bin_max), density=True)
-            cdf_ssp = np.cumsum(counts)
-            cdf_ssp_norm = cdf_ssp/cdf_ssp[-1]
-            
-            # Calculate A2
-            a2=np.sum((cdf_hist_norm-cdf_ssp_norm)**2)
-            
-            
-            # Calculate Robustness Metric-------------------------------------------------------------------------------------------
-            Rrob[n_lat[0],n_lon[0]] = 1-(a1/a2)
+    # Stack models. Dimensions on these arrays will be: models x yrs x cells
+    ncells = lat.size*lon.size
+    allmods_hist_rob = np.stack([ np.asarray(f) for f in allmods_hist ]).reshape(ens_size,time_size,ncells)
+    allmods_fut_rob  = np.stack([ np.asarray(f) for f in allmods_fut  ]).reshape(ens_size,time_size,ncells)
+
+    Rrob = robustness(allmods_hist_rob, allmods_fut_rob, chunk_size=chunk_size)
+    return xr.DataArray(Rrob.reshape(lat.size,lon.size),coords=[("lat", lat.values), ("lon", lon.values)])
+
+
+def models_mean(a) :
+    """
+    Mean over first axis of A, with the same arithmetic as numpy.ma.mean 
+    (i.e. a sum in the data type followed by a division by a counts array)
+    """
+    return a.sum(axis=0) * 1. / np.full(a.shape[1:], a.shape[0])
+
+
+def robustness(hist, fut, num_bins=1000, chunk_size=2000) :
+    """
+    Compute the robustness metric for arrays HIST and FUT of dimensions 
+    models x yrs x cells, processing cells by chunks of CHUNK_SIZE
+
+    Returns a 1D array of robustness values (NaN where any value is missing) 
+    """
+    ncells = hist.shape[-1]
+    Rrob = np.zeros(ncells)*np.nan
+    for c0 in range(0, ncells, chunk_size) :
+        cells = slice(c0, min(c0+chunk_size, ncells))
+        h = hist[..., cells]
+        f = fut [..., cells]
+
+        # A1 Calculation (based on MME and full ensemble DIFFERENCES)-----------------------------------------------------------------
+        diff = f - h
+        # difference, full ensemble
+        allmods = diff.reshape(-1, diff.shape[-1])
+        # difference, MME
+        mme = models_mean(diff)
+        # Cells with missing values get no robustness value
+        valid = ~ np.isnan(allmods).any(axis=0)
+        if not valid.any() :
+            continue
+        allmods, mme = allmods[:,valid], mme[:,valid]
+        h, f = h[..., valid], f[..., valid]
+
+        # Normalized CDFs, with bins spanning ensemble range, for ensemble and mme
+        bin_min, bin_max = allmods.min(axis=0), allmods.max(axis=0)
+        cdf_ens_norm = cdfs_on_edges(allmods, bin_min, bin_max, num_bins)
+        cdf_mme_norm = cdfs_on_edges(mme,     bin_min, bin_max, num_bins)
+        # Calculate A1
+        a1 = np.sum((cdf_ens_norm-cdf_mme_norm)**2, axis=1)
+
+        # A2 Calculation----------------------------------------------------------------------------------------------------------
+        # MME, historical and SSP
+        mme_hist = models_mean(h)
+        mme_ssp  = models_mean(f)
+        # Ranges for CDFs
+        bin_min = np.minimum(mme_hist.min(axis=0), mme_ssp.min(axis=0))
+        bin_max = np.maximum(mme_hist.max(axis=0), mme_ssp.max(axis=0))
+        cdf_hist_norm = cdfs_on_edges(mme_hist, bin_min, bin_max, num_bins)
+        cdf_ssp_norm  = cdfs_on_edges(mme_ssp,  bin_min, bin_max, num_bins)
+        # Calculate A2
+        a2 = np.sum((cdf_hist_norm-cdf_ssp_norm)**2, axis=1)
+
+        # Calculate Robustness Metric-------------------------------------------------------------------------------------------
+        with np.errstate(invalid='ignore', divide='ignore'):
+            Rrob[np.arange(cells.start, cells.stop)[valid]] = 1-(a1/a2)
             
-    return xr.DataArray(Rrob,coords=[("lat", lat), ("lon", lon)])
-
-
-#
-reference_files  = sys.argv[1].split()
-projection_files = sys.argv[2].split()
-outfilen         = sys.argv[3]
-
-#
-references  = [ xr.open_dataset(f,mask_and_scale=True).load() for f in reference_files  ]
-projections = [ xr.open_dataset(f,mask_and_scale=True).load() for f in projection_files ]
-#
-out       = xr.Dataset()
-out.attrs = projections[0].attrs
-#
-reference   = references[0]
-# Set output variable name
-if "variable_id" in reference.attrs :
-    out.attrs["variable_id"]="KS_RI(%s)"%reference.attrs["variable_id"]
-#
-# Set output coordinate bounds
-for v in [ "lat_bnds","lon_bnds"] :
-    if v in reference :
-        out[v]=reference[v]
-        
-# Also for time (use projections bounds)
-if "time_bnds" in reference :
-    out["time_bnds"]    = projections[0]["time_bnds"].isel(time=0)
-    out["time_bnds"][1] = projections[0]["time_bnds"].isel(time=-1)[1]
-
-# Compute time instant in the middle of projections time period
-#t=projections[0]["time"]
-#out.assign_coords(time=("time",t.isel(time=[t.size/2]).data))
-
-# identify sole input var
-allvars= [ var for var in reference.keys() if "_bnds" not in var ]
-if len(allvars) > 1 :
-    raise ValueError("Too many vars : %s"%allvars)
-var=allvars[0]
-
-
-out["KSRI"]= KandS([ ref[var]  for ref  in references  ] ,
-                   [ proj[var] for proj in projections ],
-                   [ proj.attrs.get("source_id",proj.attrs.get("model_id","??")) for proj in projections ],
-                   )
-
-out.to_netcdf(outfilen,encoding={'KSRI': { '_FillValue': 1e+20}})
+    return Rrob
+
+
+def band_rows(allmods_hist, memory, workers) :
+    """
+    Returns the number of latitude rows which can be processed at once by 
+    each of WORKERS processes, for a total MEMORY budget (in bytes), given 
+    the list of reference DataArrays ALLMODS_HIST 
+    """
+    ens_size=len(allmods_hist)
+    da=allmods_hist[0]
+    # Both ensembles, their difference and the float64 model means 
+    row_bytes = 4 * ens_size * da.time.size * da.lon.size * max(da.dtype.itemsize,8)
+    return max(1, int(memory // (row_bytes * max(workers,1))))
+
+
+def band_robustness(args) :
+    """
+    Compute the robustness metric for latitude rows [I0,I1[ of variable VAR 
+    in files REFERENCE_FILES and PROJECTION_FILES (ARGS is the tuple of these 
+    five values). Returns (I0, I1, robustness array)
+    """
+    reference_files, projection_files, var, i0, i1 = args
+    def read(files) :
+        band=[]
+        for f in files :
+            with xr.open_dataset(f,mask_and_scale=True) as d :
+                band.append(d[var].isel(lat=slice(i0,i1)).values)
+        return np.stack(band)
+    hist = read(reference_files)
+    fut  = read(projection_files)
+    shape= hist.shape
+    Rrob = robustness(hist.reshape(shape[0],shape[1],-1), fut.reshape(shape[0],shape[1],-1))
+    return i0, i1, Rrob.reshape(i1-i0, shape[-1])
+
+
+def banded_KandS(reference_files, projection_files, var, out, outfilen, 
+                 rows, workers=1) :
+    """
+    Compute Knutti robustness index for VAR in REFERENCE_FILES and PROJECTION_FILES 
+    by bands of ROWS latitudes, using a pool of WORKERS processes, and write 
+    dataset OUT, completed with variable KSRI, in file OUTFILEN
+
+    KSRI is first written as a missing field, and each band is then written 
+    in place as soon as it is computed, so that memory use depends on the 
+    band size and not on the grid size 
+    """
+    import netCDF4 
+    import multiprocessing
+    
+    with xr.open_dataset(reference_files[0]) as ref :
+        lat, lon = ref.lat, ref.lon
+        out["KSRI"]= xr.DataArray(np.zeros((lat.size,lon.size))*np.nan,coords=[("lat", lat.values), ("lon", lon.values)])
+        out.to_netcdf(outfilen,encoding={'KSRI': { '_FillValue': 1e+20}})
+    bands= [ (reference_files, projection_files, var, i0, min(i0+rows,lat.size)) 
+             for i0 in range(0, lat.size, rows) ]
+    print("Processing %d bands of %d latitudes with %d workers"%(len(bands),rows,workers))
+    #
+    if workers > 1 :
+        pool=multiprocessing.Pool(workers)
+        results=pool.imap_unordered(band_robustness, bands)
+    else :
+        pool=None
+        results=( band_robustness(band) for band in bands )
+    try :
+        for i0, i1, Rrob in results :
+            with netCDF4.Dataset(outfilen,"a") as nc :
+                nc.variables["KSRI"][i0:i1,:] = np.ma.masked_invalid(Rrob)
+    finally :
+        if pool is not None :
+            pool.close()
+            pool.join()
+
+
+def main(argv) :
+    """
+    Command line interface (see module doc) 
+    """
+    reference_files  = argv[1].split()
+    projection_files = argv[2].split()
+    outfilen         = argv[3]
+    memory  = argv[4] if len(argv) > 4 else os.environ.get("CAMMAC_KS_MEMORY" ,None)
+    workers = argv[5] if len(argv) > 5 else os.environ.get("CAMMAC_KS_WORKERS",1)
+    workers = int(workers)
+
+    # Open files lazily
+    references  = [ xr.open_dataset(f,mask_and_scale=True) for f in reference_files  ]
+    projections = [ xr.open_dataset(f,mask_and_scale=True) for f in projection_files ]
+    #
+    out       = xr.Dataset()
+    out.attrs = projections[0].attrs
+    #
+    reference   = references[0]
+    # Set output variable name
+    if "variable_id" in reference.attrs :
+        out.attrs["variable_id"]="KS_RI(%s)"%reference.attrs["variable_id"]
+    #
+    # Set output coordinate bounds
+    for v in [ "lat_bnds","lon_bnds"] :
+        if v in reference :
+            out[v]=reference[v].load()
+
+    # Also for time (use projections bounds)
+    if "time_bnds" in reference :
+        out["time_bnds"]    = projections[0]["time_bnds"].isel(time=0).load()
+        out["time_bnds"][1] = projections[0]["time_bnds"].isel(time=-1)[1]
+
+    # Compute time instant in the middle of projections time period
+    #t=projections[0]["time"]
+    #out.assign_coords(time=("time",t.isel(time=[t.size/2]).data))
+
+    # identify sole input var
+    allvars= [ var for var in reference.keys() if "_bnds" not in var ]
+    if len(allvars) > 1 :
+        raise ValueError("Too many vars : %s"%allvars)
+    var=allvars[0]
+
+    allmods_hist = [ ref[var]  for ref  in references  ]
+    allmods_fut  = [ proj[var] for proj in projections ]
+    names        = [ proj.attrs.get("source_id",proj.attrs.get("model_id","??")) for proj in projections ]
+
+    rows=reference.lat.size
+    if memory is not None :
+        rows=band_rows(allmods_hist, float(memory)*1.e+6, workers)
+    if rows < reference.lat.size or workers > 1 :
+        check_time_sizes(allmods_hist, allmods_fut, names)
+        for d in references + projections : 
+            d.close()
+        if workers > 1 :
+            rows=min(rows, -(-reference.lat.size // workers))
+        banded_KandS(reference_files, projection_files, var, out, outfilen, rows, workers)
+    else :
+        out["KSRI"]= KandS([ f.load() for f in allmods_hist ], [ f.load() for f in allmods_fut ], names)
+        out.to_netcdf(outfilen,encoding={'KSRI': { '_FillValue': 1e+20}})
+
 
+if __name__ == "__main__" :
+    main(sys.argv)
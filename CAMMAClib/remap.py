@@ -0,0 +1,278 @@
+"""
+Script remap regrids (NetCDF format) files using CDO, with interpolation
+weights which are cached on disk and re-used by all later calls which
+involve the same source grid, target grid and remapping method
+
+Usage : remap --weights_dir DIR [--coarsen FX,FY] METHOD GRID file_in file_out [file_in2 file_out2 ...]
+
+  - METHOD is a CDO remapping operator (such as remapcon or remapdis) ,
+  - GRID is a CDO target grid (such as r360x180, or a filename) ,
+  - DIR is the directory of the weights cache
+
+or : remap --weights_dir DIR [--coarsen FX,FY] --batch LABELS METHOD GRID "files_in" out_1 out_2 ...
+
+  where LABELS is a comma-separated list of labels (one per input file), which
+  must be a subset of `batch_labels`, in the same order; each input file is
+  remapped to the output which rank in `batch_labels` matches its label.
+  The input files, which must be single-record fields on the same grid, are
+  stacked as variables of one file, which is remapped in a single CDO call;
+  the result is then split back, with original variable names and time
+  coordinates
+
+Option --coarsen FX,FY (placed after --weights_dir DIR, and allowed in both
+forms) first coarsens the input fields, which must be on a regular (lat, lon)
+grid, by averaging blocks of FY x FX cells (see `block_average`); the fields
+are then remapped from the coarsened grid. This speeds up, and reduces the
+memory footprint of, remapping from high resolution grids. Value 1,1 means
+no coarsening
+
+Weights are computed by the CDO operator 'gen*' matching METHOD (e.g. gencon
+for remapcon), and applied using CDO operator 'remap'. Weights files are
+keyed by a signature of the source grid description (as provided by 'cdo
+griddes'), a signature of the missing values pattern of the source field
+(on which 'gen*' weights depend, see `mask_signature`), the target grid and
+the method; they are written atomically (see `cache.atomic_write`), so that
+concurrent jobs can share the cache
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import os, os.path, sys, hashlib, subprocess
+
+try :
+    from ensemble_stats import sole_variable
+    from cache import atomic_write
+except ImportError :
+    from CAMMAClib.ensemble_stats import sole_variable
+    from CAMMAClib.cache import atomic_write
+
+
+def grid_signature(filename) :
+    """
+    Returns a signature of the grid of (NetCDF) FILENAME
+    """
+    description=subprocess.check_output(["cdo","-s","griddes",filename])
+    return hashlib.sha1(description).hexdigest()[0:16]
+
+
+def mask_signature(filename) :
+    """
+    Returns a signature of the missing values pattern of the first record
+    of the first variable of (NetCDF) FILENAME, which is the mask used by
+    CDO for generating remapping weights
+    """
+    import numpy as np
+    import xarray as xr
+    with xr.open_dataset(filename) as ds :
+        da=ds[[ v for v in ds.data_vars if "_bnds" not in v ][0]]
+        if "time" in da.dims :
+            da=da.isel(time=0)
+        missing=np.isnan(da.values)
+    return hashlib.sha1(np.packbits(missing).tobytes()).hexdigest()[0:16]
+
+
+def target_signature(grid) :
+    """
+    Returns a signature for CDO target GRID, usable in a filename
+    """
+    if os.path.exists(grid) :
+        grid=os.path.abspath(grid)
+    return hashlib.sha1(grid.encode('utf-8')).hexdigest()[0:16]
+
+
+def weights_file(filename, grid, method, weights_dir) :
+    """
+    Returns the path of the weights file for remapping FILENAME to GRID with
+    CDO operator METHOD, generating it in WEIGHTS_DIR if needed
+    """
+    if not method.startswith("remap") :
+        raise ValueError("Cannot cache weights for remapping method %s"%method)
+    path=os.path.join(weights_dir,"%s_%s_%s_%s.nc"%(method,grid_signature(filename),mask_signature(filename),
+                                                     target_signature(grid)))
+    if not os.path.exists(path) :
+        atomic_write(path,lambda tmp : subprocess.check_call(["cdo","-s","gen%s,%s"%(method[len("remap"):],grid),
+                                                              filename,tmp]))
+    return path
+
+
+def block_average(ds, fx, fy) :
+    """
+    Returns a copy of Dataset DS where all variables with dimensions lat and
+    lon are averaged over blocks of FY latitudes x FX longitudes, with cell
+    area weights and skipping missing values, hence conservatively. Blocks at
+    the grid edges may be incomplete. Coordinates are the mean of block
+    cells coordinates, and bounds span the block cells bounds
+    """
+    import numpy as np
+    import xarray as xr
+    lat=ds["lat"].values
+    lon=ds["lon"].values
+    if "lat_bnds" in ds :
+        lat_bnds=ds["lat_bnds"].values
+    else :
+        edges=np.concatenate(([lat[0]-(lat[1]-lat[0])/2.],(lat[1:]+lat[:-1])/2.,[lat[-1]+(lat[-1]-lat[-2])/2.]))
+        lat_bnds=np.clip(np.stack((edges[:-1],edges[1:]),axis=-1),-90.,90.)
+    if "lon_bnds" in ds :
+        lon_bnds=ds["lon_bnds"].values
+    else :
+        edges=np.concatenate(([lon[0]-(lon[1]-lon[0])/2.],(lon[1:]+lon[:-1])/2.,[lon[-1]+(lon[-1]-lon[-2])/2.]))
+        lon_bnds=np.stack((edges[:-1],edges[1:]),axis=-1)
+    # Cell area is proportional to the product of these weights
+    wlat=np.abs(np.sin(np.deg2rad(lat_bnds[:,1]))-np.sin(np.deg2rad(lat_bnds[:,0])))
+    wlon=np.abs(lon_bnds[:,1]-lon_bnds[:,0])
+    ny=-(-len(lat)//fy)
+    nx=-(-len(lon)//fx)
+
+    def blocks(values, factor, number, fill) :
+        # Pad last axis to NUMBER*FACTOR and reshape it as (NUMBER, FACTOR)
+        pad=number*factor-values.shape[-1]
+        values=np.concatenate((values,np.full(values.shape[:-1]+(pad,),fill)),axis=-1)
+        return values.reshape(values.shape[:-1]+(number,factor))
+
+    def block_means(values, weights, factor, number) :
+        w=blocks(weights,factor,number,0.)
+        return (blocks(values,factor,number,0.)*w).sum(axis=-1)/w.sum(axis=-1)
+
+    out=ds.drop_vars([ v for v in ds.variables if "lat" in ds[v].dims or "lon" in ds[v].dims ])
+    out=out.assign_coords(lat=block_means(lat,wlat,fy,ny),lon=block_means(lon,wlon,fx,nx))
+    out["lat"].attrs=ds["lat"].attrs
+    out["lon"].attrs=ds["lon"].attrs
+    # Block bounds are the outer bounds of its first and last cells
+    firsts=np.arange(ny)*fy
+    out["lat_bnds"]=(("lat","bnds"),np.stack((lat_bnds[firsts,0],
+                                              lat_bnds[np.minimum(firsts+fy,len(lat))-1,1]),axis=-1))
+    firsts=np.arange(nx)*fx
+    out["lon_bnds"]=(("lon","bnds"),np.stack((lon_bnds[firsts,0],
+                                              lon_bnds[np.minimum(firsts+fx,len(lon))-1,1]),axis=-1))
+    out["lat"].attrs["bounds"]="lat_bnds"
+    out["lon"].attrs["bounds"]="lon_bnds"
+    for var in ds.data_vars :
+        da=ds[var]
+        if var in [ "lat_bnds", "lon_bnds" ] or "lat" not in da.dims or "lon" not in da.dims :
+            continue
+        others=[ d for d in da.dims if d not in [ "lat", "lon" ] ]
+        data=da.transpose(*(others+[ "lat", "lon" ])).values.astype(np.float64)
+        valid=~np.isnan(data)
+        # Weights of valid cells, with shape (..., lat, lon)
+        w=valid*wlat[:,None]*wlon[None,:]
+        values=np.where(valid,data,0.)*w
+        # Sum over longitude blocks, then over latitude blocks
+        sums  =blocks(np.swapaxes(blocks(values,fx,nx,0.).sum(axis=-1),-1,-2),fy,ny,0.).sum(axis=-1)
+        wsums =blocks(np.swapaxes(blocks(w     ,fx,nx,0.).sum(axis=-1),-1,-2),fy,ny,0.).sum(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means=np.swapaxes(sums/wsums,-1,-2)
+        means[np.swapaxes(wsums,-1,-2) == 0]=np.nan
+        out[var]=xr.DataArray(means.astype(da.dtype),dims=others+[ "lat", "lon" ],
+                              attrs=da.attrs).transpose(*da.dims)
+        out[var].encoding.update((k,v) for k,v in da.encoding.items() if k in [ "_FillValue", "missing_value", "dtype" ])
+    return out
+
+
+def coarsened(filename, coarsening, tmp_dir=None) :
+    """
+    Returns the name of a temporary file holding the content of FILENAME
+    coarsened by COARSENING (a pair (FX,FY), see `block_average`), or
+    FILENAME itself if COARSENING is (1,1)
+    """
+    import xarray as xr
+    fx,fy=coarsening
+    if (fx,fy) == (1,1) :
+        return filename
+    if tmp_dir is None :
+        tmp_dir=os.path.dirname(os.path.abspath(filename))
+    tmp=os.path.join(tmp_dir,"%s.coarse%d.nc"%(os.path.basename(filename),os.getpid()))
+    with xr.open_dataset(filename) as ds :
+        ds.load()
+    block_average(ds,fx,fy).to_netcdf(tmp)
+    return tmp
+
+
+#: Labels of the fields which can be remapped in a batch, in the order of outputs
+batch_labels=[ "change", "reference", "projection", "rchange", "schange" ]
+
+
+def remap_batch(files, outputs, grid, method, weights_dir, coarsening=(1,1)) :
+    """
+    Remap FILES to GRID with METHOD in a single CDO call, writing results
+    in OUTPUTS (see module doc). Fields are first coarsened by COARSENING
+    (see `block_average`)
+    """
+    import xarray as xr
+    inputs=[]
+    for f in files :
+        with xr.open_dataset(f) as ds :
+            ds.load()
+            if ds["time"].size != 1 :
+                raise ValueError("Cannot remap a multi-record file in a batch : %s"%f)
+            inputs.append(ds)
+    first=inputs[0]
+    var=sole_variable(first)
+    stacked=first.rename({var:"v0"})
+    for i,ds in enumerate(inputs[1:],start=1) :
+        v=sole_variable(ds)
+        stacked["v%d"%i]=(first[var].dims,ds[v].values,ds[v].attrs)
+        stacked["v%d"%i].encoding.update(ds[v].encoding)
+    if tuple(coarsening) != (1,1) :
+        stacked=block_average(stacked,*coarsening)
+    tmp_in ="%s.stack%d.nc"%(outputs[0],os.getpid())
+    tmp_out="%s.stack_remapped%d.nc"%(outputs[0],os.getpid())
+    stacked.to_netcdf(tmp_in)
+    try :
+        weights=weights_file(tmp_in,grid,method,weights_dir)
+        subprocess.check_call(["cdo","-s","-O","remap,%s,%s"%(grid,weights),tmp_in,tmp_out])
+        with xr.open_dataset(tmp_out) as remapped :
+            remapped.load()
+    finally :
+        for f in [ tmp_in, tmp_out ] :
+            if os.path.exists(f) :
+                os.remove(f)
+    others=[ "v%d"%i for i in range(len(inputs)) ]
+    for i,(ds,out) in enumerate(zip(inputs,outputs)) :
+        v=sole_variable(ds)
+        result=remapped.drop_vars([ o for o in others if o != "v%d"%i ]).rename({"v%d"%i:v})
+        result=result.assign_coords(time=ds["time"].values)
+        if "time_bnds" in ds and "time_bnds" in result :
+            result["time_bnds"].values[...]=ds["time_bnds"].values
+        result[v].attrs=ds[v].attrs
+        result.to_netcdf(out)
+
+
+def main(argv) :
+    """
+    Command line interface (see module doc)
+    """
+    args=argv[1:]
+    if args[0] != "--weights_dir" :
+        raise ValueError("Usage : remap --weights_dir DIR [--coarsen FX,FY] METHOD GRID file_in file_out [file_in2 file_out2 ...]")
+    weights_dir=args[1]
+    args=args[2:]
+    coarsening=(1,1)
+    batch=None
+    while args[0].startswith("--") :
+        if args[0] == "--coarsen" :
+            coarsening=tuple(int(v) for v in args[1].split(","))
+        elif args[0] == "--batch" :
+            batch=args[1].split(",")
+        else :
+            raise ValueError("Unknown option %s for remap"%args[0])
+        args=args[2:]
+    if batch is not None :
+        method,grid,files,outputs=args[0],args[1],args[2].split(),args[3:]
+        if len(batch) != len(files) :
+            raise ValueError("remap : %d labels for %d files"%(len(batch),len(files)))
+        remap_batch(files,[ outputs[batch_labels.index(l)] for l in batch ],grid,method,weights_dir,coarsening)
+        return
+    if len(args) < 4 or len(args) % 2 != 0 :
+        raise ValueError("Usage : remap --weights_dir DIR [--coarsen FX,FY] METHOD GRID file_in file_out [file_in2 file_out2 ...]")
+    method,grid=args[0:2]
+    for file_in, file_out in zip(args[2::2], args[3::2]) :
+        source=coarsened(file_in,coarsening,os.path.dirname(os.path.abspath(file_out)))
+        try :
+            weights=weights_file(source,grid,method,weights_dir)
+            subprocess.check_call(["cdo","-s","-O","remap,%s,%s"%(grid,weights),source,file_out])
+        finally :
+            if source != file_in :
+                os.remove(source)
+
+
+if __name__ == "__main__" :
+    main(sys.argv)
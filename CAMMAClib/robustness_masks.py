@@ -0,0 +1,107 @@
+"""
+Script robustness_masks computes in one pass, from ensembles of (NetCDF format)
+per-model fields on a common grid, the fraction of models agreeing on sign
+of change and the masks of the AR5 and AR6 robustness schemes (see
+`variability.stippling_hatching_masks_AR5` and
+`variability.lowchange_conflict_masks_AR6`, which results are reproduced)
+
+Usage :
+
+  robustness_masks [options] "change_files" "variability_files" "nchange_files" \\
+          out_agree out_medvar out_stippling out_hatching [ out_agreelow out_lowchange out_conflict ]
+
+  where :
+
+    - change files are the per-model changes (possibly standardized),
+    - variability files are the per-model multi-decadal variabilities,
+    - nchange files are the per-model changes normalized by their own
+      variability; they are optional (use an empty string), and the AR6 outputs
+      (last three ones) are then not produced
+
+  and options are (with default values) :
+
+    --low_change_agree_threshold 1.645 : threshold on abs(nchange) for a low change
+    --fraction_on_magnitude      0.33  : fraction of models agreeing on a low change, for AR6 lowchange
+    --fraction_on_sign           0.8   : fraction of models agreeing on sign, for AR6 conflict
+    --stippling_fraction         0.9   : fraction of models agreeing on sign, for AR5 stippling
+
+Masks have values 1 or 0, or are missing where CDO would produce a missing
+value. The ensemble median of variabilities is also output (using CDO's
+nearest rank method, see module `ensemble_stats`)
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import sys
+
+from ensemble_stats import load_ensemble, ensemble_statistics, percentile_nrank, write_like
+
+
+def compare(a, b, op) :
+    """
+    Returns a 0/1 float array for comparison OP between arrays A and B, which
+    is NaN where A or B is NaN (as for CDO comparison operators)
+    """
+    with np.errstate(invalid='ignore'):
+        rep=op(a,b).astype(np.float64)
+    rep[np.isnan(a) | np.isnan(b)]=np.nan
+    return rep
+
+
+def robustness_masks(changes, variabilities, nchanges=None, low_change_agree_threshold=1.645,
+                     fraction_on_magnitude=0.33, fraction_on_sign=0.8, stippling_fraction=0.9) :
+    """
+    Returns a dict of fields computed from (member,...) arrays CHANGES,
+    VARIABILITIES and (optionally) NCHANGES : agree (fraction of models
+    agreeing on sign of change), medvar (median variability), stippling and
+    hatching (AR5 scheme) and, if NCHANGES is not None, agreelow (fraction
+    of models agreeing on a low change), lowchange and conflict (AR6 scheme)
+    """
+    stats=ensemble_statistics(changes)
+    agree=stats["agree"]
+    abs_change=np.abs(stats["mean"])
+    medvar=percentile_nrank(variabilities,50)
+    rep=dict(agree=agree, medvar=medvar)
+    #
+    # AR5
+    masku=compare(agree,stippling_fraction,np.greater_equal)
+    rep["hatching"]=compare(abs_change,medvar,np.less)
+    rep["stippling"]=np.minimum(compare(abs_change,2*medvar,np.greater_equal),masku)
+    #
+    # AR6
+    if nchanges is not None :
+        nb=nchanges.shape[0]
+        valid=(~np.isnan(nchanges)).sum(axis=0)
+        with np.errstate(invalid='ignore'):
+            agreelow=(np.abs(nchanges) <= low_change_agree_threshold).sum(axis=0)/float(nb)
+        agreelow[valid==0]=np.nan
+        lowchange=compare(agreelow,fraction_on_magnitude,np.greater_equal)
+        sign_low_agree=compare(agree,fraction_on_sign,np.less)
+        # CDO ifnotthen : second field where first one is 0, missing elsewhere
+        conflict=np.where(lowchange == 0, sign_low_agree, np.nan)
+        rep.update(agreelow=agreelow, lowchange=lowchange, conflict=conflict)
+    return rep
+
+
+def main(argv) :
+    """
+    Command line interface (see module doc)
+    """
+    args=argv[1:]
+    options=dict()
+    while args[0].startswith("--") :
+        options[args[0][2:]]=float(args[1])
+        args=args[2:]
+    template,changes=load_ensemble(args[0].split())
+    _,variabilities=load_ensemble(args[1].split())
+    nchanges=None
+    if args[2].strip() != "" :
+        _,nchanges=load_ensemble(args[2].split())
+    masks=robustness_masks(changes,variabilities,nchanges,**options)
+    keys=[ "agree", "medvar", "stippling", "hatching", "agreelow", "lowchange", "conflict" ]
+    for key,filename in zip(keys,args[3:]) :
+        write_like(template,masks[key],filename)
+
+
+if __name__ == "__main__" :
+    main(sys.argv)
@@ -0,0 +1,436 @@
+"""
+Script series computes statistics over time windows of the time series
+of its (NetCDF format) input file, which is assumed to be single-variable
+
+Usage :
+
+  series --slices BEGIN,NYEARS,NUMBER[,STEP] file_in file_out
+
+    computes the means over windows of NYEARS years, the first one beginning
+    with year BEGIN, and the following ones beginning every STEP years
+    (default : NYEARS, i.e. NUMBER contiguous slices), within the period of
+    NUMBER*NYEARS years beginning with BEGIN. The input must have at least
+    one record per year (such as annual or seasonal means), and the output
+    has one record per window. Records are assigned to windows by their
+    year, as with CDO's seldate : e.g. the lone December which ends CDO's
+    'selseason,DJF -seasmean' output is a record of the last window
+
+  series --detrend file_in file_out [file_intercept file_slope]
+
+    removes the least-squares linear trend of the series, but not its mean
+    value (i.e. computes x - b*t, where t is the record index), and optionally
+    writes the trend coefficients a and b (x ~ a + b*t); this is the same
+    as CDO operators 'trend' and 'subtrend' with a zero intercept
+
+  series --iav FACTOR [--slices BEGIN,NYEARS,NUMBER[,STEP]] file_in file_out
+
+    computes the standard deviation (with ddof=1) of the linearly detrended
+    series, multiplied by FACTOR (the inter-annual variability); with
+    option --slices, this is done separately for each window (see above),
+    in a single batch
+
+  series --walsh THRESHOLD file_in file_out
+
+    computes, for each year of a series of monthly means of precipitation
+    (flux), Walsh (1981) seasonality index SIi, i.e. the sum on the months
+    of the year of the absolute value of the fraction of the annual rain
+    occurring in the month minus 1/12; the annual rain is 12 times the mean
+    of monthly values weighted by days per month (as for CDO's
+    yearmonmean), and the index is missing where the annual rain is lower
+    than THRESHOLD. The output has one record per year
+
+  series --seasons file_in out_ann out_djf out_mam out_jja out_son
+
+    computes the time means of the annual means and of the means of each
+    season (DJF, MAM, JJA and SON), i.e. the same as CDO's 'yearmean' or
+    'selseason,<season> -seasmean' followed by 'timmean', for all seasons
+    at once; incomplete seasons (such as a first DJF without December)
+    are averaged, as CDO does
+
+The data for the whole period is read once. Window means and inter-annual
+variabilities are computed using prefix sums along time. Trends use the closed-form
+least-squares solution. Missing values are skipped, as with CDO's timmean
+and trend. Functions `prefix_statistics` and `window_statistics` provide
+the mean and (detrended) standard deviation of any window of a series in
+constant time, from running sums
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import xarray as xr
+import numpy as np
+import sys
+
+try :
+    from ensemble_stats import sole_variable
+except ImportError :
+    from CAMMAClib.ensemble_stats import sole_variable
+
+
+def window_starts(length, nyears, step) :
+    """
+    Returns the list of start offsets of the windows of NYEARS years
+    which begin every STEP years in a period of LENGTH years
+    """
+    return list(range(0, length-nyears+1, step))
+
+
+def window_means(data, starts, stops) :
+    """
+    Returns the means of array DATA along its first axis, over windows of
+    records STARTS[i] to STOPS[i]-1 (see `window_ranges`), skipping NaNs.
+    Result has one record per window
+    """
+    valid=~np.isnan(data)
+    values=np.where(valid,data,0.).astype(np.float64)
+    zero=np.zeros((1,)+data.shape[1:])
+    csums  =np.concatenate((zero,np.cumsum(values,axis=0,dtype=np.float64)))
+    ccounts=np.concatenate((zero,np.cumsum(valid ,axis=0)))
+    sums  =csums  [stops]-csums  [starts]
+    counts=ccounts[stops]-ccounts[starts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums/counts
+
+
+def ols_trend(data) :
+    """
+    Returns the least-squares estimates (a, b) of the linear trend x ~ a + b*t
+    of array DATA along its first axis, where t is the record index,
+    skipping NaNs
+    """
+    valid=~np.isnan(data)
+    values=np.where(valid,data,0.).astype(np.float64)
+    t=np.arange(data.shape[0],dtype=np.float64).reshape((-1,)+(1,)*(data.ndim-1))
+    tv=np.where(valid,t,0.)
+    n  =valid.sum(axis=0)
+    st =tv.sum(axis=0)
+    stt=(tv*tv).sum(axis=0)
+    sx =values.sum(axis=0)
+    stx=(tv*values).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        b=(n*stx - st*sx)/(n*stt - st*st)
+        a=(sx - b*st)/n
+    return a, b
+
+
+def detrended(data, slope=None) :
+    """
+    Returns array DATA minus its linear trend along first axis, but keeping
+    its mean value (i.e. x - b*t). SLOPE (b), if not provided, is computed
+    by `ols_trend`
+    """
+    if slope is None :
+        _,slope=ols_trend(data)
+    t=np.arange(data.shape[0],dtype=np.float64).reshape((-1,)+(1,)*(data.ndim-1))
+    return data - slope*t
+
+
+def detrended_std(data) :
+    """
+    Returns the standard deviation (with ddof=1) of the linearly detrended
+    array DATA along its first axis, skipping NaNs
+    """
+    valid=~np.isnan(data)
+    n=valid.sum(axis=0)
+    residuals=detrended(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean=np.nansum(residuals,axis=0)/n
+        return np.sqrt(np.nansum((residuals-mean)**2,axis=0)/(n-1))
+
+
+def windows_iav(data, starts, stops, factor=1.) :
+    """
+    Returns, for each window of records STARTS[i] to STOPS[i]-1 of array
+    DATA (see `window_ranges`), the standard deviation of the detrended data
+    (as `detrended_std` does) multiplied by FACTOR. All windows are
+    processed in one batch, using running sums (see `prefix_statistics`)
+    """
+    prefix=prefix_statistics(data)
+    return factor*np.array([ window_statistics(prefix,start,stop)["detrended_std"]
+                             for start,stop in zip(starts,stops) ])
+
+
+def walsh_seasonality(data, years, days, threshold) :
+    """
+    Returns Walsh's seasonality index for each year of array DATA of monthly
+    precipitation (along first axis), with one record per year. YEARS
+    and DAYS are the year and number of days of each record. The annual rain
+    (12 times the days-weighted mean over the year, skipping NaNs) is masked
+    where lower than THRESHOLD
+    """
+    # Records of each year are contiguous : process years as blocks
+    starts=np.concatenate(([0],np.nonzero(np.diff(years))[0]+1))
+    index=np.cumsum(np.concatenate(([0],np.diff(years) != 0)))
+    valid=~np.isnan(data)
+    days=days.reshape((-1,)+(1,)*(data.ndim-1)).astype(np.float64)
+    weights=np.where(valid,days,0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        annual=12.*np.add.reduceat(np.where(valid,data,0.)*days,starts,axis=0)/\
+            np.add.reduceat(weights,starts,axis=0)
+        annual[~(annual >= threshold)]=np.nan
+        deviations=np.abs(data/annual[index] - 1./12.)
+    rep=np.add.reduceat(np.where(np.isnan(deviations),0.,deviations),starts,axis=0)
+    rep[np.add.reduceat(~np.isnan(deviations),starts,axis=0) == 0]=np.nan
+    return rep
+
+
+def walsh_dataset(ds, threshold) :
+    """
+    Returns a Dataset with Walsh's seasonality index (see `walsh_seasonality`)
+    for each year of monthly dataset DS, dated (as CDO yearly statistics
+    do) by the last record of the year, and with time bounds spanning the year
+    """
+    var=sole_variable(ds)
+    da=ds[var]
+    axis_num=da.get_axis_num("time")
+    years=ds["time"].dt.year.values
+    days=ds["time"].dt.days_in_month.values
+    values=walsh_seasonality(np.moveaxis(da.values,axis_num,0),years,days,threshold)
+    lasts=np.concatenate((np.nonzero(np.diff(years))[0],[len(years)-1]))
+    firsts=np.concatenate(([0],lasts[:-1]+1))
+    out=ds.isel(time=lasts)
+    out[var]=out[var].copy(data=np.moveaxis(values,0,axis_num).astype(da.dtype))
+    if "time_bnds" in ds :
+        out["time_bnds"].values[:,0]=ds["time_bnds"].values[firsts,0]
+    return out
+
+
+#: Months of the seasons processed by `seasons_means`
+season_months={ "ann" : list(range(1,13)), "DJF" : [12,1,2], "MAM" : [3,4,5], "JJA" : [6,7,8], "SON" : [9,10,11] }
+
+
+def groups_means(data, labels) :
+    """
+    Returns the means of array DATA along first axis over the groups of
+    consecutive records which have the same value in array LABELS,
+    skipping NaNs; result has one record per group
+    """
+    starts=np.concatenate(([0],np.nonzero(np.diff(labels))[0]+1))
+    valid=~np.isnan(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.add.reduceat(np.where(valid,data,0.),starts,axis=0)/np.add.reduceat(valid,starts,axis=0)
+
+
+def season_mean(data, years, months, season) :
+    """
+    Returns the mean over the occurrences of SEASON (a key of `season_months`)
+    of the seasonal (or annual) means of array DATA (along first axis), which
+    records have YEARS and MONTHS; December is counted in next year's DJF
+    """
+    selected=np.isin(months,season_months[season])
+    labels=years[selected]+((months[selected] == 12) & (season == "DJF"))
+    means=groups_means(data[selected],labels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nansum(means,axis=0)/(~np.isnan(means)).sum(axis=0)
+
+
+def seasons_means(ds) :
+    """
+    Returns a list of Datasets with the time mean of the annual means and
+    of the seasonal means of the sole variable of DS, for seasons ann,
+    DJF, MAM, JJA and SON (see `season_mean`)
+    """
+    years=ds["time"].dt.year.values
+    months=ds["time"].dt.month.values
+    return [ time_reduce(ds, lambda data : season_mean(data,years,months,season))
+             for season in [ "ann", "DJF", "MAM", "JJA", "SON" ] ]
+
+
+def prefix_statistics(data) :
+    """
+    Returns the running sufficient statistics of array DATA along its first
+    axis, as a dict of arrays with one more record than DATA (record i
+    accumulating records 0 to i-1), skipping NaNs : n (count), s and ss (sums
+    of x and x*x), st, stt and stx (sums of t, t*t and t*x, where t is the
+    record index). Data is centered beforehand, for accuracy; this does not
+    change the statistics computed by `window_statistics`
+    """
+    valid=~np.isnan(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        center=np.where(valid,data,0.).sum(axis=0,dtype=np.float64)/valid.sum(axis=0)
+    x=np.where(valid,data-center,0.).astype(np.float64)
+    t=np.arange(data.shape[0],dtype=np.float64).reshape((-1,)+(1,)*(data.ndim-1))
+    t=np.where(valid,t,0.)
+    zero=np.zeros((1,)+data.shape[1:])
+    rep=dict()
+    for key,values in [ ("n",valid), ("s",x), ("ss",x*x), ("st",t), ("stt",t*t), ("stx",t*x) ] :
+        rep[key]=np.concatenate((zero,np.cumsum(values,axis=0,dtype=np.float64)))
+    rep["center"]=center
+    return rep
+
+
+def window_statistics(prefix, start, stop) :
+    """
+    Returns a dict of statistics for records START to STOP-1 of a series,
+    computed in constant time from its PREFIX statistics (see
+    `prefix_statistics`) : mean, std (with ddof=1) and detrended_std (the
+    standard deviation, with ddof=1, of the series minus its least-squares
+    linear trend, as computed by `detrended_std`)
+    """
+    n,s,ss,st,stt,stx=[ prefix[k][stop]-prefix[k][start] for k in [ "n","s","ss","st","stt","stx" ] ]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sxx=ss-s*s/n
+        stt_c=stt-st*st/n
+        stx_c=stx-st*s/n
+        return dict(mean=s/n+prefix["center"],
+                    std=np.sqrt(np.maximum(sxx,0.)/(n-1)),
+                    detrended_std=np.sqrt(np.maximum(sxx-stx_c*stx_c/stt_c,0.)/(n-1)))
+
+
+def period_indices(years, begin, length) :
+    """
+    Returns the indices in array YEARS (which must be sorted) of the records
+    of the LENGTH years beginning with year BEGIN, checking that each year
+    has at least one record (some years may have more, such as the year of
+    the lone December which ends CDO's DJF seasonal means)
+    """
+    indices=np.nonzero((years >= begin) & (years < begin+length))[0]
+    missing=np.setdiff1d(np.arange(begin,begin+length),years[indices])
+    if len(missing) > 0 :
+        raise ValueError("Expected at least one record per year for %d-%d, none for %s"%
+                         (begin,begin+length-1,missing.tolist()))
+    return indices
+
+
+def window_ranges(years, begin, nyears, number, step=None) :
+    """
+    Returns the arrays of first indices and of last indices plus one, in
+    array YEARS (which must be sorted), of the records of each window of
+    NYEARS years beginning every STEP years (default : NYEARS), the first one
+    beginning with year BEGIN, within the period of NUMBER*NYEARS years
+    """
+    if step is None :
+        step=nyears
+    firsts=np.array([ begin+s for s in window_starts(nyears*number,nyears,step) ])
+    return np.searchsorted(years,firsts,side="left"), np.searchsorted(years,firsts+nyears,side="left")
+
+
+def windows_reduce(ds, func, begin, nyears, number, step=None) :
+    """
+    Returns a Dataset with the result of FUNC applied to the data of the
+    sole variable of dataset DS over period of NUMBER*NYEARS years beginning
+    with year BEGIN (with time as first axis), and to the arrays of first
+    and last plus one records of each window of NYEARS years beginning every
+    STEP years (default : NYEARS), see `window_ranges`. FUNC must return one
+    record per window, and the Dataset has the time coordinates and bounds
+    of these windows
+    """
+    var=sole_variable(ds)
+    da=ds[var]
+    axis_num=da.get_axis_num("time")
+    #
+    years=ds["time"].dt.year.values
+    indices=period_indices(years, begin, nyears*number)
+    data=np.moveaxis(da.values,axis_num,0)[indices]
+    firsts,stops=window_ranges(years[indices], begin, nyears, number, step)
+    values=func(data,firsts,stops)
+    starts=indices[firsts]
+    lasts=indices[stops-1]
+    #
+    out = xr.Dataset()
+    out.attrs=ds.attrs
+    for v in [ "lat_bnds","lon_bnds"] :
+        if v in ds :
+            out[v]=ds[v]
+    others=[ d for d in da.dims if d != "time" ]
+    middles=[ ds["time"].values[(s+l+1)//2] for s,l in zip(starts,lasts) ]
+    out[var]=xr.DataArray(values.astype(da.dtype),
+                          coords=[ ("time", middles) ] + [ (d, da[d].values) for d in others ],
+                          attrs=da.attrs)
+    if "time_bnds" in ds :
+        bnds=[ [ ds["time_bnds"].values[s][0], ds["time_bnds"].values[l][1] ] for s,l in zip(starts,lasts) ]
+        out["time_bnds"]=xr.DataArray(np.array(bnds),dims=("time",ds["time_bnds"].dims[-1]))
+    return out
+
+
+def slices_means(ds, begin, nyears, number, step=None) :
+    """
+    Returns a Dataset with the window means (see `window_means`) of the sole
+    variable of dataset DS over period of NUMBER*NYEARS years beginning with
+    year BEGIN, with one record (and time bounds) per window
+    """
+    return windows_reduce(ds, window_means, begin, nyears, number, step)
+
+
+def time_reduce(ds, func) :
+    """
+    Returns a Dataset with the result of FUNC applied to the data of the
+    sole variable of dataset DS (with time as first axis), as a single
+    record located in the middle of the time period
+    """
+    var=sole_variable(ds)
+    da=ds[var]
+    data=np.moveaxis(da.values,da.get_axis_num("time"),0)
+    t=ds["time"]
+    out=ds.isel(time=[t.size//2])
+    out[var]=out[var].copy(data=np.expand_dims(func(data),da.get_axis_num("time")).astype(da.dtype))
+    if "time_bnds" in ds :
+        out["time_bnds"].values[0,1]=ds["time_bnds"].values[-1][1]
+        out["time_bnds"].values[0,0]=ds["time_bnds"].values[0][0]
+    return out
+
+
+def detrend_dataset(ds) :
+    """
+    Returns a triplet of datasets for the sole variable of DS : the
+    detrended data (keeping the mean), the trend intercept and the trend slope
+    """
+    var=sole_variable(ds)
+    da=ds[var]
+    axis_num=da.get_axis_num("time")
+    data=np.moveaxis(da.values,axis_num,0)
+    intercept,slope=ols_trend(data)
+    out=ds.copy()
+    out[var]=da.copy(data=np.moveaxis(detrended(data,slope),0,axis_num).astype(da.dtype))
+    return out, time_reduce(ds,lambda d : intercept), time_reduce(ds,lambda d : slope)
+
+
+def main(argv) :
+    """
+    Command line interface (see module doc)
+    """
+    args=argv[1:]
+    slices=None
+    factor=None
+    detrend=False
+    walsh=None
+    seasons=False
+    while args[0].startswith("--") :
+        if args[0] == "--slices" :
+            slices=[ int(v) for v in args[1].split(",") ]
+            args=args[2:]
+        elif args[0] == "--iav" :
+            factor=float(args[1])
+            args=args[2:]
+        elif args[0] == "--detrend" :
+            detrend=True
+            args=args[1:]
+        elif args[0] == "--walsh" :
+            walsh=float(args[1])
+            args=args[2:]
+        elif args[0] == "--seasons" :
+            seasons=True
+            args=args[1:]
+        else :
+            raise ValueError("Unknown option %s for series"%args[0])
+    with xr.open_dataset(args[0]) as ds :
+        ds.load()
+        if detrend :
+            outs=detrend_dataset(ds)
+        elif walsh is not None :
+            outs=[ walsh_dataset(ds,walsh) ]
+        elif seasons :
+            outs=seasons_means(ds)
+        elif factor is not None and slices is not None :
+            outs=[ windows_reduce(ds, lambda data,starts,stops : windows_iav(data,starts,stops,factor), *slices) ]
+        elif factor is not None :
+            outs=[ time_reduce(ds, lambda data : factor*detrended_std(data)) ]
+        elif slices is not None :
+            outs=[ slices_means(ds,*slices) ]
+        else :
+            raise ValueError("series needs one of options --slices, --detrend, --iav, --walsh, --seasons")
+        for out,filename in zip(outs,args[1:]) :
+            out.to_netcdf(filename)
+
+
+if __name__ == "__main__" :
+    main(sys.argv)
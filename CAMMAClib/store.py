@@ -0,0 +1,244 @@
+"""
+A store of yearly seasonal means, materialized once from the monthly data of
+the entries of a data versions dictionary (see e.g. `changes.change_fields`
+for its structure), and then read instead of the monthly data, which is much
+larger, by `variability.variability_AR5`, for piControl entries, and by
+`changes.change_fields`, for historical and scenario entries (which time
+means for any period are then computed by slicing the store). The
+inter-annual variability of `variability.control_inter_annual_variability`
+does not use the store, because it detrends the monthly data :
+
+  - for each (experiment, variable, table, model, realization) entry, the store
+    holds one file per season (ANN, MAM, JJA and SON), with one record
+    per year, on the native grid; records are seasonal (or annual) means,
+    computed as CDO's 'seasmean' (or 'yearmean') would do, and dated as CDO
+    does, i.e. by their last month,
+  - data is stored as float32, compressed (NetCDF4/zlib),
+  - files are built using `build`, which reads the monthly data only once for
+    all seasons, one file at a time, and are written atomically (see
+    `cache.atomic_write`),
+  - `seasonal_field` provides the CliMAF object for a stored entry, season and
+    period, or None if the entry is not in the store
+
+Seasons which cross a year boundary (DJF) are not stored : the DJF means
+which CDO computes from the monthly data of a period include a first partial
+season (January and February) and a lone December, which cannot be derived
+from means of complete seasons; using the store would then change results
+
+The store is located in directory `store_root`, which can be set using
+environment variable CAMMAC_STORE; the store is not used when it is None.
+
+Detrended versions are not stored, because detrending depends on the sampled
+period; detrending the stored yearly series (e.g. with operator
+'ols_detrend', see `variability.init_series`) is cheap
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import os, os.path
+
+from CAMMAClib.cache import atomic_write
+
+#: Root directory of the store (default : environment variable CAMMAC_STORE).
+#: The store is not used when it is None
+store_root=os.environ.get("CAMMAC_STORE",None)
+
+#: Seasons of the store, with their months; they must not cross a year
+#: boundary (see module doc)
+store_seasons={ "ANN" : list(range(1,13)), "MAM" : [3,4,5], "JJA" : [6,7,8], "SON" : [9,10,11] }
+
+#: Aliases for season names
+season_aliases={ "ann" : "ANN", "anm" : "ANN" }
+
+
+def store_path(root, project, experiment, model, realization, variable, table, version, grid, season) :
+    """
+    Returns the path in store ROOT of the file for an entry and a SEASON
+    """
+    season=season_aliases.get(season,season)
+    name="%s_%s_%s_%s_%s_%s_%s_%s.nc"%(variable,table,model,experiment,realization,grid,version,season)
+    return os.path.join(root,project,experiment,variable,table,model,name)
+
+
+def seasonal_field(project, experiment, model, realization, variable, table, version, grid,
+                   season, period, root=None) :
+    """
+    Returns a CliMAF object for the yearly means of SEASON for an entry of
+    the store located in ROOT (default : `store_root`), restricted to PERIOD
+    (a CliMAF period string, such as '1950-1969'), or None if the store
+    does not include that entry or that season (e.g. DJF, see module doc)
+    """
+    if root is None :
+        root=store_root
+    if root is None or season_aliases.get(season,season) not in store_seasons :
+        return None
+    path=store_path(root, project, experiment, model, realization, variable, table, version, grid, season)
+    if not os.path.exists(path) :
+        return None
+    from climaf.api import fds
+    return fds(path, variable=variable, period=period)
+
+
+def first_time(filename) :
+    """
+    Returns the first time value of FILENAME, used for ordering files
+    """
+    import xarray as xr
+    with xr.open_dataset(filename) as ds :
+        return ds["time"].values[0]
+
+
+def seasonal_means(files, variable) :
+    """
+    Returns a triplet : a template Dataset (the first of FILES, without time
+    dependent variables), the list of non-time dimensions of VARIABLE, and a
+    dict which keys are the seasons of `store_seasons` and values are lists
+    of tuples (time, time bounds or None, mean field), one per season
+    occurrence, for VARIABLE in (monthly) FILES. Files are read one at a
+    time; occurrences which span several files are handled
+    """
+    import numpy as np
+    import xarray as xr
+    files=sorted(files, key=first_time)
+    rep=dict((season,[]) for season in store_seasons)
+    # Per season : [ label, sums, counts, first bound, last time, last bound ] of current occurrence
+    pending=dict((season,None) for season in store_seasons)
+    template=None
+    for f in files :
+        with xr.open_dataset(f) as ds :
+            if template is None :
+                template=ds.drop_vars([ v for v in ds.variables if "time" in ds[v].dims ]).load()
+                dims=[ d for d in ds[variable].dims if d != "time" ]
+            times=ds["time"].values
+            bounds=ds["time_bnds"].values if "time_bnds" in ds else None
+            years=ds["time"].dt.year.values
+            months=ds["time"].dt.month.values
+            data=ds[variable].transpose(*(["time"]+dims)).values.astype(np.float64)
+        valid=~np.isnan(data)
+        values=np.where(valid,data,0.)
+        for season,season_months in store_seasons.items() :
+            selected=np.nonzero(np.isin(months,season_months))[0]
+            if len(selected) == 0 :
+                continue
+            labels=years[selected]
+            starts=np.concatenate(([0],np.nonzero(np.diff(labels))[0]+1))
+            ends=np.concatenate((starts[1:],[len(selected)]))
+            sums  =np.add.reduceat(values[selected],starts,axis=0)
+            counts=np.add.reduceat(valid [selected],starts,axis=0)
+            for i,(start,end) in enumerate(zip(starts,ends)) :
+                first,last=selected[start],selected[end-1]
+                occurrence=[ labels[start], sums[i], counts[i],
+                             None if bounds is None else bounds[first][0],
+                             times[last], None if bounds is None else bounds[last][1] ]
+                current=pending[season]
+                if current is not None and current[0] == occurrence[0] :
+                    current[1]=current[1]+occurrence[1]
+                    current[2]=current[2]+occurrence[2]
+                    current[4:]=occurrence[4:]
+                    continue
+                if current is not None :
+                    rep[season].append(finalize(current))
+                pending[season]=occurrence
+    for season in store_seasons :
+        if pending[season] is not None :
+            rep[season].append(finalize(pending[season]))
+    return template, dims, rep
+
+
+def finalize(occurrence) :
+    """
+    Returns tuple (time, time bounds or None, mean field) for an OCCURRENCE
+    accumulated by `seasonal_means`
+    """
+    import numpy as np
+    _,sums,counts,first_bound,time,last_bound=occurrence
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean=sums/counts
+    mean[counts == 0]=np.nan
+    return time, None if first_bound is None else (first_bound,last_bound), mean
+
+
+def materialize(files, variable, paths, attrs=None) :
+    """
+    Compute the yearly seasonal means of VARIABLE in (monthly) FILES and
+    write them, for each season, in file PATHS[season]. ATTRS are the
+    attributes of the variable (default : those in the first file)
+    """
+    import numpy as np
+    import xarray as xr
+    template,dims,means=seasonal_means(files, variable)
+    with xr.open_dataset(sorted(files, key=first_time)[0]) as ds :
+        if attrs is None :
+            attrs=ds[variable].attrs
+        encoding=dict((k,v) for k,v in ds["time"].encoding.items() if k in [ "units", "calendar" ])
+        encoding["dtype"]="float64"
+    for season,path in paths.items() :
+        records=means[season]
+        out=template.copy()
+        out[variable]=xr.DataArray(np.array([ m for _,_,m in records ]).astype(np.float32),
+                                   dims=["time"]+dims,
+                                   coords=dict(time=np.array([ t for t,_,_ in records ])),
+                                   attrs=attrs)
+        if records[0][1] is not None :
+            out["time_bnds"]=xr.DataArray(np.array([ b for _,b,_ in records ]),dims=("time","bnds"))
+            out["time"].attrs["bounds"]="time_bnds"
+        out["time"].encoding.update(encoding)
+        out[variable].encoding.update(zlib=True, complevel=4, _FillValue=np.float32(1.e+20))
+        atomic_write(path,lambda tmp : out.to_netcdf(tmp, format="NETCDF4"))
+
+
+def projection_experiments(data_versions) :
+    """
+    Returns the list of experiments of dict DATA_VERSIONS which are
+    'historical' or a scenario ('ssp*')
+    """
+    return [ e for e in data_versions if e == "historical" or e.startswith("ssp") ]
+
+
+def build(data_versions, experiments=["piControl"], variables=None, tables=None, models=None,
+          project="CMIP6", root=None, overwrite=False) :
+    """
+    Materialize the store located in ROOT (default : `store_root`) for
+    the entries of dict DATA_VERSIONS for EXPERIMENTS, possibly restricted
+    to lists VARIABLES, TABLES and MODELS; the whole data period of each
+    entry is processed. EXPERIMENTS may also be 'projections', which means :
+    historical and all scenarios (see `projection_experiments`). Existing
+    store files are not re-computed, except if OVERWRITE is True. Returns
+    the number of processed entries
+    """
+    if experiments == "projections" :
+        experiments=projection_experiments(data_versions)
+    from climaf.api import ds
+    from CAMMAClib.mips_et_al import institute_for_model, mip_for_experiment
+    if root is None :
+        root=store_root
+    if root is None :
+        raise ValueError("A root directory must be provided for the store")
+    count=0
+    for experiment in experiments :
+        for variable in data_versions[experiment] :
+            if variables is not None and variable not in variables :
+                continue
+            for table in data_versions[experiment][variable] :
+                if tables is not None and table not in tables :
+                    continue
+                for model in data_versions[experiment][variable][table] :
+                    if models is not None and model not in models :
+                        continue
+                    for realization in data_versions[experiment][variable][table][model] :
+                        grid,version,data_period=data_versions[experiment][variable][table][model][realization]
+                        paths=dict((season,store_path(root,project,experiment,model,realization,
+                                                      variable,table,version,grid,season))
+                                   for season in store_seasons)
+                        if not overwrite and all( os.path.exists(p) for p in paths.values() ) :
+                            continue
+                        dic=dict(project=project, experiment=experiment, model=model,
+                                 period=data_period, variable=variable, table=table,
+                                 realization=realization, version=version)
+                        if project == "CMIP6" :
+                            dic.update(institute=institute_for_model(model), grid=grid,
+                                       mip=mip_for_experiment(experiment))
+                        files=ds(**dic).baseFiles().split()
+                        print("Storing %s %s %s %s %s (%d files)"%(experiment,variable,table,model,realization,len(files)))
+                        materialize(files, variable, paths)
+                        count+=1
+    return count
@@ -12,18 +12,23 @@ CAMMAC functions related to variability
 """
 from __future__  import division, print_function , unicode_literals, absolute_import
 
+import os
 from climaf.api import *
+from CAMMAClib.fusion import cfile, ceval, cvalue
 from climaf.period import init_period
 from env.environment import cscripts
 from CAMMAClib.mips_et_al import institute_for_model, table_for_var
+from CAMMAClib.store import seasonal_field
 
 
 def variability_AR5(model,realization,variable,table, data_versions,season="ANN", project="CMIP6", 
                     operator=None, operator_args={},
                     post_operator=None, post_operator_args={},
+                    slices_operator=None, slices_operator_args={},
                     shift=100,nyears=20,number=20,
                     variability=True,
                     compute=True,house_keeping=False,detrend=True,
+                    native=True,step=None,
                     deep=None):
     """
     Compute the variability according to AR5 Box 2.1 : 
@@ -37,6 +42,22 @@ def variability_AR5(model,realization,variable,table, data_versions,season="ANN"
      - build an ensemble representing the samples (NUMBER * NYEARS)
      - transform each member's result using POST_OPERATOR and POST_OPERATOR_ARGS (default 
        is to compute a time average)
+     - or, if SLICES_OPERATOR is provided, rather use it for computing that 
+       transform on all samples in a single call : it is called on the whole 
+       data with SLICES_OPERATOR_ARGS and args 'begin', 'nyears' and 'number', 
+       and must return a field with one record per sample (see e.g. operator 
+       'gini_slices' in module `cancillary`)
+     - if neither POST_OPERATOR nor SLICES_OPERATOR is provided, NATIVE is
+       True (the default) and VARIABILITY is True, the samples time means
+       are computed in a single call, which reads the data once (see
+       operator 'slices_means' and module `series`); arg STEP (in years) then
+       allows to use overlapping samples of NYEARS years, which begin every
+       STEP years, for a more robust estimate (STEP is not used otherwise)
+     - with NATIVE True, detrending is also done in a single call (see
+       operator 'ols_detrend' in `init_series`)
+     - if no OPERATOR is provided and the store of yearly seasonal means
+       includes the piControl data (see module `store`), the yearly means
+       are read in the store rather than computed from monthly data
      - if arg VARIABILITY is False , returns that result (i.e. by defaut the time mean),
      - otherwise computes and returns the variability as the ensemble standard deviation 
        multiplied by square root of 2
@@ -45,7 +66,8 @@ def variability_AR5(model,realization,variable,table, data_versions,season="ANN"
     SHIFT may be relaxed, because they are supposed to be already in a balanced state 
     from the start of published piControl data
 
-    The returned value is a CliMAF object (either a field or an ensemble, depending on VARIABILITY)
+    The returned value is a CliMAF object (either a field or an ensemble, depending on VARIABILITY; 
+    when using SLICES_OPERATOR, the latter is replaced by a field with one record per sample)
 
     Arg COMPUTE, if set to True, drives an immediate lauch of the computation, of CliMAF object, 
     and then, if arg DEEP is True, re-compute all results from scratch, without using CliMAF cached
@@ -101,7 +123,13 @@ def variability_AR5(model,realization,variable,table, data_versions,season="ANN"
     dat=basic
 
     # Implement the operation if required, otherwise seasonal or yearly average
+    stored=None
     if operator is None :
+        stored=seasonal_field(project,"piControl",model,realization,variable,table,version,grid,
+                              season,period)
+    if stored is not None :
+        dat_op=stored
+    elif operator is None :
         if season in [ "ann","ANN","anm" ] :
             dat_op=ccdo(dat,operator="yearmean")
         else:
@@ -116,28 +144,46 @@ def variability_AR5(model,realization,variable,table, data_versions,season="ANN"
 
     # Detrend the data if required
     if detrend :
-        a=ctrend(dat) 
-        ap=ccdo_fast(a,operator="mulc,0") # Do not want to have a zero-mean detrended serie
-        detrended=csubtrend(dat,ap,a.b)
+        if native :
+            init_series()
+            from climaf.operators import ols_detrend
+            detrended=ols_detrend(dat) # Keeps the mean of the serie
+        else :
+            a=ctrend(dat) 
+            ap=ccdo_fast(a,operator="mulc,0") # Do not want to have a zero-mean detrended serie
+            detrended=csubtrend(dat,ap,a.b)
         dat=detrended
 
-    # Build an ensemble which members are the slices
-    econtrol=cens()
     slices=[ "%d-%d"%(begin+n*nyears,begin+(n+1)*nyears-1) for n in range(0,number) ]
-    for period in slices :
-        econtrol[period]=ccdo(dat,operator="seldate,"+init_period(period).iso())
-
-    # On each slice, implement the required post operation, otherwise compute a plain average
-    if post_operator is not None :
-        cmeans=cens()
-        for member in econtrol:
-            cmeans[member]=post_operator(econtrol[member],**post_operator_args)
-    else:
-        cmeans=ccdo_fast(econtrol,operator="timmean")
+    if slices_operator is None and post_operator is None and native and variability is True :
+        init_series()
+        from climaf.operators import slices_means
+        slices_operator=slices_means
+        slices_operator_args={ "step" : nyears if step is None else step }
+    if slices_operator is not None :
+        # A single call processes all slices, providing one record per slice
+        cmeans=slices_operator(dat,begin=begin,nyears=nyears,number=number,**slices_operator_args)
+        slices=[]
+    else :
+        # Build an ensemble which members are the slices
+        econtrol=cens()
+        for period in slices :
+            econtrol[period]=ccdo(dat,operator="seldate,"+init_period(period).iso())
+
+        # On each slice, implement the required post operation, otherwise compute a plain average
+        if post_operator is not None :
+            cmeans=cens()
+            for member in econtrol:
+                cmeans[member]=post_operator(econtrol[member],**post_operator_args)
+        else:
+            cmeans=ccdo_fast(econtrol,operator="timmean")
         
     if variability is True :
-        # Compute variability over the slices ensemble
-        variab1=ccdo_ens(cmeans,operator='ensstd1')
+        # Compute variability over the slices ensemble (or the slices records)
+        if slices_operator is not None :
+            variab1=ccdo_fast(cmeans,operator='timstd1')
+        else :
+            variab1=ccdo_ens(cmeans,operator='ensstd1')
         variab=ccdo_fast(variab1,operator="mulc,1.414") # cf. AR5 Box 2.1
 
     #
@@ -146,13 +192,15 @@ def variability_AR5(model,realization,variable,table, data_versions,season="ANN"
         else : cfile(cmeans, deep=deep)
     if house_keeping : # Discard intermediate data
         cdrop(basic)
-        cdrop(dat_op)
+        if stored is None :
+            cdrop(dat_op)
         if operator is not None and season not in [ "ann","ANN","anm" ] :
             cdrop(dat_season)
         if detrend :
-            cdrop(a)
-            cdrop(a.b)
-            cdrop(ap)
+            if not native :
+                cdrop(a)
+                cdrop(a.b)
+                cdrop(ap)
             cdrop(detrended)
         cdrop(dat)
         for period in slices : cdrop(econtrol[period])
@@ -167,15 +215,24 @@ def variability_AR5(model,realization,variable,table, data_versions,season="ANN"
 
 
 def process_dataset(dat,season,operator=None, operator_args={},
-                    post_operator=None, post_operator_args={}):
+                    post_operator=None, post_operator_args={},
+                    slices_operator=None, slices_operator_args={}, batch=True):
     """ 
     Similar to variability_AR5, but without slicing nor detrending nor 
     variability computation on slices. Also : the data to work on is directly 
-    provided as argument DAT
+    provided as argument DAT. Args SLICES_OPERATOR and SLICES_OPERATOR_ARGS
+    are accepted for consistency with variability_AR5, but not used
 
     This function is used to process the reference period and the projection 
     periods in a way consistent with variability computation for the control period
+
+    With BATCH set to True, when no operator is provided and SEASON is one of
+    those provided by `seasonal_means`, the result is taken from the
+    means computed for all seasons in a single read of DAT; hence, calls
+    for the various seasons of the same dataset share that computation
     """
+    if batch and operator is None and post_operator is None and season in batch_seasons :
+        return seasonal_means(dat)[season]
 
     # Implement the operation if required, otherwise seasonal or yearly average
     if operator is None :
@@ -199,6 +256,27 @@ def process_dataset(dat,season,operator=None, operator_args={},
     return cmean
 
 
+#: Seasons for which `seasonal_means` provides a time mean
+batch_seasons=[ "ann", "ANN", "anm", "DJF", "MAM", "JJA", "SON" ]
+
+
+def seasonal_means(dat) :
+    """
+    Returns a dict of CliMAF objects which are the time means of the annual
+    means and of the seasonal means of DAT (as computed by CDO's yearmean or
+    seasmean, followed by timmean) for all seasons in `batch_seasons`. They
+    are computed in a single read of DAT, by operator 'seasons_means' (see
+    module `series`)
+    """
+    init_series()
+    from climaf.operators import seasons_means
+    means=seasons_means(dat)
+    rep=dict(ann=means,ANN=means,anm=means)
+    for season in [ "DJF", "MAM", "JJA", "SON" ] :
+        rep[season]=getattr(means,season)
+    return rep
+
+
 def init_trend():
     """
     Initalize CliMAF operators 'ctrend' and 'csubtrend' for using CDO 
@@ -210,6 +288,38 @@ def init_trend():
         cscript("csubtrend", "cdo subtrend ${in_1} ${in_2} ${in_3} ${out}")
 
 
+def init_series():
+    """
+    Initalize CliMAF operators which are implemented by module `series`
+    (and run by the persistent worker, see module `worker`) :
+
+      - 'slices_means' computes the means of a yearly series over a series
+        of (possibly overlapping) time windows, in a single call; records
+        are assigned to windows by their year, as CDO's seldate does
+      - 'ols_detrend' removes the linear trend of a series (but not its mean);
+        this replaces 'ctrend' and 'csubtrend'
+      - 'ols_iav' computes the standard deviation of a detrended series,
+        multiplied by arg 'factor'
+      - 'ols_iav_slices' does the same as 'ols_iav' for a series of time
+        slices, in a single call, providing one record per slice
+      - 'seasons_means' computes the time mean of annual means, and, as
+        secondary outputs 'DJF', 'MAM', 'JJA' and 'SON', the time means of
+        seasonal means, in a single read (see `seasonal_means`)
+      - 'walsh' computes Walsh's seasonality index for each year of a
+        series of monthly precipitation, masked where the annual rain is
+        lower than arg 'threshold' (see `cancillary.walsh_seasonality`)
+    """
+    
+    if "slices_means" not in cscripts:
+        worker="python %s/worker.py series "%os.path.dirname(__file__)
+        cscript("slices_means", worker+"--slices ${begin},${nyears},${number},${step} ${in} ${out}")
+        cscript("ols_detrend", worker+"--detrend ${in} ${out}")
+        cscript("ols_iav", worker+"--iav ${factor} ${in} ${out}")
+        cscript("ols_iav_slices", worker+"--iav ${factor} --slices ${begin},${nyears},${number} ${in} ${out}")
+        cscript("walsh", worker+"--walsh ${threshold} ${in} ${out}")
+        cscript("seasons_means", worker+"--seasons ${in} ${out} ${out_DJF} ${out_MAM} ${out_JJA} ${out_SON}")
+
+
 def agreement_fraction_on_sign(ensemble):
     """
     Returns the field of fraction of members of ENSEMBLE which agree on their sign 
@@ -302,12 +412,22 @@ def stippling_hatching_masks_AR5(change,variability,agreement_fract):
     return stippling,hatching
 
 
-def inter_annual_variability(dat,factor=None,house_keeping=True,compute=False):
+def inter_annual_variability(dat,factor=None,house_keeping=True,compute=False,native=True):
     """
     Computes inter_annual_variability like Pendergrass et al. 201x :
     Assuming input data has one value per year, detrend it and then computes 
     standard deviation, without multiplying by any factor (except if provided)
+
+    With NATIVE True, this is done in a single call of operator 'ols_iav' (see
+    `init_series`), rather than by a chain of CDO calls
     """
+    if native :
+        init_series()
+        from climaf.operators import ols_iav
+        rep=ols_iav(dat,factor=1. if factor is None else factor)
+        if compute :
+            cfile(rep)
+        return rep
     init_trend()
     from climaf.operators import ctrend,csubtrend
     #
@@ -333,7 +453,12 @@ def inter_annual_variability(dat,factor=None,house_keeping=True,compute=False):
 
 def control_inter_annual_variability(model,realization,variable,table,season,data_versions,
                                      nyears=20,number=20,shift=100,
-                                     house_keeping=True,compute=False,detrend=True,project="CMIP6"):
+                                     house_keeping=True,compute=False,detrend=True,project="CMIP6",
+                                     native=True,step=None):
+    # Arg STEP is accepted for consistency with variability_AR5, but not used
+    # The store of yearly seasonal means (see module `store`) is not used :
+    # the monthly data is detrended before computing seasonal means, which
+    # does not give the same result as detrending the stored seasonal means
     init_trend()
     from climaf.operators import ctrend,csubtrend
 
@@ -354,17 +479,18 @@ def control_inter_annual_variability(model,realization,variable,table,season,dat
     length=nyears*number
     detrended=control_detrend(project,model,variable,begin,length,shift,
                               variant,version,
-                              compute,house_keeping,detrend)
+                              compute,house_keeping,detrend,native)
     std_dev=ccdo_fast(detrended,operator="timstd1 -seasmean -selseason,%s"%season)
     return(ccdo_fast(std_dev,operator="mulc,1.414"))
 
 def control_detrend(project,model,variable,begin,length, shift,
                     variant,version,
-                    compute=True,house_keeping=True,detrend=True):
+                    compute=True,house_keeping=True,detrend=True,native=True):
     # Detrend the requested variable for the piControl run 
     # If compute is True, actually evaluates the result and get rid 
     #       of original data partial copy
     # If house_keeping is True, don't compute and remove existing file from cache
+    # If native is True, detrend in a single call of operator ols_detrend
     
     from climaf.operators import ctrend,csubtrend
 
@@ -376,16 +502,22 @@ def control_detrend(project,model,variable,begin,length, shift,
         control.update(mip="CMIP",institute=institute_for_model(model))
     d=ds(period="%d-%d"%(begin+shift,begin+shift+length-1),**control)
     if detrend :
-        a=ctrend(d) 
-        ap=ccdo_fast(a,operator="mulc,0") # Do not want to have a zero-mean detrended serie
-        detrended=csubtrend(d,ap,a.b)
+        if native :
+            init_series()
+            from climaf.operators import ols_detrend
+            detrended=ols_detrend(d) # Keeps the mean of the serie
+        else :
+            a=ctrend(d) 
+            ap=ccdo_fast(a,operator="mulc,0") # Do not want to have a zero-mean detrended serie
+            detrended=csubtrend(d,ap,a.b)
         if compute :
             cfile(detrended)
         if house_keeping :
             cdrop(d) # Discard cache copy of original data
-            cdrop(a)
-            cdrop(a.b)
-            cdrop(ap)
+            if not native :
+                cdrop(a)
+                cdrop(a.b)
+                cdrop(ap)
         return detrended
     else:
         return d
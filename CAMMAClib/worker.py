@@ -0,0 +1,319 @@
+"""
+A persistent worker for the CAMMAC operators which are implemented in Python
+(such as 'gini' and 'knutti'), which avoids paying, for each operator call,
+the start of a Python interpreter plus the import of numpy and xarray
+
+Usage, e.g. in a CliMAF script command line :
+
+   python worker.py <operator> <operator arguments>
+
+This command is a thin client : it sends the request, together with its
+working directory and the environment variables listed in
+`forwarded_environment`, to a long-lived local server process through a
+Unix socket, prints the operator's output and exits with the operator's
+status. The server is launched by the first call, imports once for all the
+modules implementing the operators, and runs each request in a forked child
+process, with the client's values of these variables. It exits after
+CAMMAC_WORKER_IDLE seconds without any request (default 3600). Clients which
+start concurrently are serialized by a lock file, so that only one server
+is launched.
+
+The socket is located in a directory private to the user (mode 0700),
+named cammac_worker_<uid>, in $TMPDIR (or /tmp); its name depends on the
+modification time of the library files, so that a server is not used
+anymore once the library code has changed. Environment variable
+CAMMAC_WORKER_SOCKET can provide another socket path, which directory must
+also be private to the user. The client checks that the server runs as the
+same user before sending a request.
+
+If environment variable CAMMAC_WORKER is set to 0, or if the server cannot
+be reached, the operator is run by the client process itself
+
+Adding a Python-implemented operator only requires a call to
+`register_operator`, in this module, with the operator name, the name of
+the (sibling) module and the name of a function which accepts a list of
+arguments similar to sys.argv
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import os, sys, json, socket, stat, time, hashlib
+
+#: Registered operators : name -> (module name, function name)
+operators=dict()
+
+def register_operator(name, module, function="main") :
+    """
+    Register operator NAME as implemented by FUNCTION in MODULE (a module
+    which is a sibling of this one). FUNCTION will be called with a list of
+    arguments similar to sys.argv
+    """
+    operators[name]=(module,function)
+
+register_operator("gini"  , "gini")
+register_operator("knutti", "knutti_sedlacek")
+register_operator("ensemble_stats", "ensemble_stats")
+register_operator("robustness_masks", "robustness_masks")
+register_operator("series", "series")
+register_operator("remap", "remap")
+register_operator("daily_indices", "daily_indices")
+register_operator("basins", "basins")
+
+
+#: Environment variables which the client forwards to the worker : names,
+#: or prefixes (ending with '_'). Other variables (which may e.g. hold
+#: credentials) are not sent
+forwarded_environment=[ "PATH", "LD_LIBRARY_PATH", "TMPDIR", "CAMMAC_", "CDO_", "OMP_", "HDF5_" ]
+
+
+def is_forwarded(name) :
+    """
+    Tells if environment variable NAME is forwarded to the worker
+    """
+    return any(name == f or (f.endswith("_") and name.startswith(f)) for f in forwarded_environment)
+
+
+def client_environment() :
+    """
+    Returns a dict of the environment variables forwarded to the worker
+    """
+    return dict((name,value) for name,value in os.environ.items() if is_forwarded(name))
+
+
+def check_private(directory) :
+    """
+    Raise an IOError if DIRECTORY is not a directory owned by the user and
+    inaccessible to other users
+    """
+    st=os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077 :
+        raise IOError("%s is not a directory private to user %d"%(directory,os.getuid()))
+
+
+def socket_path() :
+    """
+    Returns the path for the worker's Unix socket, creating its directory if needed
+    """
+    if "CAMMAC_WORKER_SOCKET" in os.environ :
+        return os.environ["CAMMAC_WORKER_SOCKET"]
+    libdir=os.path.dirname(os.path.abspath(__file__))
+    stamp=libdir
+    for f in sorted(os.listdir(libdir)) :
+        if f.endswith(".py") :
+            stamp+="%s%d"%(f,os.path.getmtime(os.path.join(libdir,f)))
+    name="worker_%s.sock"%hashlib.sha1(stamp.encode('utf-8')).hexdigest()[0:8]
+    directory=os.path.join(os.environ.get("TMPDIR","/tmp"),"cammac_worker_%d"%os.getuid())
+    if len(os.path.join(directory,name)) > 100 : # Limit on Unix sockets paths length
+        directory=os.path.join("/tmp","cammac_worker_%d"%os.getuid())
+    try :
+        os.mkdir(directory,0o700)
+    except OSError : # Already exists (its ownership and mode are checked by the client)
+        pass
+    return os.path.join(directory,name)
+
+
+def get_function(name) :
+    """
+    Import the module implementing operator NAME, and returns its function
+    """
+    if name not in operators :
+        raise ValueError("Unknown CAMMAC worker operator %s"%name)
+    module,function=operators[name]
+    libdir=os.path.dirname(os.path.abspath(__file__))
+    if libdir not in sys.path :
+        sys.path.insert(0,libdir)
+    return getattr(__import__(module),function)
+
+
+def run_operator(name, argv) :
+    """
+    Run operator NAME with arguments ARGV (a list similar to sys.argv)
+    """
+    get_function(name)(argv)
+
+
+def set_environment(env) :
+    """
+    Replace the forwarded environment variables of the current process (a
+    child of the server) by those of dict ENV, which come from the client's
+    environment, so that operators see the same settings (e.g.
+    CAMMAC_KS_MEMORY, PATH or TMPDIR) as when run directly
+    """
+    import tempfile
+    for name in list(os.environ) :
+        if is_forwarded(name) and name not in env :
+            del os.environ[name]
+    os.environ.update((name,value) for name,value in env.items() if is_forwarded(name))
+    tempfile.tempdir=None # Forces re-evaluating TMPDIR
+
+
+def receive(sock) :
+    """
+    Read a newline-terminated JSON message on socket SOCK; returns None if
+    the peer closed the connection without sending anything
+    """
+    data=b""
+    while not data.endswith(b"\n") :
+        chunk=sock.recv(65536)
+        if not chunk :
+            break
+        data+=chunk
+    if len(data) == 0 :
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+def send(sock, message) :
+    sock.sendall((json.dumps(message)+"\n").encode('utf-8'))
+
+
+def serve(path, idle=3600) :
+    """
+    Run the worker server on Unix socket PATH, until IDLE seconds elapse
+    without any request
+    """
+    try :
+        import socketserver
+    except ImportError :
+        import SocketServer as socketserver
+    import traceback
+    try :
+        from io import StringIO
+    except ImportError :
+        from StringIO import StringIO
+    #
+    # Import operators modules once for all, before forking
+    for name in operators :
+        get_function(name)
+
+    class Handler(socketserver.BaseRequestHandler) :
+        def handle(self) :
+            request=receive(self.request)
+            if request is None : # A client checking that the server is listening
+                return
+            output=StringIO()
+            status=0
+            stdout,stderr=sys.stdout,sys.stderr
+            sys.stdout=sys.stderr=output
+            try :
+                os.chdir(request["cwd"])
+                set_environment(request["env"])
+                run_operator(request["operator"],request["argv"])
+            except BaseException :
+                traceback.print_exc(file=output)
+                status=1
+            finally :
+                sys.stdout,sys.stderr=stdout,stderr
+            send(self.request,{"status":status, "output":output.getvalue()})
+
+    class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer) :
+        idle=False
+        def handle_timeout(self) :
+            self.idle=True
+
+    server=Server(path,Handler)
+    inode=os.stat(path).st_ino
+    server.timeout=idle
+    try :
+        while not server.idle :
+            server.handle_request()
+            server.collect_children()
+    finally :
+        server.server_close()
+        # Do not remove the socket of a server started after this one gave up
+        if os.path.exists(path) and os.stat(path).st_ino == inode :
+            os.remove(path)
+
+
+def start_server(path, timeout=60) :
+    """
+    Launch a detached worker server on socket PATH, unless another client
+    did it meanwhile, and wait until it is listening. Clients are serialized
+    by a lock on file PATH.lock
+    """
+    import subprocess, fcntl
+    with open(path+".lock","a") as lock :
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try :
+            try :
+                connect(path).close()
+                return
+            except socket.error :
+                pass
+            if os.path.exists(path) : # A stale socket, which no server listens to
+                os.remove(path)
+            with open(os.devnull,"w") as devnull :
+                subprocess.Popen([ sys.executable, os.path.abspath(__file__), "--serve", path ],
+                                 stdin=devnull, stdout=devnull, stderr=devnull,
+                                 close_fds=True, preexec_fn=os.setsid)
+            start=time.time()
+            while True :
+                try :
+                    connect(path).close()
+                    return
+                except socket.error :
+                    if time.time() - start > timeout :
+                        raise IOError("CAMMAC worker did not start on %s"%path)
+                    time.sleep(0.1)
+        finally :
+            fcntl.flock(lock,fcntl.LOCK_UN)
+
+
+def connect(path) :
+    """
+    Returns a socket connected to the worker on PATH, after checking that
+    the server runs as the user
+    """
+    sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    if hasattr(socket,"SO_PEERCRED") :
+        import struct
+        credentials=sock.getsockopt(socket.SOL_SOCKET,socket.SO_PEERCRED,struct.calcsize(str("3i")))
+        uid=struct.unpack(str("3i"),credentials)[1]
+    else :
+        uid=os.stat(path).st_uid
+    if uid != os.getuid() :
+        sock.close()
+        raise IOError("CAMMAC worker socket %s is owned by another user (%d)"%(path,uid))
+    return sock
+
+
+def client(name, argv) :
+    """
+    Have operator NAME run by the worker with arguments ARGV, starting the
+    worker if needed. Returns the operator's exit status
+    """
+    try :
+        path=socket_path()
+        check_private(os.path.dirname(os.path.abspath(path)))
+        try :
+            sock=connect(path)
+        except socket.error :
+            start_server(path)
+            sock=connect(path)
+    except (socket.error, IOError, OSError) as e :
+        print("CAMMAC worker is not available (%s), running %s directly"%(e,name))
+        run_operator(name,argv)
+        return 0
+    try :
+        send(sock,{"operator":name, "argv":argv, "cwd":os.getcwd(), "env":client_environment()})
+        answer=receive(sock)
+    finally :
+        sock.close()
+    sys.stdout.write(answer["output"])
+    return answer["status"]
+
+
+def main(argv) :
+    if argv[1] == "--serve" :
+        serve(argv[2], float(os.environ.get("CAMMAC_WORKER_IDLE",3600)))
+        return 0
+    name=argv[1]
+    operator_argv=[ name ] + argv[2:]
+    if os.environ.get("CAMMAC_WORKER","1") == "0" :
+        run_operator(name,operator_argv)
+        return 0
+    return client(name,operator_argv)
+
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv))
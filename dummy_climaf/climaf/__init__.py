@@ -3,7 +3,7 @@
 from __future__ import print_function
 
 
-__all__=["api","period","operators" ]
+__all__=["api","period","operators","classes","cache" ]
 
 
 
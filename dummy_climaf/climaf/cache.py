@@ -0,0 +1,7 @@
+""" Dummy CliMAF cache : no object is cached """
+
+from __future__ import print_function
+
+
+def hasExactObject( *lval,**kwargs) :
+    return False
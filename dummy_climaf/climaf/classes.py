@@ -0,0 +1,28 @@
+""" Dummy CliMAF classes, with the attributes of CliMAF objects which CAMMAC uses """
+
+from __future__ import print_function
+
+
+class cobject(object) :
+    def __init__(self, crs=None) :
+        self.crs=crs
+
+    def __repr__(self) :
+        return self.crs
+
+
+class ctree(cobject) :
+    def __init__(self, climaf_operator, script, *operands, **parameters) :
+        self.operator=climaf_operator
+        self.script=script
+        self.operands=operands
+        self.parameters=parameters
+        self.crs="%s(%s)"%(climaf_operator,",".join([ o.crs for o in operands ] +
+                                                    [ "%s=%r"%(k,parameters[k]) for k in sorted(parameters) ]))
+
+
+class scriptChild(cobject) :
+    def __init__(self, cobject, varname) :
+        self.father=cobject
+        self.varname=varname
+        self.crs=cobject.crs+"."+varname
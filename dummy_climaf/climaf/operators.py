@@ -14,3 +14,33 @@ def csubtrend( *lval,**kwargs) :
     pass
 def gini( *lval,**kwargs) :
     pass
+def gini_slices( *lval,**kwargs) :
+    pass
+def ensemble_stats( *lval,**kwargs) :
+    pass
+def ensemble_means_rchange( *lval,**kwargs) :
+    pass
+def robustness_masks( *lval,**kwargs) :
+    pass
+def robustness_masks_AR5( *lval,**kwargs) :
+    pass
+def slices_means( *lval,**kwargs) :
+    pass
+def ols_detrend( *lval,**kwargs) :
+    pass
+def ols_iav( *lval,**kwargs) :
+    pass
+def ols_iav_slices( *lval,**kwargs) :
+    pass
+def cached_remap( *lval,**kwargs) :
+    pass
+def cached_remap_batch( *lval,**kwargs) :
+    pass
+def walsh( *lval,**kwargs) :
+    pass
+def daily_indices( *lval,**kwargs) :
+    pass
+def seasons_means( *lval,**kwargs) :
+    pass
+def basins_averages( *lval,**kwargs) :
+    pass
@@ -24,3 +24,9 @@ if [[ $HOSTNAME == spirit*  ]]
 fi
 export TMPDIR=$CLIMAF_CACHE
 #
+
+# Memory budget (in Mbytes) and number of processes for computing the
+# Knutti and Sedlacek robustness index (see CAMMAClib/knutti_sedlacek.py);
+# keep the budget well below the memory requested by job_pm.sh
+export CAMMAC_KS_MEMORY=${CAMMAC_KS_MEMORY:-16000}
+export CAMMAC_KS_WORKERS=${CAMMAC_KS_WORKERS:-1}
@@ -0,0 +1,18 @@
+"""
+Test configuration : makes the library importable both as package CAMMAClib
+and, for the script modules run by the worker, as sibling modules. When
+CliMAF is not installed, the dummy CliMAF used for building the doc is used,
+which allows to test the Python parts of the library modules
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import os, sys
+import numpy # The real one, before dummy_climaf (which includes a dummy numpy) is on the path
+
+root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,os.path.join(root,"CAMMAClib"))
+sys.path.insert(0,root)
+try :
+    import climaf
+except ImportError :
+    sys.path.append(os.path.join(root,"dummy_climaf"))
@@ -0,0 +1,64 @@
+"""
+Round trip of aggregate fields through the cache of
+`changes.change_figure_with_caching`, over several seasons
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import xarray as xr
+
+import CAMMAClib.changes as changes
+
+
+def field(value) :
+    return xr.Dataset(dict(v=(("time","lat","lon"),np.full((1,2,3),value))),
+                      coords=dict(time=[0],lat=[0.,1.],lon=[0.,1.,2.]))
+
+
+def fake_cfile(obj, target, *args, **kwargs) :
+    obj.to_netcdf(target)
+    return target
+
+
+def fake_fds(path, variable=None, period=None) :
+    return (path,variable)
+
+
+def aggregates(season, offset) :
+    return { "pr" : { "ssp245" : { season : {
+        "mean_change"  : { "plain" : field(offset+1.) },
+        "stippling"    : { "plain" : field(offset+2.) } } } } }
+
+
+def test_seasons_in_a_row_hit_cache(tmp_path, monkeypatch) :
+    monkeypatch.setattr(changes,"cfile",fake_cfile)
+    monkeypatch.setattr(changes,"fds",fake_fds,raising=False)
+    monkeypatch.setattr(changes,"cdrop",lambda obj : None,raising=False)
+    cache_dir=str(tmp_path)
+    params=dict(variable="pr", experiment="ssp245", derivation="plain", models=[["M","r1"]])
+    fields=[ "mean_change", "stippling" ]
+    for offset,season in enumerate([ "DJF", "JJA" ]) :
+        assert changes.read_aggregates(params,[season],fields,cache_dir) == {}
+        changes.dump_aggregates(aggregates(season,10*offset),params,cache_dir)
+    for offset,season in enumerate([ "DJF", "JJA" ]) :
+        found=changes.read_aggregates(params,[season],fields,cache_dir)
+        for f,expected in zip(fields,[ 1., 2. ]) :
+            path,name=found["pr"]["ssp245"][season][f]["plain"]
+            assert name == changes.aggregate_name(f,season)
+            with xr.open_dataset(path) as ds :
+                np.testing.assert_array_equal(ds[name].values,10*offset+expected)
+
+
+def test_season_recomputation_replaces_its_fields(tmp_path, monkeypatch) :
+    monkeypatch.setattr(changes,"cfile",fake_cfile)
+    monkeypatch.setattr(changes,"fds",fake_fds,raising=False)
+    monkeypatch.setattr(changes,"cdrop",lambda obj : None,raising=False)
+    cache_dir=str(tmp_path)
+    params=dict(variable="pr", experiment="ssp245", derivation="plain")
+    changes.dump_aggregates(aggregates("DJF",0),params,cache_dir)
+    changes.dump_aggregates(aggregates("JJA",0),params,cache_dir)
+    changes.dump_aggregates(aggregates("DJF",100),params,cache_dir)
+    path,name=changes.read_aggregates(params,["DJF"],["mean_change"],cache_dir)["pr"]["ssp245"]["DJF"]["mean_change"]["plain"]
+    with xr.open_dataset(path) as ds :
+        np.testing.assert_array_equal(ds[name].values,101.)
+        assert "mean_change_JJA" in ds
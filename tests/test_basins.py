@@ -0,0 +1,86 @@
+"""
+Basins averages of script module `basins` (a sparse matrix product),
+compared to a remapping followed by masked area-weighted means, as with CDO
+operators 'remapcon' and 'fldmean'. The SCRIP weights which CDO would
+generate are emulated
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+pytest.importorskip("scipy")
+
+import basins
+import remap
+
+
+def scrip_weights(filename, nsrc, ndst, rng) :
+    """
+    Write in FILENAME random remapping weights from NSRC source cells to
+    NDST target cells, in SCRIP format, and return them as a dense matrix
+    """
+    dense=np.zeros((ndst,nsrc))
+    for dst in range(ndst) :
+        sources=rng.choice(nsrc,size=3,replace=False)
+        dense[dst,sources]=rng.dirichlet(np.ones(3))
+    dst,src=np.nonzero(dense)
+    xr.Dataset(dict(src_address=("num_links",src+1), dst_address=("num_links",dst+1),
+                    remap_matrix=(("num_links","num_wgts"),dense[dst,src][:,None]),
+                    src_grid_area=("src_grid_size",np.ones(nsrc)),
+                    dst_grid_area=("dst_grid_size",rng.uniform(1.,2.,size=ndst)))).to_netcdf(filename)
+    return dense
+
+
+def reference_averages(data, dense, areas, masks) :
+    rep=np.full((data.shape[0],masks.shape[0]),np.nan)
+    for record in range(data.shape[0]) :
+        valid=~np.isnan(data[record])
+        norms=dense[:,valid].sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            target=dense[:,valid].dot(data[record][valid])/norms
+        target[norms == 0]=np.nan
+        for basin,mask in enumerate(masks) :
+            cells=mask & ~np.isnan(target)
+            if cells.any() :
+                rep[record,basin]=(areas[cells]*target[cells]).sum()/areas[cells].sum()
+    return rep
+
+
+def test_basins_averages(tmp_path, monkeypatch) :
+    rng=np.random.default_rng(0)
+    (tmp_path/"weights").mkdir()
+    weights_dir=str(tmp_path/"weights")
+    scrip=str(tmp_path/"scrip.nc")
+    dense=scrip_weights(scrip,12,6,rng)
+    monkeypatch.setattr(remap,"grid_signature",lambda filename : "source")
+    monkeypatch.setattr(remap,"weights_file",lambda filename, grid, method, weights_dir : scrip)
+    #
+    basins_file=str(tmp_path/"num_bas.nc")
+    numbers=np.array([ [ 1, 1, 2 ], [ 0, 2, 2 ] ])
+    xr.Dataset(dict(basin=(("lat","lon"),numbers))).to_netcdf(basins_file)
+    mask_file=str(tmp_path/"NAMmonsoon_global.nc")
+    region=np.array([ [ 0., 1., 1. ], [ 1., 0., np.nan ] ])
+    xr.Dataset(dict(mask=(("lat","lon"),region))).to_netcdf(mask_file)
+    #
+    data=rng.normal(size=(3,3,4))
+    data[1,0,:]=np.nan
+    data[2]=np.nan
+    source=str(tmp_path/"pr.nc")
+    xr.Dataset(dict(pr=(("time","lat","lon"),data)),
+               coords=dict(time=pd.date_range("2000-01-01",periods=3,freq="MS"))).to_netcdf(source)
+    #
+    key=dict(Amazon=1,Lena=2)
+    out=basins.compute(source,basins_file,key,[ mask_file ],weights_dir)
+    assert list(out["basin"].values) == [ "Amazon", "Lena", "NAMmonsoon" ]
+    _,masks=basins.basins_masks(basins_file,key,[ mask_file ])
+    with xr.open_dataset(scrip) as ds :
+        areas=ds["dst_grid_area"].values
+    expected=reference_averages(data.reshape(3,-1),dense,areas,masks)
+    np.testing.assert_allclose(out["pr"].values,expected,rtol=1e-12,equal_nan=True)
+    assert np.isnan(out["pr"].values[2]).all()
+    # Components are cached, and effective matrices memoized by missing values pattern
+    assert len([ f for f in (tmp_path/"weights").iterdir() if f.name.startswith("basins_") ]) == 1
+    assert len([ k for k in basins.matrices if k[0].startswith(weights_dir) ]) == 3
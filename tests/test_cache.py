@@ -0,0 +1,77 @@
+"""
+File cache of module `cache` : keys, lookups, eviction of least recently
+used entries, and atomic writes
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import os
+import time
+
+import pytest
+
+import cache
+
+
+def write(cache_dir, size) :
+    path=cache.temporary_path(str(cache_dir))
+    with open(path,"wb") as f :
+        f.write(b"x"*size)
+    return path
+
+
+def test_cache_key() :
+    assert cache.cache_key(a=1,b="x") == cache.cache_key(b="x",a=1)
+    assert cache.cache_key(a=1,b="x") != cache.cache_key(a=1,b="y")
+    assert cache.cache_key(seasons=("ANN","DJF")) != cache.cache_key(seasons=("ANN",))
+
+
+def test_store_and_lookup(tmp_path) :
+    cache_dir=str(tmp_path/"cache")
+    key=cache.cache_key(variable="pr",season="ANN")
+    assert cache.lookup(cache_dir,key) is None
+    path=cache.store(cache_dir,key,write(cache_dir,10),params=dict(variable="pr",season="ANN"))
+    assert cache.lookup(cache_dir,key) == path
+    assert os.path.getsize(path) == 10
+    assert [ f for f in os.listdir(cache_dir) if f.startswith("tmp_") ] == []
+    # An entry which file was removed is dropped from the manifest
+    os.remove(path)
+    assert cache.lookup(cache_dir,key) is None
+
+
+def test_eviction(tmp_path) :
+    cache_dir=str(tmp_path/"cache")
+    cache.manifest(cache_dir).close()
+    paths=[]
+    for k in range(3) :
+        paths.append(cache.store(cache_dir,"key%d"%k,write(cache_dir,10),budget=100))
+        time.sleep(0.01)
+    # Accessing the first entry makes the second one the least recently used
+    cache.lookup(cache_dir,"key0")
+    cache.store(cache_dir,"key3",write(cache_dir,10),budget=30)
+    assert cache.lookup(cache_dir,"key1") is None
+    assert not os.path.exists(paths[1])
+    for key in [ "key0", "key2", "key3" ] :
+        assert cache.lookup(cache_dir,key) is not None
+    # The entry being stored is kept, whatever the budget
+    cache.store(cache_dir,"key4",write(cache_dir,50),budget=30)
+    assert cache.lookup(cache_dir,"key4") is not None
+    assert all(cache.lookup(cache_dir,key) is None for key in [ "key0", "key2", "key3" ])
+
+
+def test_atomic_write(tmp_path) :
+    path=str(tmp_path/"a"/"b"/"field.nc")
+    temporaries=[]
+    def write(tmp) :
+        temporaries.append(tmp)
+        assert not os.path.exists(path)
+        with open(tmp,"w") as f :
+            f.write("x")
+    cache.atomic_write(path,write)
+    assert open(path).read() == "x"
+    assert temporaries[0].endswith(".nc") and os.path.dirname(temporaries[0]) == os.path.dirname(path)
+    def fail(tmp) :
+        open(tmp,"w").close()
+        raise IOError("disk full")
+    with pytest.raises(IOError) :
+        cache.atomic_write(str(tmp_path/"a"/"b"/"other.nc"),fail)
+    assert os.listdir(os.path.dirname(path)) == [ "field.nc" ]
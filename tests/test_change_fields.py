@@ -0,0 +1,89 @@
+"""
+Sharing of reference fields across experiments in `changes.change_fields`,
+with CliMAF operators replaced by functions which build symbolic values
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import pytest
+
+import CAMMAClib.changes as changes
+
+
+experiments=[ "ssp126", "ssp585" ]
+models=[ ("M1","r1i1p1f1"), ("M2","r1i1p1f1") ]
+data_versions=dict((experiment,{ "pr" : { "Amon" : dict((model,{ realization : ("gn","v1","1850-2014") })
+                                                       for model,realization in models) } })
+                   for experiment in [ "historical" ]+experiments)
+
+
+@pytest.fixture
+def symbolic(monkeypatch) :
+    """
+    Replace CliMAF operators used by change_fields with functions returning
+    tuples; returns the list of calls to period_mean and to ccdo_ens
+    """
+    calls=dict(period_mean=[],ccdo_ens=[])
+
+    def period_mean(dataset_dict, grid, season, derivation) :
+        calls["period_mean"].append((dataset_dict["experiment"],dataset_dict["model"],season))
+        return ("mean",dataset_dict["experiment"],dataset_dict["model"],season)
+
+    def ccdo_ens(ens, operator) :
+        calls["ccdo_ens"].append((operator,dict(ens)))
+        return ("ens",operator,tuple(sorted(ens)))
+
+    monkeypatch.setattr(changes,"period_mean",period_mean)
+    monkeypatch.setattr(changes,"ccdo_ens",ccdo_ens,raising=False)
+    monkeypatch.setattr(changes,"ccdo_fast",lambda field, operator : ("ccdo",operator,field),raising=False)
+    monkeypatch.setattr(changes,"ccdo2",lambda a, b, operator : ("ccdo2",operator,a,b),raising=False)
+    monkeypatch.setattr(changes,"cens",lambda members, order=None : dict(members),raising=False)
+    monkeypatch.setattr(changes,"remap_batch",
+                        lambda fields, cdogrid, **kwargs : dict((k,("remapped",v)) for k,v in fields.items()))
+    monkeypatch.setattr(changes,"agreement_fraction_on_sign",lambda ens : ("agree",tuple(sorted(ens))))
+    return calls
+
+
+def test_reference_shared_across_experiments(symbolic) :
+    aggregates,dic=changes.change_fields("CMIP6","pr",experiments,[ "ANN", "JJA" ],"1995-2014","2081-2100",
+                                         dict((experiment,([],models)) for experiment in experiments),
+                                         data_versions,derivation_label="plain",relative=True,
+                                         variab_sampling_args=None,table="Amon",ensemble_engine=False)
+    # Reference means are computed once per model and season, whatever the number of experiments
+    references=[ call for call in symbolic["period_mean"] if call[0] == "historical" ]
+    assert sorted(references) == sorted((experiment,model,season) for experiment in [ "historical" ]
+                                        for model,_ in models for season in [ "ANN", "JJA" ])
+    for season in [ "ANN", "JJA" ] :
+        for model,_ in models :
+            assert dic["ssp126"][season]["reference"]["plain"][model] is \
+                dic["ssp585"][season]["reference"]["plain"][model]
+            assert dic["ssp126"][season]["reference_remapped"]["plain"][model] is \
+                dic["ssp585"][season]["reference_remapped"]["plain"][model]
+    # Ensembles only include the models' fields
+    for operator,ens in symbolic["ccdo_ens"] :
+        assert sorted(ens) == [ "M1", "M2" ]
+    for experiment in experiments :
+        assert "means_rchange" in aggregates["pr"][experiment]["JJA"]
+
+
+def test_cached_models_provide_all_fields(symbolic, monkeypatch) :
+    cache=dict()
+    monkeypatch.setattr(changes,"read_cached_field",
+                        lambda cache_dir, params : cache.get(changes.cache_key(**params)))
+    monkeypatch.setattr(changes,"write_cached_field",
+                        lambda field, cache_dir, params : cache.__setitem__(changes.cache_key(**params),field))
+    dics=[]
+    for run in range(2) :
+        _,dic=changes.change_fields("CMIP6","pr",experiments,[ "JJA" ],"1995-2014","2081-2100",
+                                    dict((experiment,([],models)) for experiment in experiments),
+                                    data_versions,derivation_label="plain",relative=True,
+                                    variab_sampling_args=None,table="Amon",ensemble_engine=False,
+                                    cache_dir="cache")
+        dics.append(dic)
+    # Second run reads all fields in cache, and provides the same ones
+    assert len(symbolic["period_mean"]) == len(models)+len(experiments)*len(models)
+    for experiment in experiments :
+        fields=dics[0][experiment]["JJA"]
+        assert sorted(dics[1][experiment]["JJA"]) == sorted(fields)
+        for field in [ "reference", "projection", "change_orig", "rchange_orig", "rchange" ] :
+            for model,_ in models :
+                assert dics[1][experiment]["JJA"][field]["plain"][model] == fields[field]["plain"][model]
@@ -0,0 +1,69 @@
+"""
+Annual indices of script module `daily_indices`, compared to day-by-day
+computations of what derivations 'dry' and 'drain' and CDO's yearly
+statistics provide
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import daily_indices
+
+
+def reference_indices(values, threshold) :
+    rep=dict((index,np.full(values.shape[1:],np.nan)) for index in daily_indices.indices)
+    for cell in np.ndindex(*values.shape[1:]) :
+        x=values[(slice(None),)+cell]
+        valid=~np.isnan(x)
+        if not valid.any() :
+            continue
+        rep["dry"][cell]=np.sum(x[valid] < threshold)
+        wet=x[valid][x[valid] > threshold]
+        if len(wet) > 0 :
+            rep["sdii"][cell]=wet.mean()
+        rep["rx1day"][cell]=x[valid].max()*daily_indices.seconds_per_day
+        sums=[ x[d:d+5].sum() for d in range(len(x)-4) if valid[d:d+5].all() ]
+        if len(sums) > 0 :
+            rep["rx5day"][cell]=max(sums)*daily_indices.seconds_per_day
+        longest=run=0
+        for value in x :
+            run=run+1 if value < threshold else 0
+            longest=max(longest,run)
+        rep["cdd"][cell]=longest
+    return rep
+
+
+def test_annual_indices() :
+    rng=np.random.default_rng(0)
+    threshold=1./daily_indices.seconds_per_day
+    values=rng.exponential(3.,size=(365,3,4))/daily_indices.seconds_per_day
+    values[100:140,0,0]=0.
+    values[10,1,1]=np.nan
+    values[:,2,3]=np.nan
+    values[:,2,2]=0.
+    result=daily_indices.annual_indices(values,threshold)
+    expected=reference_indices(values,threshold)
+    for index in daily_indices.indices :
+        np.testing.assert_allclose(result[index],expected[index],rtol=1e-10,equal_nan=True,err_msg=index)
+
+
+def test_year_across_files(tmp_path) :
+    rng=np.random.default_rng(1)
+    times=pd.date_range("2000-01-01","2001-12-31",freq="D")
+    values=rng.exponential(3.,size=(len(times),2,2))/daily_indices.seconds_per_day
+    ds=xr.Dataset(dict(pr=(("time","lat","lon"),values)),coords=dict(time=times,lat=[0.,10.],lon=[0.,10.]))
+    files=[]
+    # The second file begins in the middle of year 2000
+    for k,(begin,end) in enumerate([ ("2000-01-01","2000-06-30"), ("2000-07-01","2001-12-31") ]) :
+        files.append(str(tmp_path/("pr_%d.nc"%k)))
+        ds.sel(time=slice(begin,end)).to_netcdf(files[-1])
+    threshold=1./daily_indices.seconds_per_day
+    results=daily_indices.compute(files[::-1],threshold)
+    for index in daily_indices.indices :
+        out=results[index]["pr"]
+        assert list(out["time"].dt.year.values) == [ 2000, 2001 ]
+        for record,year in enumerate([ 2000, 2001 ]) :
+            expected=reference_indices(values[times.year == year],threshold)[index]
+            np.testing.assert_allclose(out.values[record],expected,rtol=1e-6,err_msg=index)
@@ -0,0 +1,51 @@
+"""
+Ensemble statistics of script module `ensemble_stats`, compared to
+straightforward computations of what CDO's ens* operators provide
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import math
+import numpy as np
+import xarray as xr
+
+import ensemble_stats
+
+
+def nearest_rank(values, percentile) :
+    values=np.sort(values[~np.isnan(values)])
+    if len(values) == 0 :
+        return np.nan
+    return values[max(int(math.ceil(len(values)*percentile/100.))-1,0)]
+
+
+def test_ensemble_statistics() :
+    rng=np.random.default_rng(0)
+    data=rng.normal(size=(8,3,4))
+    data[0,0,0]=np.nan
+    data[:,1,1]=np.nan
+    data[1:,2,2]=np.nan
+    stats=ensemble_stats.ensemble_statistics(data,90)
+    for index in np.ndindex(3,4) :
+        values=data[(slice(None),)+index]
+        valid=values[~np.isnan(values)]
+        expected=dict(median=nearest_rank(values,50), pctl=nearest_rank(values,90),
+                      mean=valid.mean() if len(valid) > 0 else np.nan,
+                      std=valid.std(ddof=1) if len(valid) > 1 else np.nan,
+                      agree=max((valid<=0).sum(),(valid>=0).sum())/8. if len(valid) > 0 else np.nan)
+        for key in expected :
+            np.testing.assert_allclose(stats[key][index],expected[key],rtol=1e-12,err_msg=key)
+
+
+def test_means_relative_change_zero_reference(tmp_path) :
+    projections=np.array([ [ 1., 2., np.nan ], [ 3., 2., 1. ] ])
+    references =np.array([ [ 0., 1., 2. ], [ 0., 3., 2. ] ])
+    files=[]
+    for name,data in [ ("p",projections), ("r",references) ] :
+        for i,values in enumerate(data) :
+            f=str(tmp_path / ("%s%d.nc"%(name,i)))
+            xr.Dataset(dict(v=(("lon",),values)),coords=dict(lon=[0.,1.,2.])).to_netcdf(f)
+            files.append(f)
+    out=str(tmp_path / "out.nc")
+    ensemble_stats.main([ "ensemble_stats", "--means_rchange", " ".join(files[0:2]), " ".join(files[2:4]), out ])
+    with xr.open_dataset(out) as ds :
+        np.testing.assert_allclose(ds["v"].values,[ np.nan, 0., -50. ])
@@ -0,0 +1,70 @@
+"""
+Spatial statistics of `cancillary.field_statistics`, on regular and
+curvilinear grids
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import xarray as xr
+
+import CAMMAClib.cancillary as cancillary
+
+
+def regular(path, bounds) :
+    lat=np.array([ -60., -20., 20., 60. ])
+    values=np.arange(12.).reshape(4,3)
+    ds=xr.Dataset(dict(tas=(("lat","lon"),values)),coords=dict(lat=lat,lon=[0.,120.,240.]))
+    if bounds :
+        ds["lat_bnds"]=(("lat","bnds"),np.array([ [ -90., -40. ], [ -40., 0. ], [ 0., 40. ], [ 40., 90. ] ]))
+        ds["lat"].attrs["bounds"]="lat_bnds"
+    ds.to_netcdf(path)
+    return values, lat
+
+
+def test_regular_grid(tmp_path, monkeypatch) :
+    monkeypatch.setattr(cancillary,"cfile",lambda f : f)
+    path=str(tmp_path / "regular.nc")
+    values,lat=regular(path,bounds=False)
+    weights=np.cos(np.deg2rad(lat))[:,None]*np.ones(3)
+    mean,vmax,median=cancillary.field_statistics(path,["mean","max","p50"])
+    np.testing.assert_allclose(mean,(values*weights).sum()/weights.sum(),rtol=1e-12)
+    assert (vmax,median) == (11.,5.)
+
+
+def test_regular_grid_with_bounds(tmp_path, monkeypatch) :
+    monkeypatch.setattr(cancillary,"cfile",lambda f : f)
+    path=str(tmp_path / "regular.nc")
+    values,_=regular(path,bounds=True)
+    band=np.abs(np.diff(np.sin(np.deg2rad([ -90., -40., 0., 40., 90. ]))))
+    weights=band[:,None]*np.ones(3)
+    np.testing.assert_allclose(cancillary.field_statistics(path)[0],(values*weights).sum()/weights.sum(),rtol=1e-12)
+
+
+def curvilinear(path, areas) :
+    values=np.arange(6.).reshape(2,3)
+    ds=xr.Dataset(dict(tos=(("y","x"),values)),
+                  coords=dict(nav_lat=(("y","x"),np.array([ [ 0., 1., 2. ], [ 10., 11., 12. ] ]))))
+    if areas is not None :
+        ds["areacello"]=(("y","x"),areas)
+        ds["tos"].attrs["cell_measures"]="area: areacello"
+    ds.to_netcdf(path)
+    return values
+
+
+def test_curvilinear_grid_with_areas(tmp_path, monkeypatch) :
+    monkeypatch.setattr(cancillary,"cfile",lambda f : f)
+    path=str(tmp_path / "curvilinear.nc")
+    areas=np.array([ [ 1., 2., 3. ], [ 4., 5., 6. ] ])
+    values=curvilinear(path,areas)
+    np.testing.assert_allclose(cancillary.field_statistics(path)[0],(values*areas).sum()/areas.sum(),rtol=1e-12)
+
+
+def test_curvilinear_grid_falls_back_on_cdo(tmp_path, monkeypatch) :
+    path=str(tmp_path / "curvilinear.nc")
+    curvilinear(path,None)
+    calls=[]
+    monkeypatch.setattr(cancillary,"cfile",lambda f : f)
+    monkeypatch.setattr(cancillary,"ccdo_fast",lambda f,operator : calls.append((f,operator)) or "fldmean")
+    monkeypatch.setattr(cancillary,"cvalue",lambda obj : 42.)
+    assert cancillary.field_statistics(path,["mean","min"]) == [ 42., 0. ]
+    assert calls == [ (path,"fldmean") ]
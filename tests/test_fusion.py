@@ -0,0 +1,96 @@
+"""
+Fusion of chains of CDO operators by module `fusion`, on graphs built with
+the dummy CliMAF classes : order of the piped operators, chains stopped at
+cached nodes, cache keys (CRS) and secondary outputs of scripts
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import pytest
+
+import climaf.cache
+import climaf.operators
+from climaf.classes import cobject, ctree, scriptChild
+
+import CAMMAClib.fusion as fusion
+
+
+@pytest.fixture
+def cached(monkeypatch) :
+    """
+    Make CliMAF operators 'ccdo' and 'ccdo_fast' build trees, and return
+    the set of the CRSs of objects which are deemed to be in CliMAF cache
+    """
+    crss=set()
+    for operator in fusion.fusable_operators :
+        monkeypatch.setattr(climaf.operators,operator,
+                            lambda operand, _op=operator, **kwargs : ctree(_op,None,operand,**kwargs),
+                            raising=False)
+    monkeypatch.setattr(climaf.cache,"hasExactObject",lambda o : o.crs in crss)
+    return crss
+
+
+def chain(operand, *operators) :
+    """ Apply 'ccdo' with OPERATORS to OPERAND, from first to last """
+    for operator in operators :
+        operand=climaf.operators.ccdo(operand,operator=operator)
+    return operand
+
+
+def test_operators_order(cached) :
+    data=cobject("ds(pr)")
+    steps=chain(data,"seasmean","selseason,DJF","timmean")
+    fused=fusion.fuse(steps)
+    assert fused.operator == "ccdo"
+    assert fused.parameters == dict(operator="timmean -selseason,DJF -seasmean")
+    assert fused.operands == (data,)
+    assert fused.crs == steps.crs
+    # The first operator of the chain determines the CliMAF operator
+    steps=chain(climaf.operators.ccdo_fast(data,operator="seasmean"),"timmean")
+    assert fusion.fuse(steps).operator == "ccdo_fast"
+    # Operators with other parameters are not fused
+    steps=chain(ctree("ccdo",None,data,operator="seasmean",extra="x"),"timmean")
+    assert fusion.fuse(steps) is steps
+
+
+def test_stop_at_cached_nodes(cached) :
+    data=cobject("ds(pr)")
+    middle=chain(data,"seasmean","selseason,DJF")
+    steps=chain(middle,"timmean","fldmean")
+    cached.add(middle.crs)
+    fused=fusion.fuse(steps)
+    assert fused.parameters == dict(operator="fldmean -timmean")
+    assert fused.operands[0] is middle
+    assert fused.crs == steps.crs
+    cached.add(steps.crs)
+    assert fusion.fuse(steps) is steps
+
+
+def test_script_outputs(cached) :
+    data=cobject("ds(pr)")
+    script=ctree("ensemble_stats",None,chain(data,"seasmean","timmean"),percentile=90)
+    script.outputs=dict(median="%s",std="%s")
+    fused=fusion.fuse(script)
+    assert fused is not script and fused.crs == script.crs
+    assert fused.outputs == script.outputs
+    assert fused.parameters == dict(percentile=90)
+    assert fused.operands[0].parameters == dict(operator="timmean -seasmean")
+    # Secondary outputs are passed through, and can start a chain
+    median=scriptChild(script,"median")
+    assert fusion.fuse(median) is median
+    steps=chain(median,"fldmean","timmean")
+    fused=fusion.fuse(steps)
+    assert fused.operands == (median,)
+    assert fused.parameters == dict(operator="timmean -fldmean")
+    assert fused.crs == steps.crs
+
+
+def test_shared_nodes(cached, monkeypatch) :
+    data=cobject("ds(pr)")
+    shared=chain(data,"seasmean","timmean")
+    diff=ctree("ccdo2",None,shared,shared,operator="sub")
+    fused=fusion.fuse(diff)
+    assert fused.crs == diff.crs
+    assert fused.operands[0] is fused.operands[1]
+    assert fused.operands[0].parameters == dict(operator="timmean -seasmean")
+    monkeypatch.setattr(fusion,"use_fusion",False)
+    assert fusion.fuse(diff) is diff
@@ -0,0 +1,50 @@
+"""
+Gini index of script module `gini`, compared to the original computation
+(a sorted copy of the data and rank-weighted sums)
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+import gini
+
+
+def reference_gini(values) :
+    data=np.sort(values,axis=0)
+    n=float(data.shape[0])
+    rank=np.arange(1,data.shape[0]+1).reshape((-1,)+(1,)*(data.ndim-1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (2.*np.nansum(data*rank,axis=0)/(n*np.nansum(data,axis=0)))-(n+1)/n
+
+
+def test_gini_array() :
+    rng=np.random.default_rng(0)
+    values=rng.gamma(2.,size=(30,4,5))
+    values[:,0,0]=0.
+    expected=reference_gini(values)
+    result=gini.gini_array(values.copy(),chunk_size=3)
+    np.testing.assert_allclose(result,expected,rtol=1e-12,equal_nan=True)
+    assert np.isnan(result[0,0])
+
+
+def test_gini_slices() :
+    rng=np.random.default_rng(1)
+    values=rng.gamma(2.,size=(40,3,2))
+    da=xr.DataArray(values,name="pr",
+                    coords=[ ("time",pd.date_range("1900-07-01",periods=40,freq="12MS")),
+                             ("lat",[0.,10.,20.]), ("lon",[0.,10.]) ])
+    out=gini.gini_slices_da(da,1905,10,3)
+    assert out.shape == (3,3,2)
+    for k in range(3) :
+        np.testing.assert_allclose(out.values[k],reference_gini(values[5+10*k:15+10*k]),rtol=1e-12)
+    np.testing.assert_allclose(gini.gini_da(da).values,reference_gini(values),rtol=1e-12)
+
+
+def test_slice_without_data() :
+    da=xr.DataArray(np.ones((20,2)),name="pr",
+                    coords=[ ("time",pd.date_range("1900-07-01",periods=20,freq="12MS")), ("lat",[0.,10.]) ])
+    with pytest.raises(ValueError,match="1920-1929") :
+        gini.gini_slices_da(da,1900,10,3)
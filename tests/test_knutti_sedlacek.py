@@ -0,0 +1,98 @@
+"""
+Knutti and Sedlacek robustness index of script module `knutti_sedlacek`,
+compared to the per-cell loop of the original code, and banded
+(out-of-core, multi-process) computation compared to the in-memory one
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+import knutti_sedlacek
+
+
+def reference_robustness(hist, fut, num_bins=1000) :
+    """
+    Per-cell computation of the original code, for arrays of dimensions
+    models x yrs x lat x lon
+    """
+    Rrob=np.zeros(hist.shape[2:])*np.nan
+    for index in np.ndindex(*hist.shape[2:]) :
+        h=hist[(slice(None),slice(None))+index]
+        f=fut [(slice(None),slice(None))+index]
+        allmods=(f-h).flatten()
+        mme=np.mean(f-h,axis=0)
+        if np.isnan(np.min(allmods)) or np.isnan(np.max(allmods)) :
+            continue
+        counts,edges=np.histogram(allmods,bins=num_bins,density=True)
+        cdf_ens=np.cumsum(counts)/np.cumsum(counts)[-1]
+        counts,_=np.histogram(mme,bins=num_bins,range=(np.min(edges),np.max(edges)),density=True)
+        cdf_mme=np.cumsum(counts)/np.cumsum(counts)[-1]
+        a1=np.sum((cdf_ens-cdf_mme)**2)
+        mme_hist=np.mean(h,axis=0)
+        mme_ssp =np.mean(f,axis=0)
+        bin_min=min(mme_hist.min(),mme_ssp.min())
+        bin_max=max(mme_hist.max(),mme_ssp.max())
+        counts,_=np.histogram(mme_hist,bins=num_bins,range=(bin_min,bin_max),density=True)
+        cdf_hist=np.cumsum(counts)/np.cumsum(counts)[-1]
+        counts,_=np.histogram(mme_ssp,bins=num_bins,range=(bin_min,bin_max),density=True)
+        cdf_ssp=np.cumsum(counts)/np.cumsum(counts)[-1]
+        Rrob[index]=1-a1/np.sum((cdf_hist-cdf_ssp)**2)
+    return Rrob
+
+
+def ensembles(rng, nmodels=4, nyears=20, nlat=6, nlon=5) :
+    hist=rng.normal(size=(nmodels,nyears,nlat,nlon))
+    fut =hist+rng.normal(loc=0.5,size=(nmodels,nyears,nlat,nlon))
+    hist[2,3,1,1]=np.nan
+    return hist, fut
+
+
+def write_ensemble(tmp_path, prefix, data) :
+    files=[]
+    for model,values in enumerate(data) :
+        ds=xr.Dataset(dict(pr=(("time","lat","lon"),values.astype(np.float32))),
+                      coords=dict(time=pd.date_range("2000-07-01",periods=values.shape[0],freq="12MS"),
+                                  lat=np.linspace(-50.,50.,values.shape[1]),
+                                  lon=np.linspace(0.,320.,values.shape[2])),
+                      attrs=dict(source_id="model%d"%model))
+        files.append(str(tmp_path/("%s_%d.nc"%(prefix,model))))
+        ds.to_netcdf(files[-1])
+    return files
+
+
+def test_robustness_per_cell() :
+    hist,fut=ensembles(np.random.default_rng(0))
+    shape=hist.shape
+    Rrob=knutti_sedlacek.robustness(hist.reshape(shape[0],shape[1],-1),fut.reshape(shape[0],shape[1],-1),
+                                    chunk_size=7).reshape(shape[2:])
+    expected=reference_robustness(hist,fut)
+    assert np.isnan(Rrob[1,1]) and np.isnan(expected[1,1])
+    np.testing.assert_allclose(Rrob,expected,rtol=1e-10,equal_nan=True)
+
+
+def banded_vs_full(tmp_path, extra_args) :
+    hist,fut=ensembles(np.random.default_rng(1))
+    references =" ".join(write_ensemble(tmp_path,"hist",hist))
+    projections=" ".join(write_ensemble(tmp_path,"ssp" ,fut))
+    full=str(tmp_path/"full.nc")
+    banded=str(tmp_path/"banded.nc")
+    knutti_sedlacek.main([ "knutti_sedlacek", references, projections, full, "1000", "1" ])
+    knutti_sedlacek.main([ "knutti_sedlacek", references, projections, banded ]+extra_args)
+    with xr.open_dataset(full) as f, xr.open_dataset(banded) as b :
+        assert np.isnan(f["KSRI"].values[1,1])
+        np.testing.assert_array_equal(f["KSRI"].values,b["KSRI"].values)
+        np.testing.assert_array_equal(f["lat"].values,b["lat"].values)
+
+
+@pytest.mark.parametrize("memory,workers", [ ("0.0001","1"), ("0.0001","2"), ("1000","2") ])
+def test_banded_vs_full(tmp_path, memory, workers) :
+    banded_vs_full(tmp_path, [ memory, workers ])
+
+
+def test_banded_from_environment(tmp_path, monkeypatch) :
+    monkeypatch.setenv("CAMMAC_KS_MEMORY","0.0001")
+    monkeypatch.setenv("CAMMAC_KS_WORKERS","2")
+    banded_vs_full(tmp_path, [])
@@ -0,0 +1,46 @@
+"""
+Periods statistics of `cancillary.periods_mean_or_std`, for series of a
+single value per record, or of basins averages
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+import CAMMAClib.cancillary as cancillary
+
+
+def series(path, values, dims) :
+    times=pd.date_range("2000-07-01",periods=values.shape[0],freq="12MS")
+    coords=dict(time=times)
+    if "basin" in dims :
+        coords["basin"]=[ "Amazon", "Lena" ]
+    xr.Dataset(dict(pr=(dims,values)),coords=coords).to_netcdf(path)
+    return path
+
+
+def test_single_value_series(tmp_path, monkeypatch) :
+    monkeypatch.setattr(cancillary,"cfile",lambda f : f)
+    values=np.arange(10.).reshape(10,1,1)
+    path=series(str(tmp_path / "pr.nc"),values,("time","lat","lon"))
+    rep=cancillary.periods_mean_or_std(path,[ "2000-2004", "2005-2009" ],"mean")
+    assert rep == { "2000-2004" : 2., "2005-2009" : 7. }
+
+
+def test_basins_series(tmp_path, monkeypatch) :
+    monkeypatch.setattr(cancillary,"cfile",lambda f : f)
+    values=np.arange(20.).reshape(10,2)
+    path=series(str(tmp_path / "pr.nc"),values,("time","basin"))
+    rep=cancillary.periods_mean_or_std(path,[ "2000-2009" ],"mean",basins=[ "Lena" ])
+    assert rep == { "Lena" : { "2000-2009" : 10. } }
+    with pytest.raises(ValueError,match="basin") :
+        cancillary.periods_mean_or_std(path,[ "2000-2009" ],"mean")
+
+
+def test_several_values_per_record(tmp_path, monkeypatch) :
+    monkeypatch.setattr(cancillary,"cfile",lambda f : f)
+    path=series(str(tmp_path / "pr.nc"),np.zeros((10,2,3)),("time","lat","lon"))
+    with pytest.raises(ValueError,match="6 values per record") :
+        cancillary.periods_mean_or_std(path,[ "2000-2009" ],"mean")
@@ -0,0 +1,70 @@
+"""
+Pre-coarsening of high resolution models is opt-in and bounded in accuracy,
+and the remapping settings are part of the keys of cached per-model
+remapped fields
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import climaf.operators
+
+import CAMMAClib.ancillary as ancillary
+import CAMMAClib.cancillary as cancillary
+import CAMMAClib.changes as changes
+from CAMMAClib.cache import cache_key
+
+
+data_versions=dict((experiment,{ "pr" : { "Amon" : { "CNRM-CM6-1-HR" : { "r1i1p1f2" : ("gr","v1","1850-2014") } } } })
+                   for experiment in [ "historical", "ssp585", "piControl" ])
+
+
+def keys() :
+    params=changes.model_fields_params("CMIP6","CNRM-CM6-1-HR","r1i1p1f2","pr","Amon","ANN","plain",
+                                       "historical","1995-2014","ssp585","2081-2100","r360x180",
+                                       0.1,{},data_versions,True,False)
+    return dict((field,cache_key(**p)) for field,p in params.items())
+
+
+def test_coarsening_is_opt_in(monkeypatch) :
+    option=ancillary.choose_regrid_option("pr","Amon","CNRM-CM6-1-HR","gr",target_grid="r360x180")
+    assert "coarsening" not in option
+    monkeypatch.setattr(ancillary,"use_coarsening",True)
+    option=ancillary.choose_regrid_option("pr","Amon","CNRM-CM6-1-HR","gr",target_grid="r360x180")
+    assert "coarsening" not in option
+    option=ancillary.choose_regrid_option("pr","Amon","CNRM-CM6-1-HR","gr",target_grid="r90x45")
+    assert option["coarsening"] == (4,4)
+
+
+def test_coarsening_tolerance(monkeypatch) :
+    calls=[]
+    errors=dict(pr=0.001,mrso=0.1)
+    monkeypatch.setattr(climaf.operators,"cached_remap",lambda data, **kwargs : (data,kwargs["coarsening"]),
+                        raising=False)
+    def coarsening_error(data, cdogrid, option, coarsening, statistics, relative) :
+        calls.append(data)
+        return [ errors[data] ]
+    monkeypatch.setattr(cancillary,"coarsening_error",coarsening_error)
+    monkeypatch.setattr(cancillary,"coarsening_checks",dict())
+    for variable in [ "pr", "mrso" ] :
+        for k in range(2) :
+            remapped=cancillary.remap(variable,"r90x45",coarsening=(4,4),accuracy_key=variable)
+            assert remapped == (variable,"4,4" if variable == "pr" else "1,1")
+    # Accuracy is checked once per key
+    assert calls == [ "pr", "mrso" ]
+    monkeypatch.setattr(ancillary,"coarsening_tolerance",None)
+    assert cancillary.remap("mrso","r90x45",coarsening=(4,4),accuracy_key="mrso") == ("mrso","4,4")
+
+
+def test_regrid_settings_change_cache_keys(monkeypatch) :
+    default=keys()
+    assert keys() == default
+    monkeypatch.setattr(ancillary,"use_coarsening",True)
+    coarsened=keys()
+    monkeypatch.setattr(ancillary,"use_coarsening",False)
+    monkeypatch.setattr(cancillary,"use_weights_cache",False)
+    direct=keys()
+    for field in default :
+        if field in [ "reference", "projection", "change_orig", "rchange_orig" ] :
+            # Fields on the native grid do not depend on remapping settings
+            assert len(set([ default[field], coarsened[field], direct[field] ])) == 1
+        else :
+            assert len(set([ default[field], coarsened[field], direct[field] ])) == 3
@@ -0,0 +1,68 @@
+"""
+Block averaging of module `remap` (used for pre-coarsening before remapping),
+compared to explicit area-weighted means over blocks of cells
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import xarray as xr
+
+import remap
+
+
+def test_block_average() :
+    rng=np.random.default_rng(0)
+    lat=np.linspace(-87.5,87.5,36)
+    lon=np.arange(0.,360.,5.)
+    data=rng.normal(size=(2,len(lat),len(lon)))
+    data[0,0:3,0:5]=np.nan
+    data[1,5,7]=np.nan
+    ds=xr.Dataset(dict(tas=(("time","lat","lon"),data.astype(np.float32))),
+                  coords=dict(time=[0.,1.],lat=lat,lon=lon))
+    fy,fx=3,5
+    out=remap.block_average(ds,fx,fy)
+    assert np.isnan(out["tas"].values[0,0,0])
+    assert out["tas"].shape == (2,12,15)
+    assert out["tas"].dtype == np.float32
+    # Cell areas, from bounds midway between cell centers
+    edges=np.concatenate(([-90.],(lat[1:]+lat[:-1])/2.,[90.]))
+    areas=(np.sin(np.deg2rad(edges[1:]))-np.sin(np.deg2rad(edges[:-1])))[:,None]*np.full(len(lon),5.)[None,:]
+    for record in range(2) :
+        for j in range(12) :
+            for i in range(15) :
+                # The last block of longitudes is incomplete
+                block=(slice(j*fy,(j+1)*fy),slice(i*fx,(i+1)*fx))
+                values=data[record][block]
+                weights=np.where(np.isnan(values),0.,areas[block])
+                if weights.sum() == 0 :
+                    assert np.isnan(out["tas"].values[record,j,i])
+                    continue
+                expected=(np.where(np.isnan(values),0.,values)*weights).sum()/weights.sum()
+                np.testing.assert_allclose(out["tas"].values[record,j,i],expected,rtol=1e-5,atol=1e-6)
+    np.testing.assert_allclose(out["lat_bnds"].values[0],[ -90., edges[fy] ])
+    np.testing.assert_allclose(out["lon_bnds"].values[-1],[ 70*5.-2.5, 357.5 ])
+
+
+def field_file(path, values) :
+    xr.Dataset(dict(tos=(("time","lat","lon"),values[None,...])),
+               coords=dict(time=[0.],lat=[0.,10.],lon=[0.,10.,20.])).to_netcdf(str(path))
+    return str(path)
+
+
+def test_weights_keyed_by_mask(tmp_path, monkeypatch) :
+    generated=[]
+    def check_call(command) :
+        generated.append(command[-1])
+        open(command[-1],"w").close()
+    monkeypatch.setattr(remap,"grid_signature",lambda filename : "grid")
+    monkeypatch.setattr(remap.subprocess,"check_call",check_call)
+    full=field_file(tmp_path/"full.nc",np.arange(6.).reshape(2,3))
+    other=field_file(tmp_path/"other.nc",np.arange(6.).reshape(2,3)+1.)
+    masked=np.arange(6.).reshape(2,3)
+    masked[0,1]=np.nan
+    land=field_file(tmp_path/"land.nc",masked)
+    weights_dir=str(tmp_path/"weights")
+    paths=[ remap.weights_file(f,"r360x180","remapcon",weights_dir) for f in [ full, other, land ] ]
+    assert paths[0] == paths[1]
+    assert paths[0] != paths[2]
+    assert len(generated) == 2
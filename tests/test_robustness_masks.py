@@ -0,0 +1,57 @@
+"""
+Robustness masks of script module `robustness_masks`, compared to cell by
+cell applications of the AR5 and AR6 schemes, as computed with CDO
+operators in `variability.stippling_hatching_masks_AR5` and
+`variability.lowchange_conflict_masks_AR6`
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+
+import robustness_masks
+
+
+def reference_masks(changes, variabilities, nchanges) :
+    keys=[ "agree", "medvar", "stippling", "hatching", "agreelow", "lowchange", "conflict" ]
+    rep=dict((key,np.full(changes.shape[1:],np.nan)) for key in keys)
+    nb=changes.shape[0]
+    for cell in np.ndindex(*changes.shape[1:]) :
+        c=changes[(slice(None),)+cell]
+        v=np.sort(variabilities[(slice(None),)+cell])
+        n=nchanges[(slice(None),)+cell]
+        agree=max((c <= 0).sum(),(c >= 0).sum())/float(nb)
+        medvar=v[int(np.ceil(len(v)/2.))-1]
+        change=abs(c.mean())
+        agreelow=(np.abs(n) <= 1.645).sum()/float(nb)
+        lowchange=float(agreelow >= 0.33)
+        rep["agree"][cell]=agree
+        rep["medvar"][cell]=medvar
+        rep["hatching"][cell]=float(change < medvar)
+        rep["stippling"][cell]=float(change >= 2*medvar and agree >= 0.9)
+        rep["agreelow"][cell]=agreelow
+        rep["lowchange"][cell]=lowchange
+        if lowchange == 0 :
+            rep["conflict"][cell]=float(agree < 0.8)
+    return rep
+
+
+def test_robustness_masks() :
+    rng=np.random.default_rng(0)
+    shape=(10,6,7)
+    changes=rng.normal(loc=rng.normal(scale=2.,size=shape[1:]),size=shape)
+    variabilities=rng.uniform(0.1,1.,size=shape)
+    nchanges=changes/variabilities
+    masks=robustness_masks.robustness_masks(changes,variabilities,nchanges)
+    expected=reference_masks(changes,variabilities,nchanges)
+    for key in expected :
+        np.testing.assert_allclose(masks[key],expected[key],rtol=1e-12,equal_nan=True,err_msg=key)
+    assert (masks["stippling"] == 1).any() and (masks["hatching"] == 1).any()
+    assert (~np.isnan(masks["conflict"])).any()
+
+
+def test_missing_values() :
+    changes=np.full((4,2),np.nan)
+    changes[:,1]=[ 1., 2., -1., 3. ]
+    masks=robustness_masks.robustness_masks(changes,np.ones((4,2)),changes)
+    for key in [ "agree", "stippling", "hatching", "agreelow", "lowchange" ] :
+        assert np.isnan(masks[key][0]) and not np.isnan(masks[key][1]), key
@@ -0,0 +1,128 @@
+"""
+Time windows statistics of script module `series`, compared to the
+straightforward computations they replace (CDO seldate slicing followed by
+timmean, or by trend removal and timstd1)
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+import series
+
+
+def dataset(times, values) :
+    return xr.Dataset(dict(tas=(("time","lat","lon"),values)),
+                      coords=dict(time=times, lat=[0.,10.], lon=[0.,10.,20.]))
+
+
+def djf_seasmean(begin, end, rng) :
+    """
+    Returns a Dataset emulating CDO's 'selseason,DJF -seasmean' for monthly
+    data of years BEGIN to END : a first partial season (January, February),
+    complete seasons, and a lone December, each dated by its last month
+    """
+    months=pd.date_range("%d-01-15"%begin,"%d-12-15"%end,freq="MS")+pd.Timedelta(days=14)
+    monthly=rng.normal(size=(len(months),2,3))
+    label=months.year+(months.month == 12)
+    times,values=[],[]
+    for year in np.unique(label[np.isin(months.month,[12,1,2])]) :
+        selected=np.nonzero(np.isin(months.month,[12,1,2]) & (label == year))[0]
+        times.append(months[selected[-1]])
+        values.append(monthly[selected].mean(axis=0))
+    return dataset(pd.DatetimeIndex(times),np.array(values))
+
+
+def seldate(ds, first, last) :
+    return ds["tas"].values[(ds["time"].dt.year.values >= first) & (ds["time"].dt.year.values <= last)]
+
+
+def reference_detrended_std(values) :
+    t=np.arange(values.shape[0])
+    rep=np.empty(values.shape[1:])
+    for index in np.ndindex(*values.shape[1:]) :
+        x=values[(slice(None),)+index]
+        slope=np.polyfit(t,x,1)[0]
+        rep[index]=np.std(x-slope*t,ddof=1)
+    return rep
+
+
+@pytest.mark.parametrize("step", [ None, 10 ])
+def test_slices_means_yearly(step) :
+    rng=np.random.default_rng(0)
+    values=rng.normal(size=(60,2,3))
+    ds=dataset(pd.date_range("1900-07-01",periods=60,freq="12MS"),values)
+    out=series.slices_means(ds,1905,20,2,step)
+    firsts=[ 1905+s for s in range(0,21,step or 20) ]
+    assert out["tas"].shape[0] == len(firsts)
+    for record,first in enumerate(firsts) :
+        np.testing.assert_allclose(out["tas"].values[record],seldate(ds,first,first+19).mean(axis=0),rtol=1e-12)
+
+
+def test_slices_means_djf_lone_december() :
+    ds=djf_seasmean(1900,1939,np.random.default_rng(1))
+    assert ds["time"].size == 41
+    out=series.slices_means(ds,1900,20,2)
+    for record,first in enumerate([ 1900, 1920 ]) :
+        expected=seldate(ds,first,first+19)
+        np.testing.assert_allclose(out["tas"].values[record],expected.mean(axis=0),rtol=1e-12)
+    assert len(seldate(ds,1920,1939)) == 21
+
+
+def test_windows_iav_djf_lone_december() :
+    ds=djf_seasmean(1900,1939,np.random.default_rng(2))
+    out=series.windows_reduce(ds, lambda data,starts,stops : series.windows_iav(data,starts,stops,2.),
+                              1900,20,2)
+    for record,first in enumerate([ 1900, 1920 ]) :
+        expected=2.*reference_detrended_std(seldate(ds,first,first+19))
+        np.testing.assert_allclose(out["tas"].values[record],expected,rtol=1e-10)
+
+
+def test_missing_year_is_an_error() :
+    ds=djf_seasmean(1900,1939,np.random.default_rng(3))
+    with pytest.raises(ValueError) :
+        series.slices_means(ds,1930,20,1)
+
+
+def test_window_statistics() :
+    rng=np.random.default_rng(4)
+    x=300.+0.02*np.arange(250)+rng.normal(size=250)
+    x[17]=np.nan
+    prefix=series.prefix_statistics(x)
+    for start,stop in [ (0,20), (100,130), (5,250) ] :
+        stats=series.window_statistics(prefix,start,stop)
+        valid=~np.isnan(x[start:stop])
+        y=x[start:stop][valid]
+        t=np.arange(start,stop)[valid]
+        slope=np.polyfit(t,y,1)[0]
+        np.testing.assert_allclose([ stats["mean"], stats["std"], stats["detrended_std"] ],
+                                   [ y.mean(), y.std(ddof=1), np.std(y-slope*t,ddof=1) ],rtol=1e-10)
+        if valid.all() :
+            np.testing.assert_allclose(stats["detrended_std"],series.detrended_std(x[start:stop]),rtol=1e-10)
+
+
+def test_walsh_seasonality() :
+    rng=np.random.default_rng(5)
+    months=pd.date_range("2000-01-01",periods=36,freq="MS")+pd.Timedelta(days=14)
+    values=rng.gamma(2.,size=(36,2,3))*1.e-5
+    values[0:12,0,0]*=1.e-3
+    values[14,1,2]=np.nan
+    ds=dataset(months,values)
+    threshold=1.e-5
+    out=series.walsh_dataset(ds,threshold)
+    assert list(out["time"].values) == list(months[[ 11, 23, 35 ]].values)
+    days=months.days_in_month.values
+    for record in range(3) :
+        year=slice(12*record,12*(record+1))
+        for cell in np.ndindex(2,3) :
+            x=values[(year,)+cell]
+            valid=~np.isnan(x)
+            annual=12.*(x[valid]*days[year][valid]).sum()/days[year][valid].sum()
+            if annual < threshold :
+                assert np.isnan(out["tas"].values[(record,)+cell])
+                continue
+            expected=np.abs(x[valid]/annual-1./12.).sum()
+            np.testing.assert_allclose(out["tas"].values[(record,)+cell],expected,rtol=1e-10)
+    assert np.isnan(out["tas"].values[0,0,0])
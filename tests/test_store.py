@@ -0,0 +1,46 @@
+"""
+Store of yearly seasonal means : materialized means match CDO's yearmean
+and seasmean, and seasons crossing a year boundary are not served
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import CAMMAClib.store as store
+
+
+def monthly_files(directory, rng) :
+    """ Two files of monthly data for 1850-1859, split in the middle of a year """
+    times=pd.date_range("1850-01-01",periods=120,freq="MS")+pd.Timedelta(days=14)
+    values=rng.normal(size=(120,2,3)).astype(np.float32)
+    values[5,0,0]=np.nan
+    ds=xr.Dataset(dict(pr=(("time","lat","lon"),values)),
+                  coords=dict(time=times, lat=[0.,10.], lon=[0.,10.,20.]))
+    files=[ os.path.join(directory,"pr_%d.nc"%i) for i in range(2) ]
+    ds.isel(time=slice(0,65)).to_netcdf(files[0])
+    ds.isel(time=slice(65,None)).to_netcdf(files[1])
+    return ds, files
+
+
+def test_materialized_means(tmp_path) :
+    ds,files=monthly_files(str(tmp_path),np.random.default_rng(0))
+    paths=dict((season,str(tmp_path / ("%s.nc"%season))) for season in store.store_seasons)
+    store.materialize(files[::-1],"pr",paths)
+    for season,months in store.store_seasons.items() :
+        selected=ds["pr"].where(ds["time"].dt.month.isin(months),drop=True)
+        expected=selected.groupby("time.year").mean("time").values
+        with xr.open_dataset(paths[season]) as out :
+            np.testing.assert_allclose(out["pr"].values,expected,rtol=1e-6,atol=1e-6)
+            assert list(out["time"].dt.month.values) == [ months[-1] ]*10
+
+
+def test_no_djf(tmp_path) :
+    assert "DJF" not in store.store_seasons
+    path=store.store_path(str(tmp_path),"CMIP6","historical","M","r1","pr","Amon","v1","gn","DJF")
+    os.makedirs(os.path.dirname(path))
+    open(path,"w").close()
+    assert store.seasonal_field("CMIP6","historical","M","r1","pr","Amon","v1","gn","DJF","1850-1859",
+                                root=str(tmp_path)) is None
@@ -0,0 +1,74 @@
+"""
+Structure of the results of `variability.variability_AR5`, with CliMAF
+operators replaced by functions which build symbolic values
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import pytest
+
+import climaf.operators
+import CAMMAClib.variability as variability
+
+
+class Ensemble(dict) :
+    pass
+
+
+class Period(object) :
+    def __init__(self, period) :
+        self.period=period
+    def iso(self) :
+        return self.period
+
+
+data_versions={ "piControl" : { "pr" : { "Amon" : { "M1" : { "r1i1p1f1" : ("gn","v1","1850-2349") } } } } }
+
+
+@pytest.fixture
+def symbolic(monkeypatch) :
+    """
+    Replace CliMAF operators used by variability_AR5 with functions
+    returning tuples; returns the list of calls to 'slices_means'
+    """
+    calls=[]
+
+    def ccdo(dat, operator) :
+        # As CliMAF does, an operator applied to an ensemble applies to each member
+        if isinstance(dat,Ensemble) :
+            return Ensemble((member,ccdo(dat[member],operator)) for member in dat)
+        return ("ccdo",operator,dat)
+
+    def slices_means(dat, **kwargs) :
+        calls.append(kwargs)
+        return ("slices_means",dat)
+
+    monkeypatch.setattr(variability,"ds",lambda **kwargs : ("ds",kwargs["period"]),raising=False)
+    monkeypatch.setattr(variability,"ccdo",ccdo,raising=False)
+    monkeypatch.setattr(variability,"ccdo_fast",ccdo,raising=False)
+    monkeypatch.setattr(variability,"ccdo_ens",lambda ens, operator : ("ens",operator,tuple(sorted(ens))),
+                        raising=False)
+    monkeypatch.setattr(variability,"cens",Ensemble,raising=False)
+    monkeypatch.setattr(variability,"init_period",Period)
+    monkeypatch.setattr(variability,"institute_for_model",lambda model : "I")
+    monkeypatch.setattr(variability,"seasonal_field",lambda *args : None)
+    monkeypatch.setattr(variability,"init_trend",lambda : None)
+    monkeypatch.setattr(variability,"init_series",lambda : None)
+    monkeypatch.setattr(climaf.operators,"ols_detrend",lambda dat : ("detrended",dat))
+    monkeypatch.setattr(climaf.operators,"slices_means",slices_means)
+    return calls
+
+
+def test_slices_ensemble_without_variability(symbolic) :
+    means=variability.variability_AR5("M1","r1i1p1f1","pr","Amon",data_versions,season="JJA",
+                                      nyears=20,number=3,variability=False,compute=False)
+    assert isinstance(means,Ensemble)
+    assert sorted(means) == [ "1950-1969", "1970-1989", "1990-2009" ]
+    assert means["1970-1989"][:2] == ("ccdo","timmean")
+    assert symbolic == []
+
+
+def test_native_slices_with_variability(symbolic) :
+    variab=variability.variability_AR5("M1","r1i1p1f1","pr","Amon",data_versions,season="JJA",
+                                       nyears=20,number=3,step=10,compute=False)
+    assert symbolic == [ dict(begin=1950,nyears=20,number=3,step=10) ]
+    assert variab[:2] == ("ccdo","mulc,1.414")
@@ -0,0 +1,108 @@
+"""
+Persistent worker : requests run with the client's environment (restricted
+to forwarded variables), even when the server was started from another
+environment; the socket must be private to the user; clients which start
+concurrently launch a single server
+"""
+from __future__  import division, print_function , unicode_literals, absolute_import
+
+import os, signal, sys, time
+import multiprocessing
+
+import pytest
+
+import worker
+
+
+def probe(argv) :
+    """ An operator which prints the value of environment variable ARGV[1] """
+    print("%s=%s"%(argv[1],os.environ.get(argv[1])))
+
+
+def test_client_environment_is_used(tmp_path, monkeypatch, capfd) :
+    path=str(tmp_path / "worker.sock")
+    worker.register_operator("env_probe","test_worker","probe")
+    monkeypatch.setenv("CAMMAC_KS_MEMORY","server")
+    pid=os.fork()
+    if pid == 0 :
+        try :
+            worker.serve(path,idle=60)
+        finally :
+            os._exit(0)
+    try :
+        start=time.time()
+        while not os.path.exists(path) and time.time()-start < 30 :
+            time.sleep(0.05)
+        monkeypatch.setenv("CAMMAC_WORKER_SOCKET",path)
+        for value in [ "0.05", "1.5" ] :
+            monkeypatch.setenv("CAMMAC_KS_MEMORY",value)
+            assert worker.client("env_probe",[ "env_probe", "CAMMAC_KS_MEMORY" ]) == 0
+            assert "CAMMAC_KS_MEMORY=%s"%value in capfd.readouterr().out
+        monkeypatch.delenv("CAMMAC_KS_MEMORY")
+        worker.client("env_probe",[ "env_probe", "CAMMAC_KS_MEMORY" ])
+        assert "CAMMAC_KS_MEMORY=None" in capfd.readouterr().out
+        # Other variables are not sent to the worker
+        monkeypatch.setenv("SOME_TOKEN","secret")
+        worker.client("env_probe",[ "env_probe", "SOME_TOKEN" ])
+        assert "SOME_TOKEN=None" in capfd.readouterr().out
+    finally :
+        os.kill(pid,signal.SIGTERM)
+        os.waitpid(pid,0)
+        worker.operators.pop("env_probe")
+
+
+def test_shared_directory_is_refused(tmp_path, monkeypatch, capfd) :
+    shared=tmp_path / "shared"
+    shared.mkdir()
+    os.chmod(str(shared),0o777)
+    with pytest.raises(IOError) :
+        worker.check_private(str(shared))
+    # The client then runs the operator itself
+    worker.register_operator("env_probe","test_worker","probe")
+    try :
+        monkeypatch.setenv("CAMMAC_WORKER_SOCKET",str(shared / "worker.sock"))
+        monkeypatch.setenv("CAMMAC_KS_MEMORY","direct")
+        assert worker.client("env_probe",[ "env_probe", "CAMMAC_KS_MEMORY" ]) == 0
+        out=capfd.readouterr().out
+        assert "not available" in out and "CAMMAC_KS_MEMORY=direct" in out
+        assert not os.path.exists(str(shared / "worker.sock"))
+    finally :
+        worker.operators.pop("env_probe")
+
+
+def servers(path) :
+    """
+    Returns the pids of the worker servers listening on PATH, excluding
+    the children they fork for handling requests
+    """
+    parents=dict()
+    for pid in os.listdir("/proc") :
+        try :
+            with open("/proc/%s/cmdline"%pid,"rb") as f :
+                args=f.read().decode('utf-8').split("\0")
+            with open("/proc/%s/stat"%pid) as f :
+                ppid=int(f.read().rsplit(")",1)[1].split()[1])
+        except (IOError, OSError, ValueError) :
+            continue
+        if "--serve" in args and path in args :
+            parents[int(pid)]=ppid
+    return [ pid for pid,ppid in parents.items() if ppid not in parents ]
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="uses /proc")
+def test_concurrent_starts_launch_one_server(tmp_path, monkeypatch) :
+    path=str(tmp_path / "worker.sock")
+    monkeypatch.setenv("CAMMAC_WORKER_IDLE","30")
+    clients=[ multiprocessing.Process(target=worker.start_server,args=(path,)) for k in range(4) ]
+    for c in clients :
+        c.start()
+    for c in clients :
+        c.join()
+    pids=servers(path)
+    try :
+        assert [ c.exitcode for c in clients ] == [ 0 ]*4
+        assert len(pids) == 1
+        worker.connect(path).close()
+    finally :
+        for pid in pids :
+            os.kill(pid,signal.SIGTERM)